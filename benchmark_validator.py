@@ -0,0 +1,344 @@
+import argparse
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+import data_validator
+
+ODD_EVEN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'odd:even byte check')
+# case variants generated by make_case_tree, in the order they are handed out to the cases
+CASE_VARIANTS = ['missing', 'multi_acquisition', 'localizer', 'compressed']
+# a timing is flagged when it is this much slower than the baseline
+REGRESSION_THRESHOLD = 0.2
+# ... and at least this many seconds slower, so sub-millisecond stages do not flag on timer noise
+REGRESSION_MIN_SECONDS = 0.005
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+BENCH_REQUIREMENTS = {"DICOMRequirements": {"SOPClassUID": [CT_IMAGE_STORAGE], "Modality": ["CT"],
+                                            "MinKVP": 100, "MaxKVP": 140, "MinSliceThickness": 0.5,
+                                            "MaxSliceThickness": 5, "MinRows": 64, "MinColumns": 64}}
+
+
+def make_slice(path, series_uid, study_uid, instance, rows, columns, z, spacing=0.5, acquisition=1,
+               image_type=('ORIGINAL', 'PRIMARY', 'AXIAL'), transfer_syntax=ExplicitVRLittleEndian):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.Modality = 'CT'
+    ds.ImageType = list(image_type)
+    ds.ConvolutionKernel = 'STANDARD'
+    ds.PatientPosition = 'HFS'
+    ds.KVP = 120
+    ds.AcquisitionNumber = acquisition
+    ds.InstanceNumber = instance
+    ds.ImagePositionPatient = [0.0, 0.0, z]
+    ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    ds.PixelSpacing = [spacing, spacing]
+    ds.SliceThickness = 1.0
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.RescaleIntercept = -1024
+    ds.RescaleSlope = 1
+    ds.PixelData = np.full((rows, columns), instance % 4096, dtype=np.uint16).tobytes()
+    if transfer_syntax != ExplicitVRLittleEndian:
+        # RLE Lossless is the one compressed syntax pydicom can encode without extra plugins
+        ds.compress(transfer_syntax)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def case_variants(series_count, **counts):
+    # variant (or None for a clean case) of each generated case; the variants take the first cases in
+    # CASE_VARIANTS order, e.g. missing=1, compressed=2 -> ['missing', 'compressed', 'compressed', None, ...]
+    variants = []
+    for variant in CASE_VARIANTS:
+        variants.extend([variant] * counts.get(variant, 0))
+    if len(variants) > series_count:
+        raise ValueError('%d special cases requested but only %d cases generated' % (len(variants), series_count))
+    return variants + [None] * (series_count - len(variants))
+
+
+def make_case_tree(root, series_count=4, slice_count=50, rows=512, columns=512, slice_spacing=1.0, **counts):
+    # one directory per series, laid out like an export: <root>/case_NNN/IM-NNNN.dcm.
+    # `counts` give the number of cases of each of CASE_VARIANTS: a slice dropped from the middle, the second half
+    # of the slices in acquisition 2, LOCALIZER image type, RLE Lossless pixel data
+    for s, variant in enumerate(case_variants(series_count, **counts)):
+        case_dir = os.path.join(root, 'case_%03d' % s)
+        os.makedirs(case_dir, exist_ok=True)
+        series_uid = generate_uid()
+        study_uid = generate_uid()
+        for i in range(slice_count):
+            if variant == 'missing' and i == slice_count // 2:
+                continue
+            options = {}
+            if variant == 'multi_acquisition' and i >= slice_count // 2:
+                options['acquisition'] = 2
+            elif variant == 'localizer':
+                options['image_type'] = ('ORIGINAL', 'PRIMARY', 'LOCALIZER')
+            elif variant == 'compressed':
+                options['transfer_syntax'] = RLELossless
+            make_slice(os.path.join(case_dir, 'IM-%04d.dcm' % (i + 1)), series_uid, study_uid, i + 1,
+                       rows, columns, i * slice_spacing, **options)
+    return root
+
+
+def bytes_read():
+    # cumulative bytes this process has read through read(2); None where /proc is unavailable
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def drop_from_cache(files):
+    # evicts the files from the page cache so the next pass reads them from disk; False where the platform has no
+    # posix_fadvise (the passes then run on whatever the cache holds)
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for path in files:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def time_reads(files, with_pixels):
+    # one pass over cold files where the page cache can be dropped
+    drop_from_cache(files)
+    start_bytes = bytes_read()
+    start = time.perf_counter()
+    for path in files:
+        ds = data_validator.read_slice(path, data_validator.HEADER_TAGS, with_pixels)
+        if with_pixels:
+            ds.PixelData
+    elapsed = time.perf_counter() - start
+    end_bytes = bytes_read()
+    read = None if start_bytes is None else end_bytes - start_bytes
+    return elapsed, read
+
+
+def bench_header_reads(root):
+    files = sorted(os.path.join(d, f) for d, _, names in os.walk(root) for f in names if f.endswith('.dcm'))
+    print('files:', len(files))
+    if not hasattr(os, 'posix_fadvise'):
+        print('note: page cache cannot be dropped here, both passes may read from memory')
+    results = {}
+    for label, with_pixels in (('full', True), ('header-only', False)):
+        elapsed, read = time_reads(files, with_pixels)
+        results[label] = (elapsed, read)
+        print('%-12s %8.3f s  %s bytes read' % (label, elapsed, 'n/a' if read is None else read))
+    full, header = results['full'], results['header-only']
+    print('wall-clock speedup: %.1fx' % (full[0] / header[0]))
+    if full[1] and header[1]:
+        print('I/O reduction: %.1fx' % (full[1] / header[1]))
+    return results
+
+
+class LatencyInjector(object):
+    # stand-in for a high-latency network filesystem: every slice read done by data_validator waits
+    # `latency` seconds first (sleeping releases the GIL like blocking network I/O does)
+    def __init__(self, latency):
+        self.latency = latency
+        self.original = None
+
+    def read(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.original(*args, **kwargs)
+
+    def __enter__(self):
+        self.original = data_validator.read_slice
+        data_validator.read_slice = self.read
+        return self
+
+    def __exit__(self, *exc_info):
+        data_validator.read_slice = self.original
+
+
+def run_analyze_cases(root, work_dir, **overrides):
+    # one quiet analyze_cases run over `root`; returns (seconds, summary)
+    req_path = os.path.join(work_dir, 'requirements.json')
+    with open(req_path, 'w') as f:
+        json.dump(BENCH_REQUIREMENTS, f)
+    output_dir = tempfile.mkdtemp(dir=work_dir)
+    params = dict(data_validator.DEFAULTS, input_req_json_path=req_path, path_to_dicoms=root, output_dir=output_dir)
+    params.update(overrides)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        summary = data_validator.analyze_cases(params)
+    return time.perf_counter() - start, summary
+
+
+def load_odd_even_checker():
+    # the odd/even byte check is a script whose file name is not importable, so it is loaded from its path
+    loader = importlib.machinery.SourceFileLoader('odd_even_byte_check', ODD_EVEN_SCRIPT)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def best_of(repeat, run):
+    # lowest wall time of `repeat` runs and the result of the last run
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def bench_suite(root, repeat=3):
+    # end-to-end and per-stage timings of analyze_cases and the odd/even checker plus their verdict counts;
+    # timings are flat `<benchmark>.<measure>` keys so they can be compared against a baseline one by one
+    work_dir = tempfile.mkdtemp(prefix='dv_bench_out_')
+    timings, results = {}, {}
+    try:
+        runs = []
+        for _ in range(repeat):
+            metrics_path = os.path.join(work_dir, 'metrics.json')
+            elapsed, summary = run_analyze_cases(root, work_dir, profile=metrics_path)
+            with open(metrics_path) as f:
+                runs.append((elapsed, summary, json.load(f)))
+        elapsed, summary, metrics = min(runs, key=lambda run: run[0])
+        timings['analyze_cases.total'] = elapsed
+        for stage, stage_times in metrics['stages'].items():
+            timings['analyze_cases.' + stage] = stage_times['wall']
+        timings['analyze_cases.read'] = metrics['case_stages']['read']
+        timings['analyze_cases.checks'] = metrics['case_stages']['checks']
+        results['analyze_cases'] = dict(failed=summary['number_of_failed_cases'],
+                                        errored=summary['number_of_errored_cases'],
+                                        total=summary['number_of_total_cases'],
+                                        files_read=metrics['totals']['files_read'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    checker = load_odd_even_checker()
+    start = time.perf_counter()
+    files = checker.collect_files([root])
+    timings['odd_even.collect'] = time.perf_counter() - start
+    timings['odd_even.check'], summary = best_of(repeat, lambda: checker.run_batch(files))
+    timings['odd_even.total'] = timings['odd_even.collect'] + timings['odd_even.check']
+    results['odd_even'] = summary['counts']
+
+    for key, value in sorted(timings.items()):
+        print('%-28s %8.3f s' % (key, value))
+    for key, value in sorted(results.items()):
+        print('%-28s %s' % (key, json.dumps(value, sort_keys=True)))
+    return timings, results
+
+
+def compare_to_baseline(report, baseline, threshold=REGRESSION_THRESHOLD):
+    # list of regression messages: timings more than `threshold` slower than the baseline, and any change in the
+    # verdict counts (a faster run that decides differently is not an improvement)
+    regressions = []
+    if report['config'] != baseline['config']:
+        print('warning: baseline was recorded with a different tree:', json.dumps(baseline['config'], sort_keys=True))
+    for key, value in sorted(report['timings'].items()):
+        if key not in baseline['timings']:
+            continue
+        before = baseline['timings'][key]
+        change = (value - before) / before if before > 0 else 0.0
+        print('%-28s %8.3f s  baseline %8.3f s  %+6.1f%%' % (key, value, before, change * 100))
+        if change > threshold and value - before > REGRESSION_MIN_SECONDS:
+            regressions.append('%s: %.3f s vs %.3f s baseline (%+.1f%%)' % (key, value, before, change * 100))
+    for key, value in sorted(report['results'].items()):
+        if key in baseline['results'] and baseline['results'][key] != value:
+            regressions.append('%s results changed: %s vs %s baseline'
+                               % (key, json.dumps(value, sort_keys=True),
+                                  json.dumps(baseline['results'][key], sort_keys=True)))
+    return regressions
+
+
+def bench_prefetch(root, latency, depth=4, threads=8):
+    work_dir = tempfile.mkdtemp(prefix='dv_bench_out_')
+    try:
+        with LatencyInjector(latency):
+            serial, _ = run_analyze_cases(root, work_dir)
+            prefetched, _ = run_analyze_cases(root, work_dir, prefetch=depth, io_threads=threads)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print('injected latency per file: %.1f ms' % (latency * 1000))
+    print('%-12s %8.3f s' % ('sequential', serial))
+    print('%-12s %8.3f s  (depth %d, %d threads)' % ('prefetch', prefetched, depth, threads))
+    print('throughput gain: %.1fx' % (serial / prefetched))
+    return serial, prefetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data Validator benchmarks")
+    parser.add_argument('--series', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=50)
+    parser.add_argument('--matrix', type=int, default=512)
+    for variant in CASE_VARIANTS:
+        parser.add_argument('--' + variant, help="number of generated cases with %s slices" % variant.replace('_', '-'),
+                            type=int, default=0)
+    parser.add_argument('--latency', help="per-file latency in ms injected for the prefetch benchmark",
+                        type=float, default=2.0)
+    parser.add_argument('--repeat', help="runs per timing, the fastest is kept", type=int, default=3)
+    parser.add_argument('--keep', help="directory to generate the synthetic tree in (kept after the run)",
+                        type=str, default=None)
+    parser.add_argument('--save_baseline', help="write this run's timings and results to a baseline JSON file",
+                        type=str, default=None)
+    parser.add_argument('--baseline', help="compare this run against a baseline JSON file, exit 1 on regressions",
+                        type=str, default=None)
+    parser.add_argument('--threshold', help="slowdown relative to the baseline that counts as a regression",
+                        type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+    counts = dict((variant, getattr(args, variant)) for variant in CASE_VARIANTS)
+    config = dict(series=args.series, slices=args.slices, matrix=args.matrix, **counts)
+    root = args.keep or tempfile.mkdtemp(prefix='dv_bench_')
+    try:
+        make_case_tree(root, args.series, args.slices, args.matrix, args.matrix, **counts)
+        bench_header_reads(root)
+        bench_prefetch(root, args.latency / 1000.0)
+        timings, results = bench_suite(root, args.repeat)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(root, ignore_errors=True)
+    report = dict(config=config, timings=timings, results=results)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('baseline written to', args.save_baseline)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f), args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            return 1
+        print('no regressions above %.0f%%' % (args.threshold * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-# import io
+import io
 import json
 import csv
 # import pandas as pd
@@ -9,549 +9,2303 @@ import argparse
 import sys
 from tqdm import tqdm
 import multiprocessing
+import functools
+import itertools
+import collections
+import difflib
 import traceback
+import sqlite3
+import threading
+import concurrent.futures
+import time
+import contextlib
+import heapq
+import cProfile
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import hashlib
+import glob
+import tempfile
+import shutil
+import types
+from array import array
+from pydicom.multival import MultiValue
 
+from dicom_sources import (MEMBER_SEPARATOR, archive_cases, dicomdir_cases, find_dicomdir, is_archive, open_source,
+                           read_source, source_stat, split_member, stream_order)
+from pixel_data import PixelDataElement, frame_statistics, hash_pixel_data, locate_pixel_data
+
+# cases written between flushes of the result files
+FLUSH_EVERY = 100
 DEFAULTS = dict(input_req_json_path=None, path_to_dicoms=None, output_dir=None,
                 rejected_results_filename="rejected_case_summary.csv",
                 accepted_results_filename="accepted_case_summary.csv",
                 rejected_results_json="rejected_case_summary.json",
-                accepted_results_json="accepted_case_summary.json")
+                accepted_results_json="accepted_case_summary.json",
+                flagged_results_filename="flagged_case_summary.csv",
+                flagged_results_json="flagged_case_summary.json", workers=1, case_index=None,
+                metadata_cache=None, resume=False, prefetch=0, io_threads=8, profile=None, profile_slowest=10,
+                cprofile=None, watch=False, settle=2.0, poll_interval=0.5, poll=False, group_by='directory',
+                shard=None, duplicates=None, duplicates_hash=False, triage=None, results_db=None,
+                flush_every=FLUSH_EVERY)
 RETURN_CODES = dict(no_error=[0, "no error"], missing_req_input=[1, 'missing required input'],
-                    nonexistent_path=[2, 'nonexistent path'], processing_error=[3, 'processing error'])
+                    nonexistent_path=[2, 'nonexistent path'], processing_error=[3, 'processing error'],
+                    invalid_requirements=[4, 'invalid requirements file'],
+                    incomplete_shards=[5, 'missing or incomplete shards'], unknown_run=[6, 'no such run'])
+# every header tag analyze_cases looks at; slices are read up to (not including) PixelData
+HEADER_TAGS = ['SOPClassUID', 'SOPInstanceUID', 'SeriesInstanceUID', 'AcquisitionNumber', 'InstanceNumber', 'KVP',
+               'Rows', 'Columns', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'ImageType',
+               'PatientPosition', 'Modality', 'ConvolutionKernel']
+# extra tags read for the pixel rules, and the pseudo tag asking for per-slice pixel statistics in the slice header
+PIXEL_TAGS = ['BitsAllocated', 'PixelRepresentation', 'SamplesPerPixel', 'NumberOfFrames', 'RescaleSlope',
+              'RescaleIntercept']
+PIXEL_STATISTICS = 'PixelStatistics'
+# pseudo tag asking for a hash of the PixelData value in the slice header, for the duplicate index
+PIXEL_DATA_HASH = 'PixelDataHash'
+PSEUDO_TAGS = [PIXEL_STATISTICS, PIXEL_DATA_HASH]
+# first-slice tags a case is rejected without, checked in this order
+REQUIRED_SLICE_TAGS = [('KVP', 'Case does not have kVP tag.'), ('Rows', 'Case does not have Rows tag.'),
+                       ('Columns', 'Case does not have Columns tag.'),
+                       ('ImagePositionPatient', 'Case does not have IPP tag.'),
+                       ('ImageOrientationPatient', 'Case does not have IOP tag.'),
+                       ('PixelSpacing', 'Case does not have Pixel Spacing tag.'),
+                       ('ImageType', 'Case does not have Image Type tag.')]
+REJECTED_IMAGE_TYPES = ['LOCALIZER', 'SCOUT', 'MIP']
+REQUIRED_CTA_TAGS = [('PatientPosition', 'Case does not have Patient Position tag.'),
+                     ('Modality', 'Case does not have Modality tag.'),
+                     ('ConvolutionKernel', 'Case does not have Convolution Kernel tag.')]
+# bump when the layout of cached slice headers changes
+CACHE_VERSION = 1
+# header fields of one slice, attributes exist only for tags present in the file
+SliceHeader = types.SimpleNamespace
 
 
-def analyze_cases(params):
-    cases_list = []
-    cases_path = params['path_to_dicoms']
+Rule = collections.namedtuple('Rule', ['key', 'measure', 'limit', 'check', 'message'])
+Requirements = collections.namedtuple('Requirements', ['sop_class_uids', 'header_rules', 'case_rules', 'tags',
+                                                       'with_pixels', 'pixel_rules'])
+# verdict of one case: messages is None when the case passed, status is 'accepted'/'rejected'/'error',
+# metrics are the --profile case metrics or None, instances the (SOPInstanceUID, PixelDataHash, path) of every slice
+# when the duplicate index asked for them, measures the case measures the rules were evaluated on (None for a case
+# stopped before its measures were taken)
+CaseResult = collections.namedtuple('CaseResult', ['case', 'messages', 'status', 'metrics', 'instances', 'measures'],
+                                    defaults=[None, None])
 
-    # set() for unique with/i greater for loop
-    for dir_name, sub_dirlist, files in os.walk(cases_path):
-        for filename in files:
-            if ".dcm" in filename.lower():
-                cases_list.append(dir_name)
-    rejected_cases = {'rejected_cases_list': {}}
-    warning_cases = {'warning_cases_list': {}}
-    cases_list = sorted(list(set(cases_list)))
-    for case_path in tqdm(cases_list):
-        files_list = []
-        for dir_name, sub_dirlist, files in os.walk(case_path):
-            for filename in files:
-                if ".dcm" in filename.lower():
-                    files_list.append(os.path.join(dir_name, filename))
-        # case_label = files_list[0]
-        case_label = os.path.split(files_list[0])
-        case_label = case_label[0]
-        # dcm_meta_slice_list[0] = dicom.read_file(files_list[0])
-        dcm_meta_slice_list = []
-        for f in range(len(files_list)):
-            dcm_meta_slice_list.append(dicom.read_file(files_list[f]))
-        with open(params['input_req_json_path']) as d:
-            dicom_req = json.load(d)
-        print('processing', case_label)
-        # acqno_default = {acquisition_number: 1}
-        # case terminations (3)
-        if not hasattr(dcm_meta_slice_list[0], 'SOPClassUID'):
-            # print("SOPClassUID tag does not exist.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('SOPClassUID tag does not exist.')
-                continue
-        if not hasattr(dcm_meta_slice_list[0], 'AcquisitionNumber'):
-            # print('Warning: AcquisitionNumber tag does not exist.')
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append(
-                    'Warning: AcquisitionNumber tag does not exist.')
-                continue
-        if dcm_meta_slice_list[0].SOPClassUID not in dicom_req["DICOMRequirements"]['SOPClassUID']:
-            # print('Case does not meet SOPClassUID.')
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append(
-                    'Case does not meet SOPClassUID requirements. Input given: '
-                    + str(dcm_meta_slice_list[0].SOPClassUID))
-                continue
-        if hasattr(dcm_meta_slice_list[0], 'AcquisitionNumber'):
-            if dcm_meta_slice_list[0].AcquisitionNumber is None or dcm_meta_slice_list[0].AcquisitionNumber == "":
-                # print("Warning: AcquisitionNumber missing value.")
-                acquisition_number = 1
-                if case_label not in rejected_cases['rejected_cases_list']:
-                    rejected_cases['rejected_cases_list'][case_label] = []
-                    rejected_cases['rejected_cases_list'][case_label].append(
-                        'Warning: AcquisitionNumber missing value.')
-
-        # Check that scan is one single series
-        series_instance_uid_list = []
-        for r in range(len(dcm_meta_slice_list)):
-            series_instance_uid_list.append(dcm_meta_slice_list[r].SeriesInstanceUID)
-        series_instance_uid_list = list(set(series_instance_uid_list))
-
-        acquisition_number_list = []
-        # for r in range(len(dcm_meta_slice_list)):
-        #     acquisition_number_list.append(dcm_meta_slice_list[r].AcquisitionNumber)
-        for r in range(len(dcm_meta_slice_list)):
-            if dcm_meta_slice_list[r].AcquisitionNumber is None or dcm_meta_slice_list[r].AcquisitionNumber == "":
-                acquisition_number_list.append(acquisition_number)
-            else:
-                acquisition_number_list.append(dcm_meta_slice_list[r].AcquisitionNumber)
-
-        # acquisition_number_list = list(set(acquisition_number_list))
-        acquisition_number_list = [int(a) for a in acquisition_number_list]
-
-        unique_acq_list = list(set(acquisition_number_list))
-
-        min_acq = min(unique_acq_list)
-        dcm_meta_slice_list2 = []
-        for a in range(len(acquisition_number_list)):
-            if acquisition_number_list[a] == min_acq:
-                dcm_meta_slice_list2.append(dcm_meta_slice_list[a])
-        dcm_meta_slice_list = dcm_meta_slice_list2
-
-        if len(unique_acq_list) != 1:
-            # print("Case has multiple Acquisition Numbers")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append(
-                    'Warning: Case has multiple Acquisition Numbers. '
-                    + str(len(unique_acq_list))
-                    + ' Acquisition Numbers provided.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append(
-                    'Warning: Case has multiple Acquisition Numbers. '
-                    + str(len(unique_acq_list))
-                    + ' Acquisition Numbers provided.')
-        if len(series_instance_uid_list) != 1:
-            # print("Case has multiple series, single series required.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case has multiple series.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case has multiple series.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'KVP'):
-            # print("Case does not have kVP tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have kVP tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have kVP tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'Rows'):
-            # print("Case does not have Rows tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Rows tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Rows tag.')
-            continue
 
-        if not hasattr(dcm_meta_slice_list[0], 'Columns'):
-            # print("Case does not have Columns tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Columns tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Columns tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'ImagePositionPatient'):
-            # print("Case does not have IPP tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have IPP tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have IPP tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'ImageOrientationPatient'):
-            # print("Case does not have IOP tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have IOP tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have IOP tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'PixelSpacing'):
-            # print("Case does not have Pixel Spacing tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Pixel Spacing tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Pixel Spacing tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'ImageType'):
-            # print("Case does not have Image Type tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Image Type tag.')
-            else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Image Type tag.')
+def is_one_of(value, allowed):
+    return value in allowed
+
+
+def contains(value, required):
+    return required in value
+
+
+# an undefined (nan) measure fails; check_case leaves out the rules a case legitimately has no measure for
+def at_least(value, limit):
+    return value >= limit
+
+
+def at_most(value, limit):
+    return value <= limit
+
+
+# requirement key -> (case measure it is checked against, passes(measure, limit), message template).
+# Header rules only need the first slice and run before the series geometry is looked at.
+HEADER_RULES = collections.OrderedDict([
+    ('PatientPosition', ('PatientPosition', is_one_of,
+                         'Case does not meet Patient Position requirements. Input given: {value}')),
+    ('ImageType', ('ImageType', contains, 'Case does not meet Image Type requirements. Input given: {value}')),
+    ('ConvolutionKernel', ('ConvolutionKernel', contains,
+                           'Case does not meet Convolution Kernel requirements. Input given: {value}')),
+    ('Modality', ('Modality', is_one_of, 'Case does not meet Modality requirements. Input given: {value}')),
+])
+# SRS 609 and cerebral cta reqs, checked in the order they appear in the requirements file
+CASE_RULES = collections.OrderedDict([
+    ('MinKVP', ('KVP', at_least, 'KVP too low. Case provided kVP: {value}. Minimum kVP allowed: {limit}')),
+    ('MaxKVP', ('KVP', at_most, 'KVP too high. Case provided kVP: {value}. Maximum kVP allowed: {limit}')),
+    ('MinSliceThickness', ('SliceThickness', at_least,
+                           'Slice Thickness too low. Case provided Slice Thickness: {value}. '
+                           'Minimum Slice Thickness allowed: {limit}mm')),
+    ('MaxSliceThickness', ('SliceThickness', at_most,
+                           'Slice Thickness too large. Case provided Slice Thickness: {value}. '
+                           'Maximum Slice Thickness allowed: {limit}mm')),
+    ('MinRows', ('Rows', at_least, 'Rows too low. Case provided Rows: {value}. Minimum Rows allowed: {limit}')),
+    ('MaxRows', ('Rows', at_most, 'Rows too large. Case provided Rows: {value}. Maximum Rows allowed: {limit}')),
+    ('MinColumns', ('Columns', at_least,
+                    'Columns too low. Case provided Columns: {value}. Minimum Columns allowed: {limit}')),
+    ('MaxColumns', ('Columns', at_most,
+                    'Columns too large. Case provided Columns: {value}. Maximum Columns allowed: {limit}')),
+    ('MinXFOV', ('XFOV', at_least, 'XFOV too low. Case provided XFOV: {value}. Minimum XFOV allowed: {limit}mm')),
+    ('MaxXFOV', ('XFOV', at_most,
+                 'XFOV too large. Case provided XFOV: {value}. Maximum XFOV allowed: {limit}mm')),
+    ('MinYFOV', ('YFOV', at_least, 'YFOV too low. Case provided YFOV: {value}. Minimum YFOV allowed: {limit}mm')),
+    ('MaxYFOV', ('YFOV', at_most, 'YFOV too high. Case provided YFOV: {value}. Maximum YFOV allowed: {limit}mm')),
+    ('MinZFOV', ('ZFOV', at_least, 'ZFOV too low. Case provided ZFOV: {value}. Minimum allowed ZFOV: {limit}mm')),
+    ('MaxZFOV', ('ZFOV', at_most, 'ZFOV too high. Case provided ZFOV: {value}. Maximum allowed ZFOV: {limit}mm')),
+    ('MaxPixelSpacing', ('PixelSpacing', at_most,
+                         'Pixel Spacing too high. Case provided Pixel Spacing: {value}. '
+                         'Maximum allowed Pixel Spacing: {limit}mm')),
+    ('MaxGantryTilt', ('GantryTilt', at_most,
+                       'Gantry Tilt too large. Case provided Gantry Tilt: {value}. '
+                       'Maximum allowed Gantry Tilt: {limit} degrees')),
+])
+# optional checks of the pixel values, over every slice whose pixel data is uncompressed
+PIXEL_RULES = collections.OrderedDict([
+    ('MaxBlankSlices', ('BlankSlices', at_most,
+                        'Case has blank slices. Case provided blank slices: {value}. '
+                        'Maximum blank slices allowed: {limit}')),
+    ('MaxTruncatedSlices', ('TruncatedSlices', at_most,
+                            'Case has truncated pixel data. Case provided truncated slices: {value}. '
+                            'Maximum truncated slices allowed: {limit}')),
+    ('MinHU', ('MinHU', at_least, 'HU too low. Case provided minimum HU: {value}. Minimum HU allowed: {limit}')),
+    ('MaxHU', ('MaxHU', at_most, 'HU too high. Case provided maximum HU: {value}. Maximum HU allowed: {limit}')),
+])
+# requirement keys that need the pixel bytes; any of these adds memory-mapped pixel statistics to the slice reads
+PIXEL_REQUIREMENTS = list(PIXEL_RULES)
+REQUIREMENT_KEYS = ['SOPClassUID'] + list(HEADER_RULES) + list(CASE_RULES) + list(PIXEL_RULES)
+
+
+def compile_rule(key, limit, definition):
+    measure, check, template = definition
+    if check in (at_least, at_most):
+        if isinstance(limit, bool) or not isinstance(limit, (int, float)):
+            raise ValueError('Requirement %s must be a number, got %r' % (key, limit))
+    elif check is contains and not isinstance(limit, str):
+        raise ValueError('Requirement %s must be a string, got %r' % (key, limit))
+    return Rule(key, measure, limit, check, template.replace('{limit}', str(limit)))
+
+
+def compile_requirements(dicom_req):
+    # validates the SRS requirements once and turns them into Rule lists; raises ValueError on bad input
+    if not isinstance(dicom_req, dict) or not isinstance(dicom_req.get("DICOMRequirements"), dict):
+        raise ValueError('Requirements file has no "DICOMRequirements" object')
+    known_keys = dict((key.lower(), key) for key in REQUIREMENT_KEYS)
+    given = collections.OrderedDict()
+    unknown = []
+    for key, limit in dicom_req["DICOMRequirements"].items():
+        if key.lower() in known_keys:
+            given[known_keys[key.lower()]] = limit
+        else:
+            unknown.append(key)
+    if unknown:
+        hints = []
+        for key in unknown:
+            match = difflib.get_close_matches(key, REQUIREMENT_KEYS, n=1)
+            hints.append(key + (' (did you mean %s?)' % match[0] if match else ''))
+        raise ValueError('Unknown requirement keys: ' + ', '.join(hints))
+    if 'SOPClassUID' not in given:
+        raise ValueError('Requirement SOPClassUID is required')
+    sop_class_uids = given['SOPClassUID']
+    if isinstance(sop_class_uids, str):
+        sop_class_uids = [sop_class_uids]
+    header_rules = [compile_rule(key, given[key], HEADER_RULES[key]) for key in HEADER_RULES if key in given]
+    case_rules = [compile_rule(key, given[key], CASE_RULES[key]) for key in given if key in CASE_RULES]
+    pixel_rules = [compile_rule(key, given[key], PIXEL_RULES[key]) for key in given if key in PIXEL_RULES]
+    with_pixels = any(key in PIXEL_REQUIREMENTS for key in given)
+    tags = list(HEADER_TAGS) + (PIXEL_TAGS + [PIXEL_STATISTICS] if with_pixels else [])
+    return Requirements(sop_class_uids, header_rules, case_rules, tags, with_pixels, pixel_rules)
+
+
+def load_requirements(json_path):
+    with open(json_path) as d:
+        return compile_requirements(json.load(d))
+
+
+def as_requirements(source):
+    # compiled Requirements from a requirements file path, its parsed JSON, or Requirements
+    if isinstance(source, Requirements):
+        return source
+    if isinstance(source, dict):
+        return compile_requirements(source)
+    return load_requirements(source)
+
+
+def load_profiles(json_paths):
+    # OrderedDict(profile name: Requirements), named after the files (eg. head_ct.json -> head_ct); a ValueError
+    # from an invalid file names the file
+    profiles = collections.OrderedDict()
+    for json_path in json_paths:
+        name = os.path.splitext(os.path.basename(json_path))[0]
+        unique_name, n = name, 2
+        while unique_name in profiles:
+            unique_name, n = '%s_%d' % (name, n), n + 1
+        try:
+            profiles[unique_name] = load_requirements(json_path)
+        except ValueError as e:
+            raise ValueError('%s: %s' % (json_path, e))
+    return profiles
+
+
+def profile_tags(profiles):
+    # every tag any of the profiles reads, in first-seen order
+    tags = []
+    for requirements in profiles:
+        tags.extend(tag for tag in requirements.tags if tag not in tags)
+    return tags
+
+
+def format_measure(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+def evaluate_rules(rules, measures):
+    # messages for every rule the case measures fail
+    messages = []
+    for rule in rules:
+        value = measures[rule.measure]
+        if not rule.check(value, rule.limit):
+            messages.append(rule.message.replace('{value}', str(format_measure(value))))
+    return messages
+
+
+def dicom_tags(tags):
+    # `tags` without the pseudo tags that are not DICOM keywords
+    return [tag for tag in tags if tag not in PSEUDO_TAGS]
+
+
+def read_slice(path, tags=None, with_pixels=False):
+    # header-only by default: parsing stops before PixelData and skips tags not in `tags`.
+    # `path` can also be an archive member reference or a file object.
+    if isinstance(path, str) and split_member(path)[1] is not None:
+        with open_source(path) as f:
+            return read_slice(f, tags, with_pixels)
+    if with_pixels:
+        return dicom.dcmread(path)
+    return dicom.dcmread(path, stop_before_pixels=True, specific_tags=None if tags is None else dicom_tags(tags))
+
+
+def plain_value(value):
+    # pydicom values -> JSON-able python values (MultiValue -> list, DSfloat -> float, IS -> int, UID -> str)
+    if value is None:
+        return None
+    if isinstance(value, (list, MultiValue)):
+        return [plain_value(v) for v in value]
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def extract_header(ds, tags):
+    # only tags present in the file are kept, so hasattr() on the SliceHeader behaves like on the dataset
+    header = {}
+    for tag in dicom_tags(tags):
+        if tag in ds:
+            header[tag] = plain_value(ds[tag].value)
+    return header
+
+
+def pixel_statistics(frames, ds):
+    # per-slice summary of FrameStatistics kept in the slice header (and so in the metadata cache): blank and
+    # truncated frame counts and the HU range after RescaleSlope/RescaleIntercept; None when not checked
+    if frames is None:
+        return None
+    slope = float(ds.get('RescaleSlope') or 1)
+    intercept = float(ds.get('RescaleIntercept') or 0)
+    summary = dict(blank_frames=int(np.count_nonzero(frames.mins == frames.maxs)),
+                   truncated_frames=frames.frames - len(frames.mins), min_hu=None, max_hu=None)
+    if len(frames.mins):
+        ends = [float(frames.mins.min()) * slope + intercept, float(frames.maxs.max()) * slope + intercept]
+        summary['min_hu'], summary['max_hu'] = min(ends), max(ends)
+    return summary
+
+
+def read_pixel_header(path, tags):
+    # header fields plus the pseudo tags asked for from one open of the file: the header is parsed up to
+    # PixelData, whose value is then hashed through the same file object and/or reduced through a memory map;
+    # returns (header, bytes read)
+    if split_member(path)[1] is not None:
+        # archive members cannot be memory-mapped, their pixel values are reduced from the member's bytes
+        data = read_source(path)
+        return dataset_header(dicom.dcmread(io.BytesIO(data)), tags), len(data)
+    with open(path, 'rb') as fp:
+        element = locate_pixel_data(fp, dicom_tags(tags))
+        bytes_read = fp.tell()
+        header = extract_header(element.dataset, tags)
+        if PIXEL_DATA_HASH in tags:
+            header[PIXEL_DATA_HASH], hashed = hash_pixel_data(fp, element)
+            bytes_read += hashed
+    if PIXEL_STATISTICS in tags:
+        header[PIXEL_STATISTICS] = pixel_statistics(frame_statistics(path, element), element.dataset)
+        if header[PIXEL_STATISTICS] is not None and PIXEL_DATA_HASH not in tags:
+            bytes_read += element.length
+    return header, bytes_read
+
+
+def dataset_header(ds, tags):
+    # header fields of a dataset already in memory, with PixelStatistics from its PixelData bytes if asked for
+    header = extract_header(ds, tags)
+    if PIXEL_STATISTICS in tags:
+        frames = None
+        if 'PixelData' in ds and 'TransferSyntaxUID' in ds.get('file_meta', {}):
+            frames = frame_statistics(ds.PixelData, PixelDataElement(ds.file_meta.TransferSyntaxUID, None, None, ds))
+        header[PIXEL_STATISTICS] = pixel_statistics(frames, ds)
+    if PIXEL_DATA_HASH in tags:
+        header[PIXEL_DATA_HASH] = (hashlib.blake2b(ds.PixelData, digest_size=16).hexdigest()
+                                   if 'PixelData' in ds else None)
+    return header
+
+
+def read_slice_header(path, tags, cache=None, stats=None):
+    start = time.perf_counter() if stats is not None else None
+    header, bytes_read = None, 0
+    if cache is not None:
+        size, mtime_ns = source_stat(path)
+        header = cache.get(path, size, mtime_ns)
+        if header is not None and any(tag in tags and tag not in header for tag in PSEUDO_TAGS):
+            # cached by a read without the pixel pseudo tags asked for now, read again
+            header = None
+    cache_hit = header is not None
+    if header is None and any(tag in tags for tag in PSEUDO_TAGS):
+        header, bytes_read = read_pixel_header(path, tags)
+        if cache is not None:
+            cache.put(path, size, mtime_ns, header)
+    elif header is None:
+        if stats is None:
+            ds = read_slice(path, tags)
+        else:
+            # read through our own file object to see how far into the file parsing went
+            with open_source(path) as fp:
+                ds = read_slice(fp, tags)
+                bytes_read = fp.tell()
+        header = extract_header(ds, tags)
+        if cache is not None:
+            cache.put(path, size, mtime_ns, header)
+    if stats is not None:
+        stats.add(time.perf_counter() - start, bytes_read, cache_hit)
+    return SliceHeader(**header)
+
+
+class MetadataCache(object):
+    # per-file header fields in SQLite, keyed by absolute path and valid while size and mtime are unchanged.
+    # New entries are held in memory until commit() writes them in one short transaction, so pool workers
+    # sharing the file only hold its write lock while writing, not while reading a whole case.
+    def __init__(self, db_path, tags=HEADER_TAGS):
+        self.db_path = db_path
+        # prefetch threads share the connection, the lock serializes them
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS slices (path TEXT PRIMARY KEY, size INTEGER, '
+                                'mtime_ns INTEGER, header TEXT)')
+        # entries extracted with a different tag list are useless, start over
+        layout = json.dumps([CACHE_VERSION, list(tags)])
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'layout'").fetchone()
+        if row is None or row[0] != layout:
+            self.connection.execute('DELETE FROM slices')
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('layout', ?)", (layout,))
+        self.connection.commit()
+
+    def get(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, header FROM slices WHERE path = ?',
+                                          (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return json.loads(row[2])
+
+    def put(self, path, size, mtime_ns, header):
+        with self.lock:
+            self.pending.append((os.path.abspath(path), size, mtime_ns, json.dumps(header)))
+
+    def commit(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                with self.connection:
+                    self.connection.executemany('INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?)', pending)
+
+    def evict_missing(self, cases_path, existing_paths):
+        # drops entries under cases_path whose files were not found by this run's discovery; the members of an
+        # archive given as cases_path are keyed '<archive>::<member>', outside the directory prefix
+        prefixes = [os.path.join(os.path.abspath(cases_path), '')]
+        if is_archive(cases_path):
+            prefixes.append(os.path.abspath(cases_path) + MEMBER_SEPARATOR)
+        existing = set(os.path.abspath(p) for p in existing_paths)
+        missing = []
+        for prefix in prefixes:
+            rows = self.connection.execute('SELECT path FROM slices WHERE path >= ? AND path < ?',
+                                           (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+            missing.extend((path,) for (path,) in rows if path not in existing)
+        self.connection.executemany('DELETE FROM slices WHERE path = ?', missing)
+        self.connection.commit()
+        return len(missing)
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+# one cache connection per process, opened on first use so pool workers get their own
+_open_caches = {}
+
+
+def get_metadata_cache(db_path):
+    if db_path is None:
+        return None
+    # keyed by pid as well: a connection inherited through fork must not be reused
+    key = (os.getpid(), db_path)
+    if key not in _open_caches:
+        _open_caches[key] = MetadataCache(db_path)
+    return _open_caches[key]
+
+
+def load_case_index(index_path, cases_path):
+    # index saved by a previous run over the same tree, or {} if there is none
+    if index_path is None or not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        saved = json.load(f)
+    if saved.get('root') != cases_path:
+        return {}
+    return saved['dirs']
+
+
+def save_case_index(index_path, cases_path, dirs):
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'root': cases_path, 'dirs': dirs}, f)
+    os.replace(tmp_path, index_path)
+
+
+def list_case_files(dir_name):
+    with os.scandir(dir_name) as it:
+        return sorted(dir_entry.path for dir_entry in it
+                      if ".dcm" in dir_entry.name.lower() and not dir_entry.is_dir(follow_symlinks=False))
+
+
+def scan_case_dirs(cases_path, previous=None):
+    # single os.scandir pass over the tree, returns {directory: dict(mtime, files, subdirs)} for every directory.
+    # Directories whose mtime matches `previous` reuse their previous listing instead of being rescanned.
+    previous = previous or {}
+    dirs = {}
+    pending = [cases_path]
+    while pending:
+        dir_name = pending.pop()
+        try:
+            mtime = os.stat(dir_name).st_mtime_ns
+        except OSError:
             continue
-        # warnings
-        # if not hasattr(dcm_meta_slice_list[0], 'InstanceNumber'):
-        #     if case_label not in warning_cases['warning_cases_list']:
-        #         warning_cases['warning_cases_list'][case_label] = []
-        #         warning_cases['warning_cases_list'][case_label].append('Case does not have Instance Number tag.')
-        #     else:
-        #         warning_cases['warning_cases_list'][case_label].append('Case does not have Instance Number tag.')
-        #     continue
-
-        # print(x)
-        if "LOCALIZER" in dcm_meta_slice_list[0].ImageType:
-            # print("Case has incorrect Image Type. Provided Image Type:", dcm_meta_slice_list[0].ImageType,
-            #       " LOCALIZER, SCOUT, MIP not accepted.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: LOCALIZER.')
+        entry = previous.get(dir_name)
+        if entry is None or entry['mtime'] != mtime:
+            files, subdirs = [], []
+            with os.scandir(dir_name) as it:
+                for dir_entry in it:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        subdirs.append(dir_entry.path)
+                    elif ".dcm" in dir_entry.name.lower():
+                        files.append(dir_entry.path)
+            entry = dict(mtime=mtime, files=sorted(files), subdirs=sorted(subdirs))
+        dirs[dir_name] = entry
+        pending.extend(entry['subdirs'])
+    return dirs
+
+
+def discover_cases(cases_path, index_path=None):
+    # returns {case directory: sorted .dcm files directly inside it}, reusing the listings saved in the index
+    # file for directories whose mtime is unchanged. A zip/tar archive is listed from its own index (cases are
+    # its directories, files are member references), and media with a DICOMDIR from the DICOMDIR's records
+    # (cases are series); neither is extracted or walked.
+    if is_archive(cases_path):
+        return archive_cases(cases_path)
+    dicomdir = find_dicomdir(cases_path)
+    if dicomdir is not None:
+        return dicomdir_cases(dicomdir)
+    dirs = scan_case_dirs(cases_path, load_case_index(index_path, cases_path))
+    if index_path is not None:
+        save_case_index(index_path, cases_path, dirs)
+    return {dir_name: dirs[dir_name]['files'] for dir_name in sorted(dirs) if dirs[dir_name]['files']}
+
+
+# tags the series grouping reads, and the file it reports each grouped case's directories in
+GROUP_TAGS = ['SeriesInstanceUID', 'AcquisitionNumber']
+SERIES_INDEX_FILENAME = 'series_index.json'
+
+
+def read_group_keys(path, cache=None):
+    # (SeriesInstanceUID, AcquisitionNumber) of one file; (None, None) if the file cannot be read, a missing
+    # AcquisitionNumber counts as 1 like in scan_series. Without a metadata cache only those two tags are read;
+    # with one the file is read for every header tag and cached, so validation finds it there instead of
+    # parsing the file a second time
+    try:
+        if cache is not None:
+            header = vars(read_slice_header(path, HEADER_TAGS, cache))
+        else:
+            header = extract_header(read_slice(path, GROUP_TAGS), GROUP_TAGS)
+        acquisition_number = int(header.get('AcquisitionNumber') or 1)
+    except Exception:
+        return None, None
+    return header.get('SeriesInstanceUID'), acquisition_number
+
+
+def read_group_keys_batch(paths, cache_path=None):
+    # read_group_keys of a batch of files, committing what they added to the metadata cache once per batch
+    cache = get_metadata_cache(cache_path)
+    try:
+        return [read_group_keys(path, cache) for path in paths]
+    finally:
+        if cache is not None:
+            cache.commit()
+
+
+class SeriesIndex(object):
+    # file -> (series, acquisition) index for whole archives: directories and series UIDs are interned to ints
+    # and the per-file columns are arrays, so a file costs little more than its name
+    def __init__(self):
+        self.dirs, self.dir_ids = [], {}
+        self.series_uids, self.series_ids = [], {}
+        self.file_names = []
+        self.file_dirs = array('i')
+        self.file_series = array('i')
+        self.file_acquisitions = array('q')
+
+    def add(self, path, series_uid, acquisition_number):
+        dir_name, name = os.path.split(path)
+        dir_id = self.dir_ids.setdefault(dir_name, len(self.dirs))
+        if dir_id == len(self.dirs):
+            self.dirs.append(dir_name)
+        if series_uid is None:
+            # unreadable files, or files without the UID, stay grouped by their directory
+            series_id = -1 - dir_id
+            acquisition_number = 1
+        else:
+            series_id = self.series_ids.setdefault(series_uid, len(self.series_uids))
+            if series_id == len(self.series_uids):
+                self.series_uids.append(series_uid)
+        self.file_names.append(name)
+        self.file_dirs.append(dir_id)
+        self.file_series.append(series_id)
+        self.file_acquisitions.append(acquisition_number)
+
+    def path(self, i):
+        return os.path.join(self.dirs[self.file_dirs[i]], self.file_names[i])
+
+    def groups(self, by_acquisition=False):
+        # yields (case label, series UID, acquisition number or None, file indices in the order they were added)
+        # for every series (or series and acquisition) group
+        series = np.frombuffer(self.file_series, dtype=np.int32)
+        acquisitions = np.frombuffer(self.file_acquisitions, dtype=np.int64)
+        if not len(series):
+            return
+        if by_acquisition:
+            order = np.lexsort((acquisitions, series))
+            keys = np.stack([series[order], acquisitions[order]])
+            starts = np.flatnonzero(np.any(keys[:, 1:] != keys[:, :-1], axis=0)) + 1
+        else:
+            order = np.argsort(series, kind='stable')
+            starts = np.flatnonzero(series[order][1:] != series[order][:-1]) + 1
+        for group in np.split(order, starts):
+            series_id = int(series[group[0]])
+            if series_id < 0:
+                yield self.dirs[-1 - series_id], None, None, group
+                continue
+            series_uid = self.series_uids[series_id]
+            if by_acquisition:
+                acquisition_number = int(acquisitions[group[0]])
+                yield '%s#%d' % (series_uid, acquisition_number), series_uid, acquisition_number, group
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: LOCALIZER.')
-            continue
-        if "SCOUT" in dcm_meta_slice_list[0].ImageType:
-            # print("Case has incorrect Image Type. Provided Image Type:", dcm_meta_slice_list[0].ImageType,
-            #       " LOCALIZER, SCOUT, MIP not accepted.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: SCOUT.')
+                yield series_uid, series_uid, None, group
+
+
+# files per read_group_keys_batch call of the grouping pass
+GROUP_BATCH_SIZE = 256
+
+
+def map_group_keys(read_keys, paths, workers=1):
+    # read_keys of every path, in order, in batches of GROUP_BATCH_SIZE paths; on a process pool for workers > 1
+    batches = [paths[start:start + GROUP_BATCH_SIZE] for start in range(0, len(paths), GROUP_BATCH_SIZE)]
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            for batch_keys in pool.imap(read_keys, batches):
+                for keys in batch_keys:
+                    yield keys
+    else:
+        for batch in batches:
+            for keys in read_keys(batch):
+                yield keys
+
+
+def group_cases(case_index, by_acquisition=False, cache_path=None, workers=1):
+    # regroups {directory: files} by SeriesInstanceUID (and AcquisitionNumber), reading two tags per file, or
+    # every header tag into the metadata cache when there is one;
+    # returns ({case label: files}, {case label: dict(series_uid, acquisition_number, directories)}) sorted by label
+    paths = [path for files_list in case_index.values() for path in files_list]
+    read_keys = functools.partial(read_group_keys_batch, cache_path=cache_path)
+    index = SeriesIndex()
+    order = stream_order(paths)
+    if order is not None:
+        # members of a compressed tar are read in stored order, then indexed in case order as any other files
+        keys = [None] * len(paths)
+        for i, path_keys in zip(order, map_group_keys(read_keys, [paths[i] for i in order], workers)):
+            keys[i] = path_keys
+        for path, path_keys in zip(paths, keys):
+            index.add(path, *path_keys)
+    else:
+        for path, path_keys in zip(paths, map_group_keys(read_keys, paths, workers)):
+            index.add(path, *path_keys)
+    cases, series_map = {}, {}
+    for label, series_uid, acquisition_number, group in index.groups(by_acquisition):
+        cases[label] = [index.path(i) for i in group]
+        directories = collections.Counter(index.dirs[index.file_dirs[i]] for i in group)
+        series_map[label] = dict(series_uid=series_uid, acquisition_number=acquisition_number,
+                                 directories=dict(sorted(directories.items())))
+    labels = sorted(cases)
+    return ({label: cases[label] for label in labels}, {label: series_map[label] for label in labels})
+
+
+def write_series_map(output_dir, series_map):
+    # one JSON line per grouped case: its label, series UID, acquisition number and {directory: file count}
+    with open(os.path.join(output_dir, SERIES_INDEX_FILENAME), 'w') as f:
+        for label, entry in series_map.items():
+            f.write(json.dumps(dict(case=label, **entry)) + '\n')
+
+
+# relative deviation from the median spacing above which a gap counts as a missing or dual slice
+SLICE_SPACING_ERROR_MARGIN = 0.1
+# shortest row x column cross product taken as a slice normal; the IOP of a real series gives about 1
+MIN_NORMAL_LENGTH = 1e-3
+# case measures a --triage sample cannot vouch for when its slice positions are inconsistent
+SAMPLED_GEOMETRY_MEASURES = ['SliceThickness', 'ZFOV', 'GantryTilt']
+
+
+def batch_series_geometry(series_list, error_margin=SLICE_SPACING_ERROR_MARGIN):
+    # series_list: [(positions (N, 3), orientations (N, 6)), ...] with N >= 1 for every series.
+    # All series are evaluated together in flat arrays, for callers holding many series' positions at once;
+    # check_case streams case by case and goes through series_geometry, a batch of one. Slice positions are
+    # projected onto the slice normal (row x column direction of the first IOP), so tilted and non-axial series
+    # are sorted correctly.
+    # 'valid' is False for a series whose IOP has no usable normal (eg. all zeros) or whose IPPs are not all
+    # finite; its other values are meaningless.
+    lengths = np.array([len(positions) for positions, _ in series_list], dtype=np.intp)
+    series_ids = np.repeat(np.arange(len(series_list)), lengths)
+    positions = np.concatenate([np.asarray(p, dtype=float).reshape(-1, 3) for p, _ in series_list])
+    orientations = np.concatenate([np.asarray(o, dtype=float).reshape(-1, 6) for _, o in series_list])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    ends = starts + lengths - 1
+
+    first_orientations = orientations[starts]
+    normals = np.cross(first_orientations[:, :3], first_orientations[:, 3:])
+    norms = np.linalg.norm(normals, axis=1)
+    valid = (np.isfinite(norms) & (norms > MIN_NORMAL_LENGTH)
+             & np.logical_and.reduceat(np.isfinite(positions).all(axis=1), starts))
+    # invalid series get a placeholder normal so the arithmetic below stays finite
+    normals[~valid] = [0.0, 0.0, 1.0]
+    norms[~valid] = 1.0
+    normals /= norms[:, np.newaxis]
+    projections = np.einsum('ij,ij->i', np.nan_to_num(positions), normals[series_ids])
+
+    # sort slices along the normal within each series
+    order = np.lexsort((projections, series_ids))
+    sorted_projections = projections[order]
+    sorted_positions = positions[order]
+    zfov = sorted_projections[ends] - sorted_projections[starts]
+
+    # gaps between neighbouring slices of the same series
+    same_series = series_ids[1:] == series_ids[:-1]
+    gap_series = series_ids[:-1][same_series]
+    gaps = np.abs(np.diff(sorted_projections))[same_series]
+    gap_counts = lengths - 1
+    gap_starts = np.concatenate(([0], np.cumsum(gap_counts)[:-1]))
+
+    # per-series median spacing from the gaps sorted within each series
+    sorted_gaps = gaps[np.lexsort((gaps, gap_series))]
+    spacing = np.full(len(series_list), np.nan)
+    has_gaps = gap_counts > 0
+    lower = gap_starts[has_gaps] + (gap_counts[has_gaps] - 1) // 2
+    upper = gap_starts[has_gaps] + gap_counts[has_gaps] // 2
+    spacing[has_gaps] = (sorted_gaps[lower] + sorted_gaps[upper]) / 2
+
+    irregular = np.abs(gaps - spacing[gap_series]) > error_margin * spacing[gap_series]
+    irregular_index = np.arange(len(gaps)) - gap_starts[gap_series]
+
+    # angle between the slice normal and the direction the slices are stacked in
+    stacking = sorted_positions[ends] - sorted_positions[starts]
+    stacking_length = np.linalg.norm(stacking, axis=1)
+    cosine = np.abs(np.einsum('ij,ij->i', stacking, normals)) / np.where(stacking_length > 0, stacking_length, 1)
+    tilt = np.where(stacking_length > 0, np.degrees(np.arccos(np.clip(cosine, 0, 1))), 0.0)
+
+    # gaps are grouped by series, so each series' irregular slices are one run of the flagged gaps
+    if len(series_list) == 1:
+        irregular_slices = [irregular_index[irregular]]
+    else:
+        irregular_counts = np.bincount(gap_series[irregular], minlength=len(series_list))
+        irregular_slices = np.split(irregular_index[irregular], np.cumsum(irregular_counts)[:-1])
+    return [dict(slice_spacing=spacing[s], zfov=zfov[s], gantry_tilt=tilt[s], irregular_slices=irregular_slices[s],
+                 normal=normals[s], valid=bool(valid[s])) for s in range(len(series_list))]
+
+
+def series_geometry(positions, orientations, error_margin=SLICE_SPACING_ERROR_MARGIN):
+    return batch_series_geometry([(positions, orientations)], error_margin)[0]
+
+
+def sampled_geometry(positions, orientations, indices, error_margin=SLICE_SPACING_ERROR_MARGIN):
+    # series_geometry from a --triage sample taken at the file `indices` (first and last file included). An evenly
+    # spaced series in file name order puts the sampled positions along the slice normal on one line over the file
+    # index; the slice spacing is read off that line. 'consistent' is False when the sample is off the line by
+    # more than the spacing error margin, or too small to tell, and then spacing and irregular slices are unknown.
+    geometry = series_geometry(positions, orientations, error_margin)
+    projections = np.asarray(positions, dtype=float).reshape(-1, 3) @ geometry['normal']
+    indices = np.asarray(indices, dtype=float)
+    consistent = len(indices) >= 3 and indices[-1] > indices[0]
+    if consistent:
+        step = (projections[-1] - projections[0]) / (indices[-1] - indices[0])
+        residuals = projections - (projections[0] + step * (indices - indices[0]))
+        consistent = abs(step) > 0 and np.abs(residuals).max() <= error_margin * abs(step)
+    if consistent:
+        geometry.update(slice_spacing=abs(step), irregular_slices=np.array([], dtype=np.intp))
+    else:
+        geometry.update(slice_spacing=np.nan, irregular_slices=None)
+    geometry['consistent'] = bool(consistent)
+    return geometry
+
+
+def validate_case(case, requirements, cache_path=None, headers=None, profile=False, stats=None, verbose=True,
+                  instances=False):
+    # runs every check for one (case_path, files_list) pair, reading the slices itself unless an iterable of
+    # already read headers is given; returns a CaseResult, listing the case's instances if asked to
+    if profile and stats is None:
+        stats = ReadStats()
+    if instances:
+        if headers is None:
+            headers = iter_slice_headers(case[1], requirements.tags, get_metadata_cache(cache_path), stats)
+        headers = SharedHeaders(headers)
+    if not profile:
+        case_label, messages, status, measures = run_case(case, requirements, cache_path, headers, verbose=verbose)
+        result = CaseResult(case_label, messages, status, None, measures=measures)
+    else:
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        case_label, messages, status, measures = run_case(case, requirements, cache_path, headers, stats, verbose)
+        result = CaseResult(case_label, messages, status, stats.metrics(time.perf_counter() - start_wall,
+                                                                        time.process_time() - start_cpu),
+                            measures=measures)
+    if instances:
+        result = result._replace(instances=case_instances(case, headers, verbose))
+    return result
+
+
+def case_instances(case, headers, verbose=True):
+    # (SOPInstanceUID, PixelDataHash, path) of every slice of a case for the duplicate index; slices a check
+    # stopped before are read now. A slice that cannot be read ends the reading: it and the slices after it are
+    # listed without a UID, so the index counts them as not indexed
+    listed = []
+    slices = iter(headers)
+    for item in case[1]:
+        try:
+            header = next(slices)
+        except Exception as e:
+            unread = len(case[1]) - len(listed)
+            if verbose:
+                print(case[0], 'warning:', unread, 'slices not indexed for duplicates:', e)
+            listed.extend((None, None, rest if isinstance(rest, str) else None) for rest in case[1][len(listed):])
+            break
+        listed.append((getattr(header, 'SOPInstanceUID', None), getattr(header, PIXEL_DATA_HASH, None),
+                       item if isinstance(item, str) else None))
+    return listed
+
+
+def run_case(case, requirements, cache_path=None, headers=None, stats=None, verbose=True):
+    # An exception only fails its own case, the run carries on with the next one.
+    # A SampledCase (--triage) that passes every check its sample allows but whose sample looks inconsistent comes
+    # back 'flagged' for full validation; a rejected one keeps the triage note with its messages.
+    # Returns (case label, messages, status, case measures or None).
+    rejected_cases = {'rejected_cases_list': {}, 'flagged_cases_list': {}, 'case_measures': {}}
+    try:
+        case_label = check_case(case[0], case[1], requirements, rejected_cases, get_metadata_cache(cache_path),
+                                headers, stats, verbose, getattr(case, 'indices', None))
+    except Exception as e:
+        if verbose:
+            print(case[0], 'processing error:', file=sys.stderr)
+            traceback.print_exc()
+        return case[0], ['Case processing error: %s: %s' % (type(e).__name__, e)], 'error', None
+    messages = rejected_cases['rejected_cases_list'].get(case_label)
+    measures = rejected_cases['case_measures'].get(case_label)
+    flags = rejected_cases['flagged_cases_list'].get(case_label)
+    if flags is not None:
+        if messages is None:
+            return case_label, flags, 'flagged', measures
+        messages = messages + flags
+    return case_label, messages, 'accepted' if messages is None else 'rejected', measures
+
+
+class SharedHeaders(object):
+    # one read of a case's slice headers shared by several profiles: each iteration replays the headers read so
+    # far and only reads on when it gets past them, so a file is read once however many profiles look at it and
+    # a case every profile rejects early is still only partly read. A read error is raised to every profile.
+    def __init__(self, headers):
+        self.source = iter(headers)
+        self.headers = []
+        self.error = None
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self.headers):
+                yield self.headers[index]
+                index += 1
+            elif self.error is not None:
+                raise self.error
+            elif self.source is None:
+                return
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: SCOUT.')
-            continue
-        if "MIP" in dcm_meta_slice_list[0].ImageType:
-            # print("Case has incorrect Image Type. Provided Image Type:", dcm_meta_slice_list[0].ImageType,
-            #       " LOCALIZER, SCOUT, MIP not accepted.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: MIP.')
+                try:
+                    self.headers.append(next(self.source))
+                except StopIteration:
+                    self.source = None
+                except Exception as e:
+                    self.error = e
+
+
+def validate_profiles(case, profiles, cache_path=None, headers=None, profile=False, stats=None, verbose=True,
+                      instances=False):
+    # validate_case against every profile from a single read of the case's slices;
+    # returns OrderedDict(profile name: CaseResult), all carrying the metrics and instances of the whole case
+    if len(profiles) == 1:
+        name, requirements = next(iter(profiles.items()))
+        return collections.OrderedDict([(name, validate_case(case, requirements, cache_path, headers, profile, stats,
+                                                             verbose, instances))])
+    if profile and stats is None:
+        stats = ReadStats()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if headers is None:
+        headers = iter_slice_headers(case[1], profile_tags(profiles.values()), get_metadata_cache(cache_path), stats)
+    headers = SharedHeaders(headers)
+    results = collections.OrderedDict()
+    for name, requirements in profiles.items():
+        results[name] = validate_case(case, requirements, cache_path, headers, verbose=verbose)
+    if profile:
+        metrics = stats.metrics(time.perf_counter() - start_wall, time.process_time() - start_cpu)
+        for name, result in results.items():
+            results[name] = result._replace(metrics=metrics)
+    if instances:
+        listed = case_instances(case, headers, verbose)
+        for name, result in results.items():
+            results[name] = result._replace(instances=listed)
+    return results
+
+
+def add_rejections(rejected_cases, case_label, messages):
+    if messages:
+        rejected_cases['rejected_cases_list'].setdefault(case_label, []).extend(messages)
+
+
+def iter_slice_headers(files_list, tags, cache=None, stats=None):
+    # lazily reads one slice header at a time so a case that is rejected early never touches its other files.
+    # Members of a compressed tar are all read up front in the order they are stored instead: any read out of
+    # that order decompresses the archive again from its start.
+    order = stream_order(files_list)
+    if order is None:
+        for path in files_list:
+            yield read_slice_header(path, tags, cache, stats)
+        return
+    headers = [None] * len(files_list)
+    for i in order:
+        headers[i] = read_slice_header(files_list[i], tags, cache, stats)
+    for header in headers:
+        yield header
+
+
+# --triage reads the first, the last and every TRIAGE_STEP-th file of a case unless told another step
+TRIAGE_STEP = 10
+TRIAGE_DIRNAME = 'triage'
+# a case reduced to its --triage sample: `files` are the sampled files, `indices` their positions in the case
+SampledCase = collections.namedtuple('SampledCase', ['label', 'files', 'indices'])
+
+
+def sample_case(case, step=TRIAGE_STEP):
+    # SampledCase of a (case_path, files_list) pair in file name order, or the case itself when the sample would
+    # be every file or too small for sampled_geometry to vouch for (fewer than 3 files), which would only flag
+    # the case to be read again in full
+    count = len(case[1])
+    indices = sorted(set(range(0, count, step)) | {count - 1}) if count else []
+    if len(indices) == count or len(indices) < 3:
+        return case
+    return SampledCase(case[0], [case[1][i] for i in indices], indices)
+
+
+def prefetch_cases(cases, tags, cache=None, depth=4, threads=8, profile=False):
+    # yields (case, headers, ReadStats or None) in order while the slice headers of up to `depth` upcoming cases
+    # are read on a thread pool, so per-file latency on network storage overlaps with validation. `headers` yields
+    # each header as its read finishes and re-raises read errors there, inside the case's own error handling.
+    # Reads of a case that are still queued when the caller moves on (early rejection) are cancelled.
+    cases = iter(cases)
+    # compressed tar cases are read one after the other on their own thread, so the archive is read front to back
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as stream_executor:
+        pending = collections.deque()
+
+        def submit(case):
+            stats = ReadStats() if profile else None
+            if stream_order(case[1]) is not None:
+                # a compressed tar's members are read in one task, in stored order (see iter_slice_headers)
+                pending.append((case, stats, [stream_executor.submit(list, iter_slice_headers(case[1], tags, cache,
+                                                                                              stats))], True))
+                return
+            pending.append((case, stats, [executor.submit(read_slice_header, path, tags, cache, stats)
+                                          for path in case[1]], False))
+
+        for case in itertools.islice(cases, depth):
+            submit(case)
+        while pending:
+            case, stats, futures, whole_case = pending.popleft()
+            next_case = next(cases, None)
+            if next_case is not None:
+                submit(next_case)
+            if whole_case:
+                headers = (header for future in futures for header in future.result())
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case has incorrect Image Type: MIP.')
-            continue
+                headers = (future.result() for future in futures)
+            yield case, headers, stats
+            for future in futures:
+                future.cancel()
+
+
+def check_first_slice(first, requirements):
+    # stage 1: every check that only needs the first slice; returns (messages, terminated)
+    if not hasattr(first, 'SOPClassUID'):
+        return ['SOPClassUID tag does not exist.'], True
+    if not hasattr(first, 'AcquisitionNumber'):
+        return ['Warning: AcquisitionNumber tag does not exist.'], True
+    if first.SOPClassUID not in requirements.sop_class_uids:
+        return ['Case does not meet SOPClassUID requirements. Input given: ' + str(first.SOPClassUID)], True
+    messages = []
+    if first.AcquisitionNumber is None or first.AcquisitionNumber == "":
+        messages.append('Warning: AcquisitionNumber missing value.')
+    for tag, message in REQUIRED_SLICE_TAGS:
+        if not hasattr(first, tag):
+            return messages + [message], True
+    for image_type in REJECTED_IMAGE_TYPES:
+        if image_type in first.ImageType:
+            return messages + ['Case has incorrect Image Type: ' + image_type + '.'], True
+    # cerebral cta
+    for tag, message in REQUIRED_CTA_TAGS:
+        if not hasattr(first, tag):
+            return messages + [message], True
+    return messages, False
+
+
+def has_instance_number(header):
+    try:
+        int(getattr(header, 'InstanceNumber', None))
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+# series columns the pixel rules are measured from
+PIXEL_COLUMNS = ('blank_frames', 'truncated_frames', 'min_hu', 'max_hu')
+
+
+def scan_series(first, remaining, with_pixels=False):
+    # stage 2: streams over the slices keeping only the per-slice fields the series checks need,
+    # in columnar form, instead of the slice headers themselves
+    series_uids = set()
+    acquisition_numbers, positions, orientations, instance_numbers = [], [], [], []
+    # pixel statistics columns, nan for slices whose pixel data was not checked
+    pixel_columns = dict((key, []) for key in PIXEL_COLUMNS)
+    for header in itertools.chain([first], remaining):
+        if with_pixels:
+            statistics = getattr(header, PIXEL_STATISTICS, None) or {}
+            for key, column in pixel_columns.items():
+                value = statistics.get(key)
+                column.append(np.nan if value is None else value)
+        series_uids.add(header.SeriesInstanceUID)
+        acquisition_number = header.AcquisitionNumber
+        if acquisition_number is None or acquisition_number == "":
+            acquisition_number = 1
+        acquisition_numbers.append(int(acquisition_number))
+        positions.append(header.ImagePositionPatient)
+        orientations.append(header.ImageOrientationPatient)
+        instance_numbers.append(has_instance_number(header))
+    series = dict(series_uids=series_uids, acquisition_numbers=np.array(acquisition_numbers),
+                  positions=np.array(positions, dtype=float), orientations=np.array(orientations, dtype=float),
+                  instance_numbers=np.array(instance_numbers, dtype=bool))
+    for key, column in pixel_columns.items():
+        series[key] = np.array(column, dtype=float)
+    return series
 
-        # cerebral cta
-        if not hasattr(dcm_meta_slice_list[0], 'PatientPosition'):
-            # print("Case does not have PatientPosition tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Patient Position tag.')
+
+def pixel_measures(series):
+    # (case measures of the pixel rules, number of slices not checked); the HU range is nan when no slice could be
+    # checked, and check_case then leaves the HU rules out
+    checked = ~np.isnan(series['blank_frames'])
+    min_hu, max_hu = series['min_hu'], series['max_hu']
+    has_values = ~np.isnan(min_hu)
+    return dict(BlankSlices=int(series['blank_frames'][checked].sum()),
+                TruncatedSlices=int(series['truncated_frames'][checked].sum()),
+                MinHU=float(min_hu[has_values].min()) if has_values.any() else np.nan,
+                MaxHU=float(max_hu[has_values].max()) if has_values.any() else np.nan), int((~checked).sum())
+
+
+def check_case(case_path, files_list, requirements, rejected_cases, cache=None, headers=None, stats=None,
+               verbose=True, sample=None):
+    # `sample` holds the file indices of a --triage sample files_list was taken at: the geometry is then estimated
+    # by sampled_geometry, and a case it cannot vouch for is flagged instead of having its geometry rules decided
+    case_label = case_path
+    if verbose:
+        print('processing', case_label)
+    if headers is None:
+        slices = iter_slice_headers(files_list, requirements.tags, cache, stats)
+    else:
+        slices = iter(headers)
+    try:
+        first = next(slices, None)
+        if first is None:
+            raise ValueError('case has no slices')
+        messages, terminated = check_first_slice(first, requirements)
+        add_rejections(rejected_cases, case_label, messages)
+        if terminated:
+            return case_label
+        series = scan_series(first, slices, requirements.with_pixels)
+    finally:
+        if cache is not None:
+            cache.commit()
+
+    # only the lowest acquisition is checked for geometry
+    unique_acq_list = np.unique(series['acquisition_numbers'])
+    in_first_acquisition = series['acquisition_numbers'] == unique_acq_list[0]
+    if len(unique_acq_list) != 1:
+        add_rejections(rejected_cases, case_label, ['Warning: Case has multiple Acquisition Numbers. '
+                                                    + str(len(unique_acq_list)) + ' Acquisition Numbers provided.'])
+    # Check that scan is one single series
+    if len(series['series_uids']) != 1:
+        add_rejections(rejected_cases, case_label, ['Case has multiple series.'])
+        return case_label
+
+    header_measures = dict(PatientPosition=first.PatientPosition, ImageType=first.ImageType,
+                           ConvolutionKernel=first.ConvolutionKernel, Modality=first.Modality)
+    add_rejections(rejected_cases, case_label, evaluate_rules(requirements.header_rules, header_measures))
+    XFOV = round(first.PixelSpacing[1] * first.Rows, 2)
+    YFOV = round(first.PixelSpacing[0] * first.Columns, 2)
+    if sample is None:
+        geometry = series_geometry(series['positions'][in_first_acquisition],
+                                   series['orientations'][in_first_acquisition])
+    else:
+        geometry = sampled_geometry(series['positions'][in_first_acquisition],
+                                    series['orientations'][in_first_acquisition],
+                                    np.asarray(sample)[in_first_acquisition])
+    if not geometry['valid']:
+        add_rejections(rejected_cases, case_label, ['Case has invalid Image Orientation Patient or '
+                                                    'Image Position Patient.'])
+        return case_label
+    ZFOV = round(geometry['zfov'], 2)
+    case_rules = requirements.case_rules
+    if in_first_acquisition.sum() < 2:
+        # a single slice has no slice spacing
+        case_rules = [rule for rule in case_rules if rule.measure != 'SliceThickness']
+    if geometry.get('consistent', True):
+        missing_slices_str = ""
+        for i in geometry['irregular_slices']:
+            missing_slices_str = missing_slices_str + str(i) + "; "
+        if len(geometry['irregular_slices']) > 0:
+            add_rejections(rejected_cases, case_label, ['Case has missing_slices or dual slices.'
+                                                        + ' Missing slices number: ' + missing_slices_str])
+    else:
+        rejected_cases['flagged_cases_list'][case_label] = [
+            'Triage: sampled slice positions are not evenly spaced in file order, needs full validation.']
+        case_rules = [rule for rule in case_rules if rule.measure not in SAMPLED_GEOMETRY_MEASURES]
+    final_slice_spacing = geometry['slice_spacing']
+
+    for valid in series['instance_numbers'][in_first_acquisition]:
+        if not valid and verbose:
+            print(case_label, 'warning: missing instance number')
+
+    case_measures = dict(KVP=first.KVP, SliceThickness=final_slice_spacing,
+                         Rows=int(first.Rows), Columns=int(first.Columns),
+                         XFOV=XFOV, YFOV=YFOV, ZFOV=ZFOV, GantryTilt=geometry['gantry_tilt'],
+                         PixelSpacing=np.amax(first.PixelSpacing))
+    add_rejections(rejected_cases, case_label, evaluate_rules(case_rules, case_measures))
+    # like the geometry, the pixel measures cover the first acquisition only (and on a --triage sample only the
+    # sampled slices of it)
+    if requirements.pixel_rules:
+        measures, unchecked = pixel_measures({key: series[key][in_first_acquisition]
+                                              for key in PIXEL_COLUMNS})
+        if unchecked and verbose:
+            print(case_label, 'warning: pixel data of', unchecked, 'slices not checked (compressed or unsupported)')
+        pixel_rules = requirements.pixel_rules
+        if np.isnan(measures['MinHU']):
+            # no slice had checkable pixel values, there is no HU range to judge
+            pixel_rules = [rule for rule in pixel_rules if rule.measure not in ('MinHU', 'MaxHU')]
+        add_rejections(rejected_cases, case_label, evaluate_rules(pixel_rules, measures))
+        case_measures.update(measures)
+    rejected_cases.setdefault('case_measures', {})[case_label] = case_measures
+    return case_label
+
+
+# completed-case journal kept in the output directory for --resume
+JOURNAL_FILENAME = '.data_validator_journal'
+OUTPUT_KEYS = ['rejected_results_filename', 'accepted_results_filename', 'rejected_results_json',
+               'accepted_results_json']
+# extra outputs of --triage writers, for the cases left to full validation
+FLAGGED_OUTPUT_KEYS = ['flagged_results_filename', 'flagged_results_json']
+
+
+def read_journal(journal_path):
+    # {case_label: status} for every case up to the last completed flush, the output sizes at that flush, and the
+    # journal's own size up to that flush. Case lines after the last flush mark (or a torn last line) are ignored;
+    # those cases are simply redone, and the journal is cut back to the mark before it is appended to.
+    completed, offsets, journal_size = {}, None, 0
+    pending = {}
+    if not os.path.exists(journal_path):
+        return completed, offsets, journal_size
+    position = 0
+    with open(journal_path, 'rb') as f:
+        for line in f:
+            position += len(line)
+            if not line.endswith(b'\n'):
+                break
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if 'offsets' in entry:
+                completed.update(pending)
+                pending = {}
+                offsets, journal_size = entry['offsets'], position
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Patient Position tag.')
-            continue
-        if not hasattr(dcm_meta_slice_list[0], 'Modality'):
-            # print("Case does not have Modality tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Modality tag.')
+                pending[entry['case']] = entry['status']
+    return completed, offsets, journal_size
+
+
+class ResultWriter(object):
+    # streams each case's verdict to the accepted/rejected CSV and JSON Lines files as soon as it is decided,
+    # so an interrupted run still leaves every case decided before the last flush on disk.
+    # Each flush also appends the flushed cases and the output file sizes to the journal; with resume=True the
+    # outputs are cut back to the last journaled sizes and appended to, skipping the journaled cases.
+    # With flagged=True (--triage) the cases flagged for full validation get files of their own; they are neither
+    # accepted nor failed.
+    def __init__(self, params, resume=False, flush_every=FLUSH_EVERY, flagged=False):
+        output_dir = params['output_dir']
+        keys = OUTPUT_KEYS + FLAGGED_OUTPUT_KEYS if flagged else OUTPUT_KEYS
+        self.paths = dict((key, os.path.join(output_dir, params[key])) for key in keys)
+        self.journal_path = os.path.join(output_dir, JOURNAL_FILENAME)
+        self.completed, offsets, journal_size = read_journal(self.journal_path) if resume else ({}, None, 0)
+        mode = 'w'
+        if offsets is not None:
+            mode = 'a'
+            for key, path in self.paths.items():
+                with open(path, 'a') as f:
+                    f.truncate(offsets.get(key, 0))
+            # a torn last line would otherwise swallow the first entry appended after it
+            with open(self.journal_path, 'a') as f:
+                f.truncate(journal_size)
+        self.files = dict((key, open(path, mode, newline='')) for key, path in self.paths.items())
+        self.journal = open(self.journal_path, mode)
+        self.accepted_writer = csv.writer(self.files['accepted_results_filename'], delimiter=',')
+        self.flush_every = flush_every
+        self.unflushed = []
+        self.number_of_failed_cases = 0
+        self.number_of_errored_cases = 0
+        self.number_of_flagged_cases = 0
+        self.number_of_total_cases = 0
+        for status in self.completed.values():
+            self.count(status)
+
+    def count(self, status, step=1):
+        self.number_of_total_cases += step
+        if status == 'flagged':
+            self.number_of_flagged_cases += step
+        elif status != 'accepted':
+            self.number_of_failed_cases += step
+            if status == 'error':
+                self.number_of_errored_cases += step
+
+    def write(self, case_label, messages, status):
+        entry = {'case': case_label, 'status': status}
+        previous = self.completed.get(case_label)
+        if previous is not None:
+            # a later verdict on a case already written (a series --watch saw change) replaces the earlier one:
+            # its JSON entry names the status it supersedes and the counts only keep the latest verdict
+            entry['supersedes'] = previous
+            self.count(previous, -1)
+        if status == 'accepted':
+            self.accepted_writer.writerow([case_label])
+            self.files['accepted_results_json'].write(json.dumps(entry) + '\n')
+        elif status == 'flagged':
+            entry['messages'] = messages
+            self.files['flagged_results_filename'].write("%s, %s\n" % (case_label, messages))
+            self.files['flagged_results_json'].write(json.dumps(entry) + '\n')
+        else:
+            entry['messages'] = messages
+            self.files['rejected_results_filename'].write("%s, %s\n" % (case_label, messages))
+            self.files['rejected_results_json'].write(json.dumps(entry) + '\n')
+        self.completed[case_label] = status
+        self.count(status)
+        self.unflushed.append((case_label, status))
+        if len(self.unflushed) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # outputs first, then the journal, so the journal never lists a case whose verdict is not on disk
+        offsets = {}
+        for key, f in self.files.items():
+            f.flush()
+            offsets[key] = f.tell()
+        for case_label, status in self.unflushed:
+            self.journal.write(json.dumps({'case': case_label, 'status': status}) + '\n')
+        self.journal.write(json.dumps({'offsets': offsets}) + '\n')
+        self.journal.flush()
+        self.unflushed = []
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.journal.close()
+
+
+# case measures kept as columns of the results database, in requirements file order
+MEASURE_COLUMNS = list(collections.OrderedDict.fromkeys(
+    measure for rules in (CASE_RULES, PIXEL_RULES) for measure, _, _ in rules.values()))
+# (message prefix, code) for every rejection message; rule messages are coded by their requirement key
+REJECTION_CODES = ([(template.split('{value}')[0], key) for rules in (HEADER_RULES, CASE_RULES, PIXEL_RULES)
+                    for key, (_, _, template) in rules.items()]
+                   + [(message, 'Missing' + tag) for tag, message in REQUIRED_SLICE_TAGS + REQUIRED_CTA_TAGS]
+                   + [('SOPClassUID tag does not exist.', 'MissingSOPClassUID'),
+                      ('Warning: AcquisitionNumber tag does not exist.', 'MissingAcquisitionNumber'),
+                      ('Case does not meet SOPClassUID requirements.', 'SOPClassUID'),
+                      ('Warning: AcquisitionNumber missing value.', 'EmptyAcquisitionNumber'),
+                      ('Case has incorrect Image Type: ', 'RejectedImageType'),
+                      ('Warning: Case has multiple Acquisition Numbers.', 'MultipleAcquisitions'),
+                      ('Case has multiple series.', 'MultipleSeries'),
+                      ('Case has missing_slices or dual slices.', 'IrregularSlices'),
+                      ('Case has invalid Image Orientation Patient', 'InvalidGeometry'),
+                      ('Triage: ', 'TriageInconsistent'),
+                      ('Case processing error: ', 'ProcessingError')])
+RESULTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, profile TEXT, cases_path TEXT, mode TEXT,
+                                 started TEXT, finished TEXT, shard TEXT);
+CREATE TABLE IF NOT EXISTS cases (run_id INTEGER, case_key TEXT, status TEXT, %s,
+                                  PRIMARY KEY (run_id, case_key)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cases_status ON cases (run_id, status);
+CREATE TABLE IF NOT EXISTS rejections (run_id INTEGER, case_key TEXT, code TEXT, message TEXT);
+CREATE INDEX IF NOT EXISTS rejections_case ON rejections (run_id, case_key);
+CREATE INDEX IF NOT EXISTS rejections_code ON rejections (run_id, code);
+''' % ', '.join('%s REAL' % column for column in MEASURE_COLUMNS)
+# codes of a case's rejections, for listings
+CASE_CODES_SQL = ("(SELECT group_concat(code, ',') FROM rejections r "
+                  "WHERE r.run_id = %s.run_id AND r.case_key = %s.case_key)")
+
+
+def rejection_code(message):
+    for prefix, code in REJECTION_CODES:
+        if message.startswith(prefix):
+            return code
+    return 'Other'
+
+
+def case_key(case_label, cases_path):
+    # case label relative to the validated path, so runs over the same tree line up whatever it was called and
+    # with or without a trailing separator; labels outside the path (series UIDs) are kept as they are
+    root = cases_path.rstrip(os.sep) or cases_path
+    if case_label.startswith(root):
+        relative = case_label[len(root):]
+        if not relative or relative[0] in os.sep + ':' or root.endswith(os.sep):
+            return relative.lstrip(os.sep + ':') or '.'
+    return case_label
+
+
+def measure_value(value):
+    # float of a numeric case measure, None for anything else and for nan
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(value) else value
+
+
+def run_path(cases_path):
+    # cases path as runs record it: absolute, without a trailing separator, so 'tree' and 'tree/' are one tree
+    return None if cases_path is None else os.path.abspath(cases_path)
+
+
+def run_shard(shard):
+    # (K, N) -> 'K/N' as runs record it, None for an unsharded run
+    return None if shard is None else '%d/%d' % tuple(shard)
+
+
+class ResultsDatabase(object):
+    # --results_db: the verdicts of every run in SQLite, one run per requirements profile (and per --triage pass).
+    # Cases carry their status and measures, rejections a code per message (see REJECTION_CODES); the indexes
+    # make run-to-run diffs and per-rule queries lookups rather than scans of the result files.
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(RESULTS_SCHEMA)
+        if 'shard' not in [row[1] for row in self.connection.execute('PRAGMA table_info(runs)')]:
+            # databases written before runs recorded their shard
+            self.connection.execute('ALTER TABLE runs ADD COLUMN shard TEXT')
+        self.connection.commit()
+        self.resumed = set()
+        self.pending = 0
+
+    def start_run(self, profile, cases_path, mode='full', resume=False, shard=None):
+        # run id to record into; with resume the last run of the same profile, path and shard is continued, as the
+        # result files are
+        cases_path, shard = run_path(cases_path), run_shard(shard)
+        if resume:
+            row = self.connection.execute('SELECT run_id FROM runs WHERE profile = ? AND cases_path = ? AND mode = ? '
+                                          'AND shard IS ? ORDER BY run_id DESC LIMIT 1',
+                                          (profile, cases_path, mode, shard)).fetchone()
+            if row is not None:
+                self.connection.execute('UPDATE runs SET finished = NULL WHERE run_id = ?', row)
+                self.connection.commit()
+                self.resumed.add(row[0])
+                return row[0]
+        cursor = self.connection.execute('INSERT INTO runs (profile, cases_path, mode, shard, started) '
+                                         'VALUES (?, ?, ?, ?, ?)',
+                                         (profile, cases_path, mode, shard, time.strftime('%Y-%m-%dT%H:%M:%S')))
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def add(self, run_id, key, result):
+        if run_id in self.resumed:
+            self.connection.execute('DELETE FROM rejections WHERE run_id = ? AND case_key = ?', (run_id, key))
+        measures = result.measures or {}
+        self.connection.execute('INSERT OR REPLACE INTO cases (run_id, case_key, status, %s) VALUES (?, ?, ?, %s)'
+                                % (', '.join(MEASURE_COLUMNS), ', '.join('?' * len(MEASURE_COLUMNS))),
+                                [run_id, key, result.status]
+                                + [measure_value(measures.get(column)) for column in MEASURE_COLUMNS])
+        if result.status != 'accepted':
+            self.connection.executemany('INSERT INTO rejections VALUES (?, ?, ?, ?)',
+                                        [(run_id, key, rejection_code(message), message)
+                                         for message in result.messages or []])
+        self.pending += 1
+        if self.pending >= FLUSH_EVERY:
+            self.commit()
+
+    def finish_run(self, run_id):
+        self.connection.execute('UPDATE runs SET finished = ? WHERE run_id = ?',
+                                (time.strftime('%Y-%m-%dT%H:%M:%S'), run_id))
+        self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def runs(self):
+        # (run_id, profile, mode, shard, cases_path, started, finished, cases, failed cases) of every run
+        return self.connection.execute(
+            "SELECT run_id, profile, mode, shard, cases_path, started, finished, "
+            "(SELECT count(*) FROM cases c WHERE c.run_id = runs.run_id), "
+            "(SELECT count(*) FROM cases c WHERE c.run_id = runs.run_id AND c.status != 'accepted') "
+            "FROM runs ORDER BY run_id").fetchall()
+
+    def latest_run(self, profile=None, mode='full', cases_path=None, shard=None):
+        # id of the newest run, of the profile, cases path and shard given; None when there is none
+        sql, arguments = 'SELECT run_id FROM runs WHERE mode = ?', [mode]
+        for column, value in [('profile', profile), ('cases_path', run_path(cases_path)),
+                              ('shard', run_shard(shard))]:
+            if value is not None:
+                sql += ' AND %s = ?' % column
+                arguments.append(value)
+        row = self.connection.execute(sql + ' ORDER BY run_id DESC LIMIT 1', arguments).fetchone()
+        return None if row is None else row[0]
+
+    def previous_run(self, run_id):
+        # id of the run of the same profile, mode, cases path and shard before `run_id`, None when there is none
+        row = self.connection.execute('SELECT p.run_id FROM runs r JOIN runs p ON p.profile = r.profile '
+                                      'AND p.mode = r.mode AND p.cases_path IS r.cases_path AND p.shard IS r.shard '
+                                      'AND p.run_id < r.run_id WHERE r.run_id = ? '
+                                      'ORDER BY p.run_id DESC LIMIT 1', (run_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def has_run(self, run_id):
+        return self.connection.execute('SELECT 1 FROM runs WHERE run_id = ?', (run_id,)).fetchone() is not None
+
+    def diff(self, old_run, new_run, newly_failed=False):
+        # (case key, old status, new status, new rejection codes) of every case whose status changed between the
+        # runs, None for a case missing from a run; newly_failed keeps the cases accepted (or missing) before and
+        # not accepted now
+        changed = ('a.status IS NOT b.status' if not newly_failed else
+                   "b.status != 'accepted' AND (a.status IS NULL OR a.status = 'accepted')")
+        sql = ('SELECT b.case_key, a.status, b.status, %s FROM cases b '
+               'LEFT JOIN cases a ON a.run_id = ? AND a.case_key = b.case_key '
+               'WHERE b.run_id = ? AND %s' % (CASE_CODES_SQL % ('b', 'b'), changed))
+        arguments = [old_run, new_run]
+        if not newly_failed:
+            sql += (' UNION ALL SELECT a.case_key, a.status, NULL, NULL FROM cases a WHERE a.run_id = ? '
+                    'AND NOT EXISTS (SELECT 1 FROM cases b WHERE b.run_id = ? AND b.case_key = a.case_key)')
+            arguments += [old_run, new_run]
+        return self.connection.execute(sql + ' ORDER BY 1', arguments)
+
+    def query(self, run_id, status=None, code=None, case_glob=None, conditions=()):
+        # (case key, status, rejection codes) of the run's cases matching every filter given; conditions are
+        # (measure column, operator, value) triples
+        sql = 'SELECT c.case_key, c.status, %s FROM cases c WHERE c.run_id = ?' % (CASE_CODES_SQL % ('c', 'c'))
+        arguments = [run_id]
+        if status is not None:
+            sql += ' AND c.status = ?'
+            arguments.append(status)
+        if code is not None:
+            sql += ' AND c.case_key IN (SELECT case_key FROM rejections WHERE run_id = ? AND code = ?)'
+            arguments += [run_id, code]
+        if case_glob is not None:
+            sql += ' AND c.case_key GLOB ?'
+            arguments.append(case_glob)
+        for column, operator, value in conditions:
+            sql += ' AND c.%s %s ?' % (column, operator)
+            arguments.append(value)
+        return self.connection.execute(sql + ' ORDER BY c.case_key', arguments)
+
+    def counts(self, run_id, by='code'):
+        # (code or status, number of cases) of a run, most frequent first
+        if by == 'code':
+            sql = ('SELECT code, count(DISTINCT case_key) FROM rejections WHERE run_id = ? '
+                   'GROUP BY code ORDER BY 2 DESC, 1')
+        else:
+            sql = 'SELECT status, count(*) FROM cases WHERE run_id = ? GROUP BY status ORDER BY 2 DESC, 1'
+        return self.connection.execute(sql, (run_id,))
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def record_results(results_db, run_ids, case_results, cases_path):
+    # one case's results from MultiValidator into the run of each profile
+    for name, result in case_results.items():
+        results_db.add(run_ids[name], case_key(result.case, cases_path), result)
+
+
+class ReadStats(object):
+    # slice reads of one case, only collected with --profile; prefetch threads add to it concurrently
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_read = 0
+        self.cache_hits = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+
+    def add(self, seconds, bytes_read, cache_hit):
+        with self.lock:
+            self.read_seconds += seconds
+            if cache_hit:
+                self.cache_hits += 1
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Modality tag.')
+                self.files_read += 1
+                self.bytes_read += bytes_read
+
+    def metrics(self, wall, cpu):
+        return dict(wall=wall, cpu=cpu, read_wall=self.read_seconds, check_wall=max(wall - self.read_seconds, 0.0),
+                    files_read=self.files_read, cache_hits=self.cache_hits, bytes_read=self.bytes_read)
+
+
+class RunProfiler(object):
+    # per-stage wall/CPU time of the main process plus the per-case metrics returned by validate_case
+    def __init__(self, slowest_count=10):
+        self.stages = collections.OrderedDict()
+        self.slowest_count = slowest_count
+        self.slowest = []
+        self.totals = collections.OrderedDict((key, 0) for key in ['cases', 'files_read', 'cache_hits', 'bytes_read'])
+        # summed over cases, wherever they ran: slice reading vs everything else, and the cases' CPU time
+        self.case_stages = collections.OrderedDict([('read', 0.0), ('checks', 0.0), ('cpu', 0.0)])
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(name, dict(wall=0.0, cpu=0.0))
+            totals['wall'] += time.perf_counter() - start_wall
+            totals['cpu'] += time.process_time() - start_cpu
+
+    def record_case(self, case_label, metrics):
+        if metrics is None:
+            return
+        self.totals['cases'] += 1
+        for key in ['files_read', 'cache_hits', 'bytes_read']:
+            self.totals[key] += metrics[key]
+        self.case_stages['read'] += metrics['read_wall']
+        self.case_stages['checks'] += metrics['check_wall']
+        self.case_stages['cpu'] += metrics['cpu']
+        entry = (metrics['wall'], case_label, metrics)
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def report(self):
+        slowest = [dict(case=case_label, **metrics) for _, case_label, metrics in sorted(self.slowest, reverse=True)]
+        return dict(stages=self.stages, case_stages=self.case_stages, totals=self.totals, slowest_cases=slowest)
+
+    def write(self, metrics_path):
+        with open(metrics_path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+class NullProfiler(object):
+    # used when --profile is off, so the hot path pays for a no-op context manager and nothing else
+    _no_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._no_stage
+
+    def record_case(self, case_label, metrics):
+        pass
+
+
+class Validator(object):
+    # validation engine for embedding: built once from a requirements file (or its parsed JSON, or compiled
+    # Requirements) and reused for any number of series and trees, so pydicom/numpy imports, the requirements
+    # and the metadata cache connection stay warm. Nothing is written; results come back as CaseResults.
+    # The worker pool for workers > 1 is started on first use and kept until close().
+    # With instances=True every CaseResult lists its slices' (SOPInstanceUID, PixelDataHash, path) for a
+    # DuplicateIndex, the hash only with hash_pixels=True. With triage=k validate_cases only reads every k-th slice
+    # of a case (see sample_case) and a case the sample cannot decide comes back 'flagged'.
+    def __init__(self, requirements, metadata_cache=None, workers=1, prefetch=0, io_threads=8, profile=False,
+                 verbose=False, instances=False, hash_pixels=False, triage=None):
+        self.metadata_cache = metadata_cache
+        self.workers = workers
+        self.prefetch = prefetch
+        self.io_threads = io_threads
+        self.profile = profile
+        self.verbose = verbose
+        self.instances = instances
+        self.hash_pixels = hash_pixels
+        self.triage = triage
+        self.pool = None
+        self.load(requirements)
+
+    def compile(self, requirements):
+        requirements = as_requirements(requirements)
+        if self.hash_pixels and PIXEL_DATA_HASH not in requirements.tags:
+            requirements = requirements._replace(tags=requirements.tags + [PIXEL_DATA_HASH])
+        return requirements
+
+    def load(self, requirements):
+        self.requirements = self.compile(requirements)
+        self.tags = self.requirements.tags
+
+    def validate(self, case, headers=None, stats=None):
+        return validate_case(case, self.requirements, self.metadata_cache, headers, self.profile, stats,
+                             self.verbose, self.instances)
+
+    def pool_function(self):
+        return functools.partial(validate_case, requirements=self.requirements, cache_path=self.metadata_cache,
+                                 profile=self.profile, verbose=self.verbose, instances=self.instances)
+
+    def header(self, item, stats=None):
+        # SliceHeader of a path, pydicom Dataset or SliceHeader
+        if isinstance(item, SliceHeader):
+            return item
+        if isinstance(item, dicom.Dataset):
+            return SliceHeader(**dataset_header(item, self.tags))
+        return read_slice_header(item, self.tags, get_metadata_cache(self.metadata_cache), stats)
+
+    def validate_series(self, datasets_or_paths, label=None):
+        # one series given as slice file paths, already read pydicom Datasets, or a mix of both, in slice order
+        items = list(datasets_or_paths)
+        if not items:
+            raise ValueError('empty series')
+        if label is None:
+            label = os.path.dirname(items[0]) if items and isinstance(items[0], str) else 'series'
+        stats = ReadStats() if self.profile else None
+        headers = (self.header(item, stats) for item in items)
+        return self.validate((label, items), headers, stats)
+
+    def validate_cases(self, cases):
+        # CaseResults of (case_path, files_list) pairs, in the given order
+        if self.triage is not None:
+            cases = (sample_case(case, self.triage) for case in cases)
+        if self.workers > 1:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(processes=self.workers)
+            # imap yields results in case order, so the outputs are the same as the serial path
+            return self.pool.imap(self.pool_function(), cases)
+        if self.prefetch > 0:
+            prefetched = prefetch_cases(cases, self.tags, get_metadata_cache(self.metadata_cache),
+                                        self.prefetch, self.io_threads, self.profile)
+            return (self.validate(case, headers, stats) for case, headers, stats in prefetched)
+        return (self.validate(case) for case in cases)
+
+    def validate_tree(self, cases_path, case_index=None, group_by='directory'):
+        # generator of CaseResults, one per directory holding .dcm files under `cases_path`, or with group_by
+        # 'series' / 'acquisition' one per SeriesInstanceUID (and AcquisitionNumber) found under it
+        cases = discover_cases(cases_path, case_index)
+        if group_by != 'directory':
+            cases = group_cases(cases, group_by == 'acquisition', self.metadata_cache, self.workers)[0]
+        for result in self.validate_cases(list(cases.items())):
+            yield result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MultiValidator(Validator):
+    # Validator for several requirement profiles in one pass: each series is read once and evaluated against
+    # every profile, and results come back as OrderedDict(profile name: CaseResult).
+    # `profiles` maps profile names to anything Validator takes as requirements.
+    def load(self, profiles):
+        self.profiles = collections.OrderedDict((name, self.compile(requirements))
+                                                for name, requirements in profiles.items())
+        self.tags = profile_tags(self.profiles.values())
+
+    def validate(self, case, headers=None, stats=None):
+        return validate_profiles(case, self.profiles, self.metadata_cache, headers, self.profile, stats,
+                                 self.verbose, self.instances)
+
+    def pool_function(self):
+        return functools.partial(validate_profiles, profiles=self.profiles, cache_path=self.metadata_cache,
+                                 profile=self.profile, verbose=self.verbose, instances=self.instances)
+
+
+# per-shard output directories, and the manifest a shard writes once it has finished
+SHARD_DIRNAME = 'shard-%d-of-%d'
+SHARD_MANIFEST_FILENAME = 'shard_manifest.json'
+
+
+def parse_shard(spec):
+    # '--shard K/N' -> (K, N), shards numbered 1 to N
+    try:
+        shard, shards = [int(part) for part in spec.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be K/N, eg. 2/8')
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError('shard K/N needs 1 <= K <= N, got %s' % spec)
+    return shard, shards
+
+
+def shard_dir(output_dir, shard):
+    return os.path.join(output_dir, SHARD_DIRNAME % shard)
+
+
+def in_shard(case_label, cases_path, shard):
+    # stable across machines and runs: a hash of the case key (for --group_by series, the series UID), so every
+    # shard of the same tree agrees on the partition without talking to the others
+    digest = hashlib.blake2b(case_key(case_label, cases_path).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard[1] == shard[0] - 1
+
+
+def merge_shards(params, shard_dirs=None):
+    # combines the JSON Lines results of --shard runs into the usual outputs of output_dir, cases in label order
+    # like an unsharded run; returns (counts as analyze_cases returns them, list of problems found)
+    output_dir = params['output_dir']
+    if not shard_dirs:
+        shard_dirs = sorted(glob.glob(os.path.join(output_dir, SHARD_DIRNAME.replace('%d', '*'))))
+    problems, manifests = [], []
+    for directory in shard_dirs:
+        manifest_path = os.path.join(directory, SHARD_MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            problems.append('%s has no %s, the shard did not finish' % (directory, SHARD_MANIFEST_FILENAME))
             continue
-        if not hasattr(dcm_meta_slice_list[0], 'ConvolutionKernel'):
-            # print("Case does not have ConvolutionKernel tag.")
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Convolution Kernel tag.')
+        with open(manifest_path) as f:
+            manifests.append((directory, json.load(f)))
+    if not manifests:
+        return {}, problems + ['no finished shards found']
+    shard_counts = set(manifest['shards'] for _, manifest in manifests)
+    if len(shard_counts) > 1:
+        problems.append('shards of runs with different shard counts: %s' % sorted(shard_counts))
+    done = set(manifest['shard'] for _, manifest in manifests)
+    for shard_count in shard_counts:
+        missing = sorted(set(range(1, shard_count + 1)) - done)
+        if missing:
+            problems.append('missing shards of %d: %s' % (shard_count, ', '.join(str(shard) for shard in missing)))
+    # every shard discovers the whole tree: the cases of a complete set of shards must add up to what each of
+    # them found
+    totals = set(manifest.get('total_cases') for _, manifest in manifests)
+    if len(totals) > 1:
+        problems.append('shards discovered different numbers of cases: %s' % sorted(totals, key=str))
+    elif not problems:
+        total, = totals
+        sharded = sum(manifest['cases'] for _, manifest in manifests)
+        if total is not None and sharded != total:
+            problems.append('shards hold %d cases but %d were discovered' % (sharded, total))
+    profile_names = manifests[0][1]['profiles']
+    if any(manifest['profiles'] != profile_names for _, manifest in manifests):
+        problems.append('shards were run with different requirement profiles')
+    entries = dict((name, {}) for name in profile_names)
+    for directory, _ in manifests:
+        for name in profile_names:
+            profile_dir = directory if len(profile_names) == 1 else os.path.join(directory, name)
+            for key in ['rejected_results_json', 'accepted_results_json']:
+                with open(os.path.join(profile_dir, params[key])) as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        entries[name][entry['case']] = entry
+    series_map = {}
+    for directory, _ in manifests:
+        series_index_path = os.path.join(directory, SERIES_INDEX_FILENAME)
+        if os.path.exists(series_index_path):
+            with open(series_index_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    series_map[entry.pop('case')] = entry
+    if series_map:
+        write_series_map(output_dir, dict((label, series_map[label]) for label in sorted(series_map)))
+    writers = open_writers(dict(params, resume=False), profile_names)
+    try:
+        for name, profile_entries in entries.items():
+            for case_label in sorted(profile_entries):
+                entry = profile_entries[case_label]
+                writers[name].write(case_label, entry.get('messages'), entry['status'])
+    finally:
+        for writer in writers.values():
+            writer.close()
+    summaries = summarize_writers(writers)
+    if len(summaries) > 1:
+        with open(os.path.join(output_dir, 'profile_summary.json'), 'w') as f:
+            json.dump(summaries, f, indent=1)
+    indexed = [(directory, manifest['duplicates']) for directory, manifest in manifests if manifest.get('duplicates')]
+    if indexed:
+        if len(indexed) < len(manifests):
+            problems.append('only %d of %d shards were run with --duplicates' % (len(indexed), len(manifests)))
+        hash_pixels = all(duplicates['hash_pixels'] for _, duplicates in indexed)
+        if not hash_pixels and any(duplicates['hash_pixels'] for _, duplicates in indexed):
+            problems.append('only some shards were run with --duplicates_hash, the merged report has no hashes')
+        report_path = params.get('duplicates') or os.path.join(output_dir, DUPLICATE_REPORT_FILENAME)
+        index = DuplicateIndex(tempfile.mkdtemp(prefix='duplicates-', dir=output_dir), hash_pixels)
+        try:
+            for directory, duplicates in indexed:
+                index.add_shard(os.path.join(directory, DUPLICATE_RUNS_DIRNAME), duplicates)
+            counts = index.write(report_path)
+        finally:
+            index.close()
+        print('Instances indexed for duplicates: ', index.number_of_instances)
+        for kind, count in counts.items():
+            if count:
+                print('Duplicate groups (%s): ' % kind, count)
+        print('Duplicate instance report written to: ', report_path)
+    return (next(iter(summaries.values())) if len(summaries) == 1 else summaries), problems
+
+
+# rows kept in memory per sorted run of the duplicate index before they are spilled to disk
+DUPLICATE_RUN_SIZE = 500000
+# where a --shard run keeps its duplicate index runs for merge, and the merged report when merge is not given a path
+DUPLICATE_RUNS_DIRNAME = 'duplicate_runs'
+DUPLICATE_REPORT_FILENAME = 'duplicates.jsonl'
+DUPLICATE_KINDS = ['duplicate_uid', 'exact_duplicate', 'uid_conflict', 'content_duplicate']
+
+
+class SortedRuns(object):
+    # external sort of JSON-serializable rows: rows are buffered and spilled to `directory` as sorted JSON Lines
+    # runs of at most run_size rows, and iterating merges the runs, so memory is bounded by run_size
+    def __init__(self, directory, name, run_size=DUPLICATE_RUN_SIZE):
+        self.directory = directory
+        self.name = name
+        self.run_size = run_size
+        self.buffer = []
+        self.runs = []
+
+    def add(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def spill(self):
+        if not self.buffer:
+            return
+        run_path = os.path.join(self.directory, '%s-%d.jsonl' % (self.name, len(self.runs)))
+        self.buffer.sort()
+        with open(run_path, 'w') as f:
+            for row in self.buffer:
+                f.write(json.dumps(row) + '\n')
+        self.runs.append(run_path)
+        self.buffer = []
+
+    def __iter__(self):
+        self.spill()
+        files = [open(run_path) for run_path in self.runs]
+        try:
+            for row in heapq.merge(*[(json.loads(line) for line in f) for f in files]):
+                yield row
+        finally:
+            for f in files:
+                f.close()
+
+
+class DuplicateIndex(object):
+    # archive-wide index of the SOPInstanceUID, and with hash_pixels the PixelData hash, of every slice validated,
+    # fed the instances of each CaseResult. Rows live in sorted runs on disk, one ordered by UID and one by hash,
+    # so tens of millions of slices fit in bounded memory and report() is a single pass over each.
+    def __init__(self, directory, hash_pixels=False, run_size=DUPLICATE_RUN_SIZE):
+        self.directory = directory
+        self.hash_pixels = hash_pixels
+        self.by_uid = SortedRuns(directory, 'uid', run_size)
+        self.by_hash = SortedRuns(directory, 'hash', run_size) if hash_pixels else None
+        self.number_of_instances = 0
+        self.number_of_unindexed = 0
+
+    def add(self, instances):
+        for uid, pixel_hash, path in instances or []:
+            self.number_of_instances += 1
+            if uid:
+                self.by_uid.add([str(uid), pixel_hash or '', path or ''])
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case does not have Convolution Kernel tag.')
-            continue
+                self.number_of_unindexed += 1
+            if pixel_hash and self.by_hash is not None:
+                self.by_hash.add([pixel_hash, str(uid or ''), path or ''])
 
-        if "PatientPosition" in dicom_req["DICOMRequirements"]:
-            if dcm_meta_slice_list[0].PatientPosition not in dicom_req["DICOMRequirements"]['PatientPosition']:
-                # print('Case does not meet Patient Position requirements.')
-                if case_label not in rejected_cases['rejected_cases_list']:
-                    rejected_cases['rejected_cases_list'][case_label] = []
-                    rejected_cases['rejected_cases_list'][case_label].append(
-                        'Case does not meet Patient Position requirements. Input given: '
-                        + str(dcm_meta_slice_list[0].PatientPosition))
-        if "ImageType" in dicom_req["DICOMRequirements"]:
-            if dicom_req["DICOMRequirements"]['ImageType'] not in dcm_meta_slice_list[0].ImageType:
-                # print('Case does not meet Image Type requirements.')
-                if case_label not in rejected_cases['rejected_cases_list']:
-                    rejected_cases['rejected_cases_list'][case_label] = []
-                    rejected_cases['rejected_cases_list'][case_label].append(
-                        'Case does not meet Image Type requirements. Input given: '
-                        + str(dcm_meta_slice_list[0].ImageType))
-        if "ConvolutionKernel" in dicom_req["DICOMRequirements"]:
-            if dicom_req["DICOMRequirements"]['ConvolutionKernel'] not in dcm_meta_slice_list[0].ConvolutionKernel:
-                # print('Case does not meet Convolution Kernel requirements.')
-                if case_label not in rejected_cases['rejected_cases_list']:
-                    rejected_cases['rejected_cases_list'][case_label] = []
-                    rejected_cases['rejected_cases_list'][case_label].append(
-                        'Case does not meet Convolution Kernel requirements. Input given: '
-                        + str(dcm_meta_slice_list[0].ConvolutionKernel))
-        if "Modality" in dicom_req["DICOMRequirements"]:
-            if dcm_meta_slice_list[0].Modality not in dicom_req["DICOMRequirements"]['Modality']:
-                # print('Case does not meet Modality requirements.')
-                if case_label not in rejected_cases['rejected_cases_list']:
-                    rejected_cases['rejected_cases_list'][case_label] = []
-                    rejected_cases['rejected_cases_list'][case_label].append(
-                        'Case does not meet Modality requirements. Input given: '
-                        + str(dcm_meta_slice_list[0].Modality))
-        XFOV = round(dcm_meta_slice_list[0].PixelSpacing[1] * dcm_meta_slice_list[0].Rows, 2)
-        YFOV = round(dcm_meta_slice_list[0].PixelSpacing[0] * dcm_meta_slice_list[0].Columns, 2)
-        slice_position_list = []
-        for r in range(len(dcm_meta_slice_list)):
-            slice_position_list.append(float(dcm_meta_slice_list[r].ImagePositionPatient[2]))
-        slice_position_list = np.asarray(slice_position_list)
-        ZFOV = round(np.amax(slice_position_list) - np.amin(slice_position_list), 2)
-        slice_spacing_list = np.abs(np.diff(np.sort(slice_position_list)))
-        # list of spacing [1.25 repeated]
-        reference_slice_spacing = np.median(slice_spacing_list)
-        error_margin = 0.1
-        missing_slices = np.where(np.abs(slice_spacing_list - reference_slice_spacing) >
-                                  error_margin * reference_slice_spacing)
-        # slice_spacing_list = np.round(slice_spacing_list, 2)
-        # slice_spacing, counts = np.unique(slice_spacing_list, return_counts=True)
-        # slice_spacing_mode = slice_spacing[np.argmax(counts)]
-        missing_slices_str = ""
-        # missing_slices = np.where(slice_spacing_list != slice_spacing_mode)
-        for i in range(len(missing_slices[0])):
-            missing_slices_str = missing_slices_str + str(missing_slices[0][i]) + "; "
-        # if len(slice_spacing) > 1:
-        if len(missing_slices[0]) > 0:
-            if case_label not in rejected_cases['rejected_cases_list']:
-                rejected_cases['rejected_cases_list'][case_label] = []
-                rejected_cases['rejected_cases_list'][case_label].append('Case has missing_slices or dual slices.'
-                                                                         + ' Missing slices number: ' +
-                                                                         missing_slices_str)
+    def report(self):
+        # one dict per duplicate group: instances sharing a UID are 'duplicate_uid' without hashes, else
+        # 'exact_duplicate' when their pixel data match and 'uid_conflict' when it differs; instances with
+        # different UIDs but the same pixel data are 'content_duplicate'
+        for uid, group in itertools.groupby(self.by_uid, key=lambda row: row[0]):
+            rows = list(group)
+            if len(rows) < 2:
+                continue
+            if not self.hash_pixels:
+                kind = 'duplicate_uid'
+            elif len(set(row[1] for row in rows)) == 1:
+                kind = 'exact_duplicate'
             else:
-                rejected_cases['rejected_cases_list'][case_label].append('Case has missing_slices or dual slices.'
-                                                                         + ' Missing slices number: ' +
-                                                                         missing_slices_str)
-        final_slice_spacing = reference_slice_spacing
-
-        # print(len(dcm_meta_slice_list))
-        for slice_index in range(len(dcm_meta_slice_list)):
-            x = dcm_meta_slice_list[slice_index].InstanceNumber
-            try:
-                test = int(x)
-            except:
-                print(case_label, 'warning: missing instance number')
-
-        # slice count will just be the length of the number of slices, you can do this with dcm_meta_slice_list
-        slice_count = len(dcm_meta_slice_list)
-        # ZFOV = round(slice_count * final_slice_spacing, 2)
-
-        for key in dicom_req["DICOMRequirements"]:
-            # SRS 609
-            if key.lower() == "MinKVP".lower():
-                if dcm_meta_slice_list[0].KVP < dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "KVP too low. Case provided kVP: " + str(
-                                round(dcm_meta_slice_list[0].KVP, 2)) + " Minimum kVP allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinKVP']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "KVP too low. Case provided kVP: " + str(
-                                round(dcm_meta_slice_list[0].KVP, 2)) + "." + " Minimum kVP allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinKVP']))
-            if key.lower() == "MaxKVP".lower():
-                if dcm_meta_slice_list[0].KVP > dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "KVP too high. Case provided kVP: " + "." + str(round(dcm_meta_slice_list[0].KVP, 2)) +
-                            " Maximum kVP allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxKVP']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "KVP too high. Case provided kVP: " + str(round(dcm_meta_slice_list[0].KVP, 2)) + "." +
-                            " Maximum kVP allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxKVP']))
-            if key.lower() == "MinSliceThickness".lower():
-                if final_slice_spacing < dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Slice Thickness too low. Case provided Slice Thickness: " +
-                            str(round(final_slice_spacing, 2)) + "." +
-                            " Minimum Slice Thickness allowed: " + str(dicom_req["DICOMRequirements"]
-                                                                       ['MinSliceThickness']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Slice Thickness too low. Case provided Slice Thickness: " +
-                            str(round(final_slice_spacing, 2)) + "." +
-                            " Minimum Slice Thickness allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinSliceThickness']) + "mm")
-            if key.lower() == "MaxSliceThickness".lower():
-                if final_slice_spacing > dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Slice Thickness too large. Case provided Slice Thickness: " +
-                            str(round(final_slice_spacing, 2)) + "." +
-                            " Maximum Slice Thickness allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxSliceThickness']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Slice Thickness too large. Case provided Slice Thickness: " +
-                            str(round(final_slice_spacing, 2)) + "." +
-                            " Maximum Slice Thickness allowed: " + str(
-                                dicom_req["DICOMRequirements"]['MaxSliceThickness']))
-            if key.lower() == "MinRows".lower():
-                if int(dcm_meta_slice_list[0].Rows) < dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Rows too low. Case provided Rows: " + str(
-                                dcm_meta_slice_list[0].Rows) + "." + " Minimum Rows allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinRows']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Rows too low. Case provided Rows: " + str(
-                                dcm_meta_slice_list[0].Rows) + "." + " Minimum Rows allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinRows']))
-            if key.lower() == "MaxRows".lower():
-                if int(dcm_meta_slice_list[0].Rows) > dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Rows too large. Case provided Rows: " + str(
-                                dcm_meta_slice_list[0].Rows) + "." + " Maximum Rows allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxRows']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Rows too large. Case provided Rows: " + str(
-                                dcm_meta_slice_list[0].Rows) + "." + " Maximum Rows allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxRows']))
-            if key.lower() == "MinColumns".lower():
-                if int(dcm_meta_slice_list[0].Columns) < dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Columns too low. Case provided Columns: " + str(dcm_meta_slice_list[0].Columns) +
-                            " Minimum Columns allowed:" + str(dicom_req["DICOMRequirements"]['MinColumns']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Columns too low. Case provided Columns: " + str(dcm_meta_slice_list[0].Columns) + "." +
-                            " Minimum Columns allowed: " + str(dicom_req["DICOMRequirements"]['MinColumns']))
-            if key.lower() == "MaxColumns".lower():
-                if int(dcm_meta_slice_list[0].Columns) > dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Columns too large. Case provided Columns: " + str(dcm_meta_slice_list[0].Columns) + "." +
-                            " Maximum Columns allowed: " + str(dicom_req["DICOMRequirements"]['MaxColumns']))
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Columns too large. Case provided Columns: " + str(dcm_meta_slice_list[0].Columns) + "." +
-                            " Maximum Columns allowed: " + str(dicom_req["DICOMRequirements"]['MaxColumns']))
-            if key.lower() == "MinXFOV".lower():
-                if XFOV < dicom_req["DICOMRequirements"]['MinXFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "XFOV too low. Case provided XFOV: " + str(XFOV) + "." + " Minimum XFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinXFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "XFOV too low. Case provided XFOV: " + str(XFOV) + "." + " Minimum XFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinXFOV']) + "mm")
-            if key.lower() == "MaxXFOV".lower():
-                if XFOV > dicom_req["DICOMRequirements"]['MaxXFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "XFOV too large. Case provided XFOV: " + str(XFOV) + "." + " Maximum XFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxXFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "XFOV too large. Case provided XFOV: " + str(XFOV) + "." + " Maximum XFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxXFOV']) + "mm")
-            if key.lower() == "MinYFOV".lower():
-                if YFOV < dicom_req["DICOMRequirements"]['MinYFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "YFOV too low. Case provided YFOV: " + str(YFOV) + "." + " Minimum YFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinYFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "YFOV too low. Case provided YFOV: " + str(YFOV) + "." + " Minimum YFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MinYFOV']) + "mm")
-            if key.lower() == "MaxYFOV".lower():
-                if YFOV > dicom_req["DICOMRequirements"]['MaxYFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "YFOV too high. Case provided YFOV: " + str(YFOV) + "." + " Maximum YFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxYFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "YFOV too high. Case provided YFOV: " + str(YFOV) + "." + " Maximum YFOV allowed: " +
-                            str(dicom_req["DICOMRequirements"]['MaxYFOV']) + "mm")
-            if key.lower() == "MinZFOV".lower():
-                if ZFOV < dicom_req["DICOMRequirements"]['MinZFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "ZFOV too low. Case provided ZFOV: " + str(ZFOV) + "." + " Minimum allowed ZFOV: " +
-                            str(dicom_req["DICOMRequirements"]['MinZFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "ZFOV too low. Case provided ZFOV: " + str(ZFOV) + "." + " Minimum allowed ZFOV: " +
-                            str(dicom_req["DICOMRequirements"]['MinZFOV']) + "mm")
-            if key.lower() == "MaxZFOV".lower():
-                if ZFOV > dicom_req["DICOMRequirements"]['MaxZFOV']:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "ZFOV too high. Case provided ZFOV: " + str('ZFOV') + "." + " Maximum allowed ZFOV: " +
-                            str(dicom_req["DICOMRequirements"]['MaxZFOV']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "ZFOV too high. Case provided ZFOV: " + str(ZFOV) + "." + " Maximum allowed ZFOV: " +
-                            str(dicom_req["DICOMRequirements"]['MaxZFOV']) + "mm")
-
-            # cerebral cta reqs
-            if key.lower() == "MaxPixelSpacing".lower():
-                max_pixel_spacing = np.amax(dcm_meta_slice_list[0].PixelSpacing)
-                if max_pixel_spacing > dicom_req["DICOMRequirements"][key]:
-                    if case_label not in rejected_cases['rejected_cases_list']:
-                        rejected_cases['rejected_cases_list'][case_label] = []
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "Pixel Spacing too high. Case provided Pixel Spacing: " + str('MaxPixelSpacing') + "." +
-                            " Maximum allowed Pixel Spacing: " +
-                            str(dicom_req["DICOMRequirements"]['MaxPixelSpacing']) + "mm")
-                    else:
-                        rejected_cases['rejected_cases_list'][case_label].append(
-                            "PixelSpacing too high. Case provided PixelSpacing: " + str('MaxPixelSpacing') + "." +
-                            " Maximum allowed PixelSpacing: " + str(dicom_req["DICOMRequirements"]['MaxPixelSpacing']) +
-                            "mm")
-
-    # rejected_cases['number_of_failed_cases'] = (len(rejected_cases['rejected_cases_list'][case_label]))
-    # number_failed = rejected_cases['rejected_cases_list']
-    rejected_cases['number_of_failed_cases'] = len(rejected_cases['rejected_cases_list'])
-    print('Number of failed cases: ', rejected_cases['number_of_failed_cases'])
-    # rejected_cases['number_of_failed_cases'] = (len(number_failed.keys()))
-    rejected_cases['number_of_total_cases'] = (len(cases_list))
-    print('Total number of cases processed: ', rejected_cases['number_of_total_cases'])
-
-    f = open('accepted_cases_summary.csv', 'w')
-    for case_label in cases_list:
-        if case_label not in rejected_cases['rejected_cases_list']:
-            rows = [case_label]
-            writer = csv.writer(f, delimiter=',')
-            writer.writerow([x.split(',') for x in rows])
-    f.close()
-
-    with open(os.path.join(params['output_dir'], params['rejected_results_filename']), "w") as p:
-        for key in rejected_cases['rejected_cases_list'].keys():
-            p.write("%s, %s\n" % (key, rejected_cases['rejected_cases_list'][key]))
-    p.close()
+                kind = 'uid_conflict'
+            yield duplicate_entry(kind, 'sop_instance_uid', uid, [(row[0], row[1], row[2]) for row in rows])
+        if self.by_hash is None:
+            return
+        for pixel_hash, group in itertools.groupby(self.by_hash, key=lambda row: row[0]):
+            rows = list(group)
+            if len(set(row[1] for row in rows)) > 1:
+                yield duplicate_entry('content_duplicate', 'pixel_data_hash', pixel_hash,
+                                      [(row[1], row[0], row[2]) for row in rows])
 
+    def write(self, report_path):
+        # JSON Lines report; returns OrderedDict(kind: number of groups)
+        counts = collections.OrderedDict((kind, 0) for kind in DUPLICATE_KINDS)
+        with open(report_path, 'w') as f:
+            for entry in self.report():
+                counts[entry['kind']] += 1
+                f.write(json.dumps(entry) + '\n')
+        return counts
 
-def main() -> int:
-    return_code = 0
-    parser = argparse.ArgumentParser(description="Rapid Data Validator")
-    parser.add_argument('-sr', '--srs_req_json_path', help=
-                        "input file path for SRS Requirements JSON file, eg. \'/Users/name/foldername/filename.json\'",
-                        type=str, required=False, action="store", dest="input_req_json_path",
-                        default=DEFAULTS["input_req_json_path"])
-    parser.add_argument('-dc', '--dcm_case_path', help=
-                        "input file path for dicom cases, eg. \'/Users/name/foldername\'",
-                        type=str, required=False, action="store", dest="path_to_dicoms",
-                        default=DEFAULTS["path_to_dicoms"])
-    parser.add_argument('-od', '--output_directory', help=
-                        "output directory path to export csv results, eg. \'/Users/name/foldername/filename.csv\'",
-                        type=str, required=False, action="store", dest="output_dir",
-                        default=DEFAULTS["output_dir"])
+    def manifest(self):
+        # what a shard keeps of its index for merge: the counts and its sorted runs, relative to the directory
+        for runs in [self.by_uid, self.by_hash]:
+            if runs is not None:
+                runs.spill()
+        return dict(hash_pixels=self.hash_pixels, instances=self.number_of_instances,
+                    unindexed=self.number_of_unindexed,
+                    uid=[os.path.basename(path) for path in self.by_uid.runs],
+                    hash=[os.path.basename(path) for path in self.by_hash.runs] if self.by_hash is not None else [])
+
+    def add_shard(self, directory, manifest):
+        # merges in the sorted runs a shard kept in `directory`; their rows are already sorted, nothing is re-read
+        self.number_of_instances += manifest['instances']
+        self.number_of_unindexed += manifest['unindexed']
+        self.by_uid.runs.extend(os.path.join(directory, name) for name in manifest['uid'])
+        if self.by_hash is not None:
+            self.by_hash.runs.extend(os.path.join(directory, name) for name in manifest['hash'])
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def duplicate_entry(kind, key_name, key, rows):
+    return collections.OrderedDict([('kind', kind), (key_name, key), ('instances', [
+        collections.OrderedDict([('sop_instance_uid', uid or None), ('pixel_data_hash', pixel_hash or None),
+                                 ('path', path or None)]) for uid, pixel_hash, path in rows])])
+
+
+def open_writers(params, profile_names, flagged=False):
+    # OrderedDict(profile name: ResultWriter); a single profile writes straight into output_dir, several write
+    # into one subdirectory per profile
+    if len(profile_names) == 1:
+        return collections.OrderedDict([(profile_names[0], ResultWriter(params, params['resume'],
+                                                                        params['flush_every'], flagged))])
+    writers = collections.OrderedDict()
+    for name in profile_names:
+        output_dir = os.path.join(params['output_dir'], name)
+        os.makedirs(output_dir, exist_ok=True)
+        writers[name] = ResultWriter(dict(params, output_dir=output_dir), params['resume'], params['flush_every'],
+                                     flagged)
+    return writers
+
+
+def write_results(writers, results):
+    # results of one case from MultiValidator; a profile that already has the case (--resume) is left alone
+    for name, result in results.items():
+        if result.case not in writers[name].completed:
+            writers[name].write(result.case, result.messages, result.status)
+
+
+def is_completed(writers, case_label):
+    return all(case_label in writer.completed for writer in writers.values())
+
+
+def summarize_writers(writers):
+    # OrderedDict(profile name: counts) as printed at the end of a run
+    summaries = collections.OrderedDict()
+    for name, writer in writers.items():
+        if len(writers) > 1:
+            print('Profile', name)
+        summary = summaries[name] = {}
+        summary['number_of_failed_cases'] = writer.number_of_failed_cases
+        print('Number of failed cases: ', summary['number_of_failed_cases'])
+        summary['number_of_errored_cases'] = writer.number_of_errored_cases
+        if summary['number_of_errored_cases']:
+            print('Number of cases with processing errors: ', summary['number_of_errored_cases'])
+        if writer.number_of_flagged_cases:
+            summary['number_of_flagged_cases'] = writer.number_of_flagged_cases
+            print('Number of cases flagged for full validation: ', summary['number_of_flagged_cases'])
+        summary['number_of_total_cases'] = writer.number_of_total_cases
+        print('Total number of cases processed: ', summary['number_of_total_cases'])
+    return summaries
+
+
+def resolve_profiles(params, profiles=None):
+    # profiles given, else loaded from input_req_json_path (one path or a list of them); a bare Requirements
+    # counts as one profile
+    if profiles is None:
+        json_paths = params['input_req_json_path']
+        profiles = load_profiles([json_paths] if isinstance(json_paths, str) else json_paths)
+    elif isinstance(profiles, Requirements):
+        profiles = collections.OrderedDict([('requirements', profiles)])
+    return profiles
+
+
+def triage_cases(params, profiles, cases, case_index, triage_writers, writers, profiler, results_db=None):
+    # --triage pass: every case validated from its sample into triage_writers; returns the cases that need a full
+    # validation, those flagged now or by the run being resumed that have no full verdict yet
+    if results_db is not None:
+        run_ids = collections.OrderedDict((name, results_db.start_run(name, params['path_to_dicoms'], 'triage',
+                                                                      params['resume'], params['shard']))
+                                          for name in profiles)
+    validator = MultiValidator(profiles, params['metadata_cache'], params['workers'], params['prefetch'],
+                               params['io_threads'], params['profile'] is not None, verbose=True,
+                               triage=params['triage'])
+    flagged = set(case_label for writer in triage_writers.values()
+                  for case_label, status in writer.completed.items() if status == 'flagged')
+    try:
+        with profiler.stage('triage'):
+            for case_results in tqdm(validator.validate_cases(cases), total=len(cases)):
+                first = next(iter(case_results.values()))
+                profiler.record_case(first.case, first.metrics)
+                if any(result.status == 'flagged' for result in case_results.values()):
+                    flagged.add(first.case)
+                with profiler.stage('output'):
+                    write_results(triage_writers, case_results)
+                    if results_db is not None:
+                        record_results(results_db, run_ids, case_results, params['path_to_dicoms'])
+    finally:
+        validator.close()
+    if results_db is not None:
+        for run_id in run_ids.values():
+            results_db.finish_run(run_id)
+    print('Cases flagged by triage for full validation: ', len(flagged))
+    return [case for case in case_index.items() if case[0] in flagged and not is_completed(writers, case[0])]
+
+
+def analyze_cases(params, profiles=None):
+    # command line run: every case under path_to_dicoms through a MultiValidator, verdicts streamed to the output
+    # files of each profile. Returns the counts of the profile, or OrderedDict(profile name: counts) for several.
+    profiles = resolve_profiles(params, profiles)
+    cases_path = params['path_to_dicoms']
+    profiler = RunProfiler(params['profile_slowest']) if params['profile'] is not None else NullProfiler()
+    profile = params['profile'] is not None
+    if params['shard'] is not None:
+        params = dict(params, output_dir=shard_dir(params['output_dir'], params['shard']))
+        os.makedirs(params['output_dir'], exist_ok=True)
+
+    with profiler.stage('discovery'):
+        discovered = case_index = discover_cases(cases_path, params['case_index'])
+    if params['group_by'] != 'directory':
+        with profiler.stage('grouping'):
+            case_index, series_map = group_cases(case_index, params['group_by'] == 'acquisition',
+                                                 params['metadata_cache'], params['workers'])
+        print('Series found: ', len(case_index))
+    total_cases = len(case_index)
+    if params['shard'] is not None:
+        case_index = dict((label, files_list) for label, files_list in case_index.items()
+                          if in_shard(label, cases_path, params['shard']))
+        print('Shard %d/%d cases: ' % params['shard'], len(case_index))
+    if params['group_by'] != 'directory':
+        write_series_map(params['output_dir'], dict((label, series_map[label]) for label in case_index))
+    writers = open_writers(params, list(profiles))
+    triage_writers = None
+    if params['triage'] is not None:
+        # triage verdicts of every case go to their own directory, the output directory gets the full verdicts
+        # of the cases triage flagged
+        triage_params = dict(params, output_dir=os.path.join(params['output_dir'], TRIAGE_DIRNAME))
+        os.makedirs(triage_params['output_dir'], exist_ok=True)
+        triage_writers = open_writers(triage_params, list(profiles), flagged=True)
+    cases = [case for case in case_index.items() if not is_completed(triage_writers or writers, case[0])]
+    if len(cases) < len(case_index):
+        print('Resuming, cases already done: ', len(case_index) - len(cases))
+    results_db = None
+    if params['results_db'] is not None:
+        results_db = ResultsDatabase(params['results_db'])
+        run_ids = collections.OrderedDict((name, results_db.start_run(name, cases_path, 'full', params['resume'],
+                                                                      params['shard']))
+                                          for name in profiles)
+    duplicates = None
+    if params['duplicates'] is not None:
+        if params['shard'] is None:
+            duplicates_dir = tempfile.mkdtemp(prefix='duplicates-', dir=params['output_dir'])
+        else:
+            # kept for merge, which combines the runs of every shard into one report
+            duplicates_dir = os.path.join(params['output_dir'], DUPLICATE_RUNS_DIRNAME)
+            shutil.rmtree(duplicates_dir, ignore_errors=True)
+            os.makedirs(duplicates_dir)
+        duplicates = DuplicateIndex(duplicates_dir, params['duplicates_hash'])
+    validator = MultiValidator(profiles, params['metadata_cache'], params['workers'], params['prefetch'],
+                               params['io_threads'], profile, verbose=True, instances=duplicates is not None,
+                               hash_pixels=params['duplicates_hash'])
+    hot_path = cProfile.Profile() if params['cprofile'] is not None else None
+    try:
+        if hot_path is not None:
+            hot_path.enable()
+        if triage_writers is not None:
+            cases = triage_cases(params, profiles, cases, case_index, triage_writers, writers, profiler, results_db)
+        results = validator.validate_cases(cases)
+        with profiler.stage('validation'):
+            for case_results in tqdm(results, total=len(cases)):
+                first = next(iter(case_results.values()))
+                profiler.record_case(first.case, first.metrics)
+                if duplicates is not None:
+                    duplicates.add(first.instances)
+                with profiler.stage('output'):
+                    write_results(writers, case_results)
+                    if results_db is not None:
+                        record_results(results_db, run_ids, case_results, cases_path)
+        if results_db is not None:
+            for run_id in run_ids.values():
+                results_db.finish_run(run_id)
+            print('Results recorded in %s as run %s' % (params['results_db'],
+                                                       ', '.join(str(run_id) for run_id in run_ids.values())))
+        if duplicates is not None:
+            with profiler.stage('duplicates'):
+                counts = duplicates.write(params['duplicates'])
+            print('Instances indexed for duplicates: ', duplicates.number_of_instances)
+            if duplicates.number_of_unindexed:
+                print('Instances without a readable SOPInstanceUID: ', duplicates.number_of_unindexed)
+            for kind, count in counts.items():
+                if count:
+                    print('Duplicate groups (%s): ' % kind, count)
+            print('Duplicate instance report written to: ', params['duplicates'])
+    finally:
+        if hot_path is not None:
+            hot_path.disable()
+            hot_path.dump_stats(params['cprofile'])
+        validator.close()
+        if duplicates is not None and params['shard'] is None:
+            duplicates.close()
+        if results_db is not None:
+            results_db.close()
+        with profiler.stage('output'):
+            for writer in list(writers.values()) + list((triage_writers or {}).values()):
+                writer.close()
+    if params['metadata_cache'] is not None:
+        evicted = get_metadata_cache(params['metadata_cache']).evict_missing(
+            cases_path, [path for files_list in discovered.values() for path in files_list])
+        print('Metadata cache entries evicted: ', evicted)
+
+    if triage_writers is not None:
+        print('Triage:')
+        triage_summaries = summarize_writers(triage_writers)
+        with open(os.path.join(params['output_dir'], TRIAGE_DIRNAME, 'triage_summary.json'), 'w') as f:
+            json.dump(triage_summaries, f, indent=1)
+        print('Full validation of flagged cases:')
+    summaries = summarize_writers(writers)
+    if len(summaries) > 1:
+        with open(os.path.join(params['output_dir'], 'profile_summary.json'), 'w') as f:
+            json.dump(summaries, f, indent=1)
+    if params['shard'] is not None:
+        # written last: a shard without its manifest did not finish
+        with open(os.path.join(params['output_dir'], SHARD_MANIFEST_FILENAME), 'w') as f:
+            json.dump(dict(shard=params['shard'][0], shards=params['shard'][1], profiles=list(profiles),
+                           cases=len(case_index), total_cases=total_cases, summaries=summaries,
+                           duplicates=duplicates.manifest() if duplicates is not None else None), f, indent=1)
+    if profile:
+        profiler.write(params['profile'])
+        print('Profile metrics written to: ', params['profile'])
+    if len(summaries) == 1:
+        return next(iter(summaries.values()))
+    return summaries
+
+
+# Linux inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher(object):
+    # rescans the tree every poll with the same mtime-keyed listing reuse as discover_cases, so only
+    # directories whose mtime moved are listed again
+    def __init__(self, cases_path):
+        self.cases_path = cases_path
+        self.dirs = scan_case_dirs(cases_path)
+
+    def case_dirs(self):
+        return [dir_name for dir_name, entry in self.dirs.items() if entry['files']]
+
+    def changed_dirs(self, timeout):
+        time.sleep(timeout)
+        previous = self.dirs
+        self.dirs = scan_case_dirs(self.cases_path, previous)
+        return set(dir_name for dir_name, entry in self.dirs.items()
+                   if dir_name not in previous or previous[dir_name]['mtime'] != entry['mtime'])
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+    # one inotify watch per directory of the tree; changed_dirs() returns the directories that had events,
+    # without touching the rest of the tree
+    def __init__(self, cases_path):
+        PollingWatcher.__init__(self, cases_path)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        for dir_name in self.dirs:
+            self.add_watch(dir_name)
+
+    def add_watch(self, dir_name):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_name), WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = dir_name
+
+    def changed_dirs(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return set()
+        changed, new_dirs = set(), []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + name_length].rstrip(b'\0')
+            offset += INOTIFY_EVENT.size + name_length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, fall back to one full rescan
+                changed = PollingWatcher.changed_dirs(self, 0) | set(self.case_dirs())
+                watched = set(self.watches.values())
+                for dir_name in self.dirs:
+                    if dir_name not in watched:
+                        self.add_watch(dir_name)
+                return changed
+            dir_name = self.watches.get(wd)
+            if dir_name is None:
+                continue
+            changed.add(dir_name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_dirs.append(os.path.join(dir_name, os.fsdecode(name)))
+        for new_dir in new_dirs:
+            # files may land in a new directory before its watch exists, so its whole subtree counts as changed
+            for sub_dir, _, _ in os.walk(new_dir):
+                self.add_watch(sub_dir)
+                changed.add(sub_dir)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(cases_path, poll=False):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(cases_path)
+        except (OSError, AttributeError, TypeError) as e:
+            print('inotify unavailable, polling instead:', e)
+    return PollingWatcher(cases_path)
+
+
+def case_signature(dir_name):
+    # (files, (name, size, mtime) of each) of a case directory; a series has stopped growing once this is stable
+    files = list_case_files(dir_name)
+    stats = []
+    for path in files:
+        stat = os.stat(path)
+        stats.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+    return files, tuple(stats)
+
+
+def stop_on_sigterm(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def watch_cases(params, profiles=None):
+    # daemon mode: validates each series once it has stopped changing for `settle` seconds, and again whenever
+    # it changes later, appending each verdict to the outputs as soon as it is decided. Requirements, the metadata
+    # cache and the process stay warm between series. Runs until interrupted (Ctrl-C or SIGTERM).
+    profiles = resolve_profiles(params, profiles)
+    cases_path = params['path_to_dicoms']
+    settle = params['settle']
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    watcher = make_watcher(cases_path, params['poll'])
+    # a daemon restart always appends to the verdicts it wrote before, --resume or not
+    writers = open_writers(dict(params, resume=True), list(profiles))
+    validator = MultiValidator(profiles, params['metadata_cache'], verbose=True)
+    # validated signature of each case, and (signature, time it was last seen changing) of unsettled ones
+    validated = {}
+    pending = dict((dir_name, None) for dir_name in watcher.case_dirs())
+    print('Watching', cases_path, 'with', type(watcher).__name__)
+    try:
+        while True:
+            for dir_name in watcher.changed_dirs(params['poll_interval']):
+                pending[dir_name] = None
+            now = time.monotonic()
+            for dir_name in sorted(pending):
+                try:
+                    files, signature = case_signature(dir_name)
+                except OSError:
+                    # removed, or a file vanished while we looked; try again on the next event or poll
+                    pending[dir_name] = None
+                    if not os.path.isdir(dir_name):
+                        del pending[dir_name]
+                    continue
+                last = pending[dir_name]
+                if dir_name not in validated and is_completed(writers, dir_name):
+                    # decided by the run being resumed
+                    validated[dir_name] = signature
+                if last is None or last[0] != signature:
+                    pending[dir_name] = (signature, now)
+                    continue
+                if now - last[1] < settle:
+                    continue
+                del pending[dir_name]
+                if not files or validated.get(dir_name) == signature:
+                    continue
+                validated[dir_name] = signature
+                for case_results in validator.validate_cases([(dir_name, files)]):
+                    for name, result in case_results.items():
+                        writers[name].write(result.case, result.messages, result.status)
+                        print('verdict', result.case, name, result.status)
+                for writer in writers.values():
+                    writer.flush()
+    except KeyboardInterrupt:
+        print('Stopping watch')
+    finally:
+        validator.close()
+        watcher.close()
+        for writer in writers.values():
+            writer.close()
+    return summarize_writers(writers)
+
+
+def add_output_arguments(parser):
+    # result file names, shared by runs and merge
     parser.add_argument('-rf', '--rejected_results_filename', help=
                         "(optional) name of rejected results file csv, eg. \'/Users/name/foldername/filename.csv\'",
                         type=str, required=False, action="store", dest="rejected_results_filename",
@@ -568,6 +2322,249 @@ def main() -> int:
                         "(optional) name of accepted results file json, eg. \'/Users/name/foldername/filename.json\'",
                         type=str, required=False, action="store", dest="accepted_results_json",
                         default=DEFAULTS["accepted_results_json"])
+    parser.add_argument('-ff', '--flagged_results_filename', help=
+                        "(optional) name of the --triage flagged results file csv, eg. \'filename.csv\'",
+                        type=str, required=False, action="store", dest="flagged_results_filename",
+                        default=DEFAULTS["flagged_results_filename"])
+    parser.add_argument('-fj', '--flagged_results_json', help=
+                        "(optional) name of the --triage flagged results file json, eg. \'filename.json\'",
+                        type=str, required=False, action="store", dest="flagged_results_json",
+                        default=DEFAULTS["flagged_results_json"])
+
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser(prog='data_validator.py merge',
+                                     description="Merge the results of --shard runs into one set of result files")
+    parser.add_argument('shard_dirs', nargs='*', help=
+                        "shard output directories, by default every shard-K-of-N directory in the output directory")
+    parser.add_argument('-od', '--output_directory', help=
+                        "output directory for the merged results, eg. \'/Users/name/foldername\'",
+                        type=str, required=True, action="store", dest="output_dir")
+    add_output_arguments(parser)
+    parser.add_argument('--duplicates', help=
+                        "(optional) path of the duplicate instance report combined from shards run with --duplicates, "
+                        "by default " + DUPLICATE_REPORT_FILENAME + " in the output directory",
+                        type=str, required=False, action="store", dest="duplicates", default=DEFAULTS["duplicates"])
+    params = dict(DEFAULTS, **vars(parser.parse_args(argv)))
+    if not os.path.exists(params['output_dir']):
+        print(RETURN_CODES['nonexistent_path'])
+        return RETURN_CODES['nonexistent_path'][0]
+    _, problems = merge_shards(params, params.pop('shard_dirs'))
+    for problem in problems:
+        print('warning:', problem)
+    if problems:
+        return RETURN_CODES['incomplete_shards'][0]
+    return RETURN_CODES['no_error'][0]
+
+
+def measure_condition(text):
+    # '--where ZFOV<100' -> ('ZFOV', '<', 100.0)
+    for operator in ['<=', '>=', '!=', '<', '>', '=']:
+        column, separator, value = text.partition(operator)
+        if separator:
+            break
+    else:
+        raise argparse.ArgumentTypeError('condition must be MEASURE<op>VALUE, eg. ZFOV<100, got %s' % text)
+    column = column.strip()
+    if column not in MEASURE_COLUMNS:
+        raise argparse.ArgumentTypeError('unknown measure %s, one of %s' % (column, ', '.join(MEASURE_COLUMNS)))
+    try:
+        return column, operator, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('condition value must be a number, got %s' % value)
+
+
+def diff_main(argv):
+    parser = argparse.ArgumentParser(prog='data_validator.py diff',
+                                     description="Cases whose verdict changed between two runs of a --results_db")
+    parser.add_argument('results_db', help="results database written by --results_db")
+    parser.add_argument('--from', help=
+                        "older run id, by default the run before --to of the same profile, path and shard",
+                        type=int, dest="old_run", default=None)
+    parser.add_argument('--to', help="newer run id, by default the latest run", type=int, dest="new_run",
+                        default=None)
+    parser.add_argument('--profile', help="profile the default runs are taken from, by default the latest run's",
+                        default=None)
+    parser.add_argument('--path', help="cases path the default runs are taken from", dest="cases_path", default=None)
+    parser.add_argument('--shard', help="shard K/N the default runs are taken from", type=parse_shard, default=None)
+    parser.add_argument('--newly_failed', help="only cases accepted (or absent) before and not accepted now",
+                        action="store_true", default=False)
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.results_db):
+        print(RETURN_CODES['nonexistent_path'])
+        return RETURN_CODES['nonexistent_path'][0]
+    results_db = ResultsDatabase(args.results_db)
+    try:
+        if args.new_run is None:
+            args.new_run = results_db.latest_run(args.profile, cases_path=args.cases_path, shard=args.shard)
+        if args.old_run is None and args.new_run is not None:
+            args.old_run = results_db.previous_run(args.new_run)
+        if not all(run_id is not None and results_db.has_run(run_id) for run_id in [args.old_run, args.new_run]):
+            print(RETURN_CODES['unknown_run'][1] + ':', args.old_run, args.new_run)
+            return RETURN_CODES['unknown_run'][0]
+        print('Changes from run %d to run %d' % (args.old_run, args.new_run))
+        for key, old_status, new_status, codes in results_db.diff(args.old_run, args.new_run, args.newly_failed):
+            print('%s\t%s -> %s\t%s' % (key, old_status or 'absent', new_status or 'absent', codes or ''))
+    finally:
+        results_db.close()
+    return RETURN_CODES['no_error'][0]
+
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog='data_validator.py query',
+                                     description="Cases of one run of a --results_db by status, rule and measure")
+    parser.add_argument('results_db', help="results database written by --results_db")
+    parser.add_argument('--run', help="run id, by default the latest run", type=int, default=None)
+    parser.add_argument('--profile', help="take the latest run of this profile", default=None)
+    parser.add_argument('--path', help="take the latest run over this cases path", dest="cases_path", default=None)
+    parser.add_argument('--shard', help="take the latest run of this shard K/N", type=parse_shard, default=None)
+    parser.add_argument('--runs', help="list the recorded runs instead", action="store_true", default=False)
+    parser.add_argument('--status', help="cases with this status", default=None,
+                        choices=['accepted', 'rejected', 'error', 'flagged'])
+    parser.add_argument('--code', help="cases rejected by this rule, eg. MinKVP or IrregularSlices", default=None)
+    parser.add_argument('--case', help="cases whose key matches this glob pattern", dest="case_glob", default=None)
+    parser.add_argument('--where', help="cases whose measure meets this condition, eg. ZFOV<100; repeatable. "
+                        "Measures: " + ', '.join(MEASURE_COLUMNS), type=measure_condition, action="append",
+                        dest="conditions", default=[])
+    parser.add_argument('--count_by', help="number of cases per rejection code or per status instead of the cases",
+                        choices=['code', 'status'], default=None)
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.results_db):
+        print(RETURN_CODES['nonexistent_path'])
+        return RETURN_CODES['nonexistent_path'][0]
+    results_db = ResultsDatabase(args.results_db)
+    try:
+        if args.runs:
+            for row in results_db.runs():
+                print('\t'.join('' if value is None else str(value) for value in row))
+            return RETURN_CODES['no_error'][0]
+        if args.run is None:
+            args.run = results_db.latest_run(args.profile, cases_path=args.cases_path, shard=args.shard)
+        if args.run is None or not results_db.has_run(args.run):
+            print(RETURN_CODES['unknown_run'][1] + ':', args.run)
+            return RETURN_CODES['unknown_run'][0]
+        if args.count_by is not None:
+            rows = results_db.counts(args.run, args.count_by)
+        else:
+            rows = results_db.query(args.run, args.status, args.code, args.case_glob, args.conditions)
+        for row in rows:
+            print('\t'.join('' if value is None else str(value) for value in row))
+    finally:
+        results_db.close()
+    return RETURN_CODES['no_error'][0]
+
+
+def main() -> int:
+    if sys.argv[1:2] == ['merge']:
+        return merge_main(sys.argv[2:])
+    if sys.argv[1:2] == ['diff']:
+        return diff_main(sys.argv[2:])
+    if sys.argv[1:2] == ['query']:
+        return query_main(sys.argv[2:])
+    return_code = 0
+    parser = argparse.ArgumentParser(description="Rapid Data Validator")
+    parser.add_argument('-sr', '--srs_req_json_path', help=
+                        "input file path for SRS Requirements JSON file, eg. \'/Users/name/foldername/filename.json\'; "
+                        "several files validate every case against each of them from one read of the data, with "
+                        "results in one output subdirectory per file",
+                        type=str, nargs='+', required=False, action="store", dest="input_req_json_path",
+                        default=DEFAULTS["input_req_json_path"])
+    parser.add_argument('-dc', '--dcm_case_path', help=
+                        "input file path for dicom cases, eg. \'/Users/name/foldername\', or a zip/tar archive "
+                        "or DICOMDIR to read them from in place",
+                        type=str, required=False, action="store", dest="path_to_dicoms",
+                        default=DEFAULTS["path_to_dicoms"])
+    parser.add_argument('-od', '--output_directory', help=
+                        "output directory path to export csv results, eg. \'/Users/name/foldername/filename.csv\'",
+                        type=str, required=False, action="store", dest="output_dir",
+                        default=DEFAULTS["output_dir"])
+    add_output_arguments(parser)
+    parser.add_argument('-w', '--workers', help=
+                        "(optional) number of worker processes to validate cases in parallel, eg. 8",
+                        type=int, required=False, action="store", dest="workers",
+                        default=DEFAULTS["workers"])
+    parser.add_argument('-ci', '--case_index', help=
+                        "(optional) file to save the discovered case index to and reuse on later runs while "
+                        "directory mtimes are unchanged, eg. \'/Users/name/foldername/case_index.json\'",
+                        type=str, required=False, action="store", dest="case_index",
+                        default=DEFAULTS["case_index"])
+    parser.add_argument('-mc', '--metadata_cache', help=
+                        "(optional) SQLite file caching per-slice header fields between runs, "
+                        "eg. \'/Users/name/foldername/metadata_cache.db\'",
+                        type=str, required=False, action="store", dest="metadata_cache",
+                        default=DEFAULTS["metadata_cache"])
+    parser.add_argument('--resume', help=
+                        "(optional) skip cases already recorded in the output directory's journal by an "
+                        "interrupted run and append to its results",
+                        required=False, action="store_true", dest="resume", default=DEFAULTS["resume"])
+    parser.add_argument('--flush_every', help=
+                        "(optional) cases written between flushes of the results and the --resume journal "
+                        "(default %d)" % FLUSH_EVERY,
+                        type=int, required=False, action="store", dest="flush_every", default=DEFAULTS["flush_every"])
+    parser.add_argument('-pf', '--prefetch', help=
+                        "(optional) number of upcoming cases whose slice headers are read ahead on a thread pool "
+                        "while the current case is validated, for network storage; 0 disables it. Prefetched "
+                        "cases are read in full, used when --workers is 1",
+                        type=int, required=False, action="store", dest="prefetch", default=DEFAULTS["prefetch"])
+    parser.add_argument('-io', '--io_threads', help=
+                        "(optional) number of threads reading slice headers for --prefetch",
+                        type=int, required=False, action="store", dest="io_threads", default=DEFAULTS["io_threads"])
+    parser.add_argument('--profile', help=
+                        "(optional) write per-stage timings, files/bytes read and the slowest cases to this JSON "
+                        "file, eg. \'/Users/name/foldername/metrics.json\'",
+                        type=str, required=False, action="store", dest="profile", default=DEFAULTS["profile"])
+    parser.add_argument('--profile_slowest', help="(optional) number of slowest cases listed by --profile",
+                        type=int, required=False, action="store", dest="profile_slowest",
+                        default=DEFAULTS["profile_slowest"])
+    parser.add_argument('--cprofile', help=
+                        "(optional) dump cProfile stats of the validation loop in the main process to this file",
+                        type=str, required=False, action="store", dest="cprofile", default=DEFAULTS["cprofile"])
+    parser.add_argument('--watch', help=
+                        "(optional) keep running and validate each new or changed series under the dicom case path "
+                        "once it stops changing, appending verdicts to the results; stop with Ctrl-C or SIGTERM",
+                        required=False, action="store_true", dest="watch", default=DEFAULTS["watch"])
+    parser.add_argument('--settle', help=
+                        "(optional) seconds a series must stay unchanged before --watch validates it",
+                        type=float, required=False, action="store", dest="settle", default=DEFAULTS["settle"])
+    parser.add_argument('--poll_interval', help=
+                        "(optional) seconds between --watch checks for changes and settled series",
+                        type=float, required=False, action="store", dest="poll_interval",
+                        default=DEFAULTS["poll_interval"])
+    parser.add_argument('--poll', help=
+                        "(optional) make --watch rescan the tree instead of using inotify, eg. for network mounts",
+                        required=False, action="store_true", dest="poll", default=DEFAULTS["poll"])
+    parser.add_argument('-gb', '--group_by', help=
+                        "(optional) what a case is: every directory holding .dcm files (default), every "
+                        "SeriesInstanceUID wherever its files are ('series'), or every series and AcquisitionNumber "
+                        "('acquisition'); grouped runs list each case's directories in " + SERIES_INDEX_FILENAME,
+                        type=str, required=False, action="store", dest="group_by", default=DEFAULTS["group_by"],
+                        choices=['directory', 'series', 'acquisition'])
+    parser.add_argument('--shard', help=
+                        "(optional) validate only shard K of N, eg. 2/8: cases are split by a stable hash of their "
+                        "path (or series UID) and results go to shard-K-of-N in the output directory; combine the "
+                        "shards with \'data_validator.py merge -od OUTPUT_DIRECTORY\'",
+                        type=parse_shard, required=False, action="store", dest="shard", default=DEFAULTS["shard"])
+    parser.add_argument('--duplicates', help=
+                        "(optional) JSON Lines report of SOPInstanceUIDs found in more than one file across all "
+                        "validated cases, built from the slices the validation reads anyway",
+                        type=str, required=False, action="store", dest="duplicates", default=DEFAULTS["duplicates"])
+    parser.add_argument('--duplicates_hash', help=
+                        "(optional) also hash every slice's PixelData for --duplicates, telling exact duplicates "
+                        "from different content under one UID and finding the same content under different UIDs",
+                        required=False, action="store_true", dest="duplicates_hash",
+                        default=DEFAULTS["duplicates_hash"])
+    parser.add_argument('--results_db', help=
+                        "(optional) also record this run's verdicts, rejection codes and case measures in this SQLite "
+                        "database, for \'data_validator.py diff RESULTS_DB\' and \'data_validator.py query "
+                        "RESULTS_DB\'",
+                        type=str, required=False, action="store", dest="results_db", default=DEFAULTS["results_db"])
+    parser.add_argument('--triage', help=
+                        "(optional) screen cases from a sample of their slices: the first, the last and every K-th "
+                        "file by name (default K=%d). Triage verdicts go to the %s subdirectory of the output "
+                        "directory; cases whose sample is inconsistent are flagged and fully validated into the "
+                        "output directory itself" % (TRIAGE_STEP, TRIAGE_DIRNAME),
+                        type=int, nargs='?', const=TRIAGE_STEP, required=False, action="store", dest="triage",
+                        default=DEFAULTS["triage"])
     args = parser.parse_args()
     params = vars(args)
     if params['input_req_json_path'] == DEFAULTS["input_req_json_path"]:
@@ -582,7 +2579,7 @@ def main() -> int:
         print(RETURN_CODES['missing_req_input'])
         return_code = RETURN_CODES['missing_req_input']
         return return_code
-    if not os.path.exists(params['input_req_json_path']):
+    if not all(os.path.exists(json_path) for json_path in params['input_req_json_path']):
         print(RETURN_CODES['nonexistent_path'])
         return_code = RETURN_CODES['nonexistent_path']
         return return_code
@@ -595,7 +2592,34 @@ def main() -> int:
         return_code = RETURN_CODES['nonexistent_path']
         return return_code
     try:
-        analyze_cases(params)
+        profiles = load_profiles(params['input_req_json_path'])
+    except ValueError as e:
+        print(RETURN_CODES['invalid_requirements'][1] + ':', e)
+        return_code = RETURN_CODES['invalid_requirements'][0]
+        return return_code
+    try:
+        if params['watch'] and params['shard'] is not None:
+            print('--shard is not supported by --watch')
+            return RETURN_CODES['missing_req_input'][0]
+        if params['triage'] is not None and params['duplicates'] is not None:
+            print('--duplicates needs every slice read, it cannot be combined with --triage')
+            return RETURN_CODES['missing_req_input'][0]
+        if params['triage'] is not None and params['triage'] < 1:
+            print('--triage needs a step of at least 1')
+            return RETURN_CODES['missing_req_input'][0]
+        if params['watch'] and not os.path.isdir(params['path_to_dicoms']):
+            print('--watch needs a directory of dicom cases')
+            return RETURN_CODES['missing_req_input'][0]
+        if params['watch']:
+            if params['group_by'] != 'directory':
+                print('--group_by is ignored by --watch, which validates directories')
+            if params['duplicates'] is not None:
+                print('--duplicates is ignored by --watch, which never finishes a pass over the tree')
+            if params['triage'] is not None:
+                print('--triage is ignored by --watch')
+            watch_cases(params, profiles)
+        else:
+            analyze_cases(params, profiles)
     except:
         print(RETURN_CODES['processing_error'])
         traceback.print_exc()
@@ -0,0 +1,172 @@
+# Finding and opening DICOM files that live inside zip/tar archives or are listed by a DICOMDIR,
+# without extracting anything to disk
+import collections
+import contextlib
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+
+import pydicom
+from pydicom.fileset import FileSet
+
+# separates an archive path from a member inside it in a file reference, eg. '/data/bundle.zip::case1/IM1.dcm'
+MEMBER_SEPARATOR = '::'
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+DICOMDIR_FILENAME = 'DICOMDIR'
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def member_ref(archive_path, name):
+    return archive_path + MEMBER_SEPARATOR + name
+
+
+def split_member(ref):
+    # (archive path, member name) of a member reference, (ref, None) of a plain file path
+    archive_path, separator, name = ref.partition(MEMBER_SEPARATOR)
+    if separator and archive_path.lower().endswith(ARCHIVE_SUFFIXES):
+        return archive_path, name
+    return ref, None
+
+
+class Archive(object):
+    # one open zip or tar file shared by the threads of a process. Tar members share the archive's file position,
+    # so they are read under a lock; zipfile already serializes its reads.
+    # A compressed tar is `streamed`: seeking back in it decompresses it again from the start, so its members
+    # should be read in the order they are stored (see stream_order).
+    def __init__(self, path):
+        self.path = path
+        self.mtime_ns = os.stat(path).st_mtime_ns
+        self.lock = threading.Lock()
+        if zipfile.is_zipfile(path):
+            self.zip, self.tar = zipfile.ZipFile(path), None
+            self.sizes = dict((info.filename, info.file_size) for info in self.zip.infolist() if not info.is_dir())
+            self.streamed = False
+        else:
+            # listing a compressed tar decompresses it once
+            self.zip, self.tar = None, tarfile.open(path)
+            self.members = dict((info.name, info) for info in self.tar.getmembers() if info.isfile())
+            self.sizes = dict((name, info.size) for name, info in self.members.items())
+            self.streamed = not path.lower().endswith('.tar')
+
+    @contextlib.contextmanager
+    def open(self, name):
+        if self.zip is not None:
+            with self.zip.open(name) as f:
+                yield f
+        else:
+            with self.lock:
+                yield self.tar.extractfile(self.members[name])
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+
+# one handle per archive and process, opened on first use so pool workers get their own
+_open_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_archive(path):
+    key = (os.getpid(), path)
+    with _archives_lock:
+        if key not in _open_archives:
+            _open_archives[key] = Archive(path)
+        return _open_archives[key]
+
+
+@contextlib.contextmanager
+def open_source(ref):
+    # binary file object of a plain file path or an archive member reference
+    archive_path, name = split_member(ref)
+    if name is None:
+        with open(ref, 'rb') as f:
+            yield f
+    else:
+        with get_archive(archive_path).open(name) as f:
+            yield f
+
+
+def read_source(ref):
+    # whole content of a file or member, for readers that need a buffer (eg. pixel values of a member)
+    with open_source(ref) as f:
+        return f.read()
+
+
+def source_stat(ref):
+    # (size, mtime_ns) for the metadata cache; a member has its own size and the mtime of its archive
+    archive_path, name = split_member(ref)
+    if name is None:
+        stat = os.stat(ref)
+        return stat.st_size, stat.st_mtime_ns
+    archive = get_archive(archive_path)
+    return archive.sizes[name], archive.mtime_ns
+
+
+def stream_order(refs):
+    # positions of `refs` in the order their bytes are stored when they are all members of one streamed archive
+    # (a compressed tar), else None: anything else reads as cheaply in any order
+    if not refs:
+        return None
+    archive_path, name = split_member(refs[0])
+    if name is None or not is_archive(archive_path):
+        return None
+    archive = get_archive(archive_path)
+    if not archive.streamed:
+        return None
+    offsets = []
+    for ref in refs:
+        ref_archive, name = split_member(ref)
+        if ref_archive != archive_path:
+            return None
+        offsets.append(archive.members[name].offset)
+    return sorted(range(len(refs)), key=offsets.__getitem__)
+
+
+def archive_cases(archive_path):
+    # {case reference: sorted member references} for every directory inside the archive holding .dcm members,
+    # straight from the archive's listing. Cases are sorted by name, or for a streamed archive by where their
+    # first member is stored, so reading them in turn goes through the archive front to back.
+    cases = collections.defaultdict(list)
+    archive = get_archive(archive_path)
+    for name in archive.sizes:
+        if ".dcm" in posixpath.basename(name).lower():
+            cases[member_ref(archive_path, posixpath.dirname(name))].append(member_ref(archive_path, name))
+    if archive.streamed:
+        def first_offset(case):
+            return min(archive.members[split_member(ref)[1]].offset for ref in cases[case])
+        return dict((case, sorted(cases[case])) for case in sorted(cases, key=first_offset))
+    return dict((case, sorted(cases[case])) for case in sorted(cases))
+
+
+def find_dicomdir(path):
+    # the DICOMDIR `path` is, or the one at the root of the directory `path`, else None
+    if os.path.basename(path) == DICOMDIR_FILENAME and os.path.isfile(path):
+        return path
+    candidate = os.path.join(path, DICOMDIR_FILENAME)
+    if os.path.isfile(candidate):
+        return candidate
+    return None
+
+
+def dicomdir_cases(dicomdir_path):
+    # {case: sorted file paths} from the DICOMDIR's records, one case per series, so the media is never walked.
+    # A case is named after its files' directory, with '#<SeriesInstanceUID>' added when series share a directory.
+    series = collections.OrderedDict()
+    for instance in FileSet(pydicom.dcmread(dicomdir_path)):
+        series_uid = getattr(instance, 'SeriesInstanceUID', None) or os.path.dirname(instance.path)
+        series.setdefault(series_uid, []).append(instance.path)
+    directories = collections.Counter(os.path.dirname(sorted(paths)[0]) for paths in series.values())
+    cases = {}
+    for series_uid, paths in series.items():
+        paths = sorted(paths)
+        label = os.path.dirname(paths[0])
+        if directories[label] > 1:
+            label = '%s#%s' % (label, series_uid)
+        cases[label] = paths
+    return dict((case, cases[case]) for case in sorted(cases))
+
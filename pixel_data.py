@@ -0,0 +1,213 @@
+# Locating PixelData in a DICOM file without reading the pixel bytes
+import collections
+import hashlib
+import os
+import struct
+
+import numpy as np
+import pydicom
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+UNCOMPRESSED_TRANSFER_SYNTAXES = ['1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.2']
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+# encapsulated PixelData framing, always little endian: items, and the delimiter closing the fragment sequence
+ITEM_TAG = (0xFFFE, 0xE000)
+SEQUENCE_DELIMITER_TAG = (0xFFFE, 0xE0DD)
+ITEM_HEADER = struct.Struct('<HHL')
+# frames reduced per step are capped to about this many bytes, which bounds memory on large multi-frame objects
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# offset/length are None when the file has no top-level PixelData, or when it cannot be located
+# without decompressing the whole dataset (deflated transfer syntax)
+PixelDataElement = collections.namedtuple('PixelDataElement', ['transfer_syntax', 'offset', 'length', 'dataset'])
+# outcome of verify_encapsulated: fragments found (Basic Offset Table not counted), frames the header declares,
+# Basic Offset Table entries, and a message per problem (empty when the encapsulation is sound)
+EncapsulationCheck = collections.namedtuple('EncapsulationCheck', ['fragments', 'frames', 'offsets', 'problems'])
+# per-frame minimum and maximum stored values of the complete frames, and the number of frames the header declares
+FrameStatistics = collections.namedtuple('FrameStatistics', ['frames', 'mins', 'maxs'])
+
+
+def read_element_header(fileobj, transfer_syntax):
+    # (tag, declared value length, header size) of the element at the current position, None at end of file
+    little_endian = transfer_syntax != EXPLICIT_VR_BIG_ENDIAN
+    prefix = '<' if little_endian else '>'
+    header = fileobj.read(8)
+    if len(header) < 8:
+        return None
+    group, element = struct.unpack(prefix + 'HH', header[:4])
+    if transfer_syntax == IMPLICIT_VR_LITTLE_ENDIAN:
+        return (group, element), struct.unpack(prefix + 'L', header[4:8])[0], 8
+    vr = header[4:6]
+    if vr in (b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'):
+        extra = fileobj.read(4)
+        if len(extra) < 4:
+            return None
+        return (group, element), struct.unpack(prefix + 'L', extra)[0], 12
+    return (group, element), struct.unpack(prefix + 'H', header[6:8])[0], 8
+
+
+def locate_pixel_data(fileobj, specific_tags=('Rows',)):
+    # parses the header up to PixelData (only `specific_tags` are kept) and reads the 8/12 byte element
+    # header that follows; the pixel bytes themselves are never read
+    ds = pydicom.dcmread(fileobj, stop_before_pixels=True, specific_tags=list(specific_tags))
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if transfer_syntax == DeflatedExplicitVRLittleEndian:
+        return PixelDataElement(transfer_syntax, None, None, ds)
+    position = fileobj.tell()
+    element = read_element_header(fileobj, transfer_syntax)
+    if element is None or element[0] != PIXEL_DATA_TAG:
+        return PixelDataElement(transfer_syntax, None, None, ds)
+    return PixelDataElement(transfer_syntax, position + element[2], element[1], ds)
+
+
+def native_dtype(transfer_syntax, ds):
+    # numpy dtype of one stored value of uncompressed pixel data, None for layouts we do not reduce (1 bit, float)
+    bits_allocated = ds.get('BitsAllocated')
+    if bits_allocated not in (8, 16, 32):
+        return None
+    kind = 'i' if ds.get('PixelRepresentation', 0) == 1 else 'u'
+    order = '>' if transfer_syntax == EXPLICIT_VR_BIG_ENDIAN else '<'
+    return np.dtype('%s%s%d' % (order, kind, bits_allocated // 8))
+
+
+def frame_statistics(source, element, chunk_bytes=CHUNK_BYTES):
+    # FrameStatistics of uncompressed pixel data, from a file path through a read-only memory map or from the
+    # PixelData bytes of a dataset in memory. Frames are reduced a chunk at a time, so only one chunk is ever
+    # paged in; frames that the file or the element is too short for are left out.
+    # None when there is no pixel data, it is compressed, or its layout is not supported.
+    ds = element.dataset
+    if element.transfer_syntax not in UNCOMPRESSED_TRANSFER_SYNTAXES or 'Rows' not in ds or 'Columns' not in ds:
+        return None
+    dtype = native_dtype(element.transfer_syntax, ds)
+    if dtype is None:
+        return None
+    frame_size = int(ds.Rows) * int(ds.Columns) * int(ds.get('SamplesPerPixel', 1) or 1)
+    frames = int(ds.get('NumberOfFrames', 1) or 1)
+    if isinstance(source, (bytes, bytearray)):
+        available = len(source)
+    else:
+        if element.offset is None or element.length == UNDEFINED_LENGTH:
+            return None
+        available = min(element.length, max(os.path.getsize(source) - element.offset, 0))
+    complete = min(frames, available // dtype.itemsize // frame_size) if frame_size else 0
+    mins, maxs = np.empty(complete, dtype), np.empty(complete, dtype)
+    if complete:
+        if isinstance(source, (bytes, bytearray)):
+            data = np.frombuffer(source, dtype, complete * frame_size).reshape(complete, frame_size)
+        else:
+            data = np.memmap(source, dtype, mode='r', offset=element.offset, shape=(complete, frame_size))
+        step = max(1, chunk_bytes // (frame_size * dtype.itemsize))
+        for start in range(0, complete, step):
+            chunk = data[start:start + step]
+            mins[start:start + step] = chunk.min(axis=1)
+            maxs[start:start + step] = chunk.max(axis=1)
+        del data
+    return FrameStatistics(frames, mins, maxs)
+
+
+def hash_pixel_data(fileobj, element, chunk_bytes=CHUNK_BYTES):
+    # (blake2b hex digest of the PixelData value, bytes hashed), read from `fileobj` a chunk at a time; undefined
+    # length (encapsulated) values are hashed to the end of the file. (None, 0) when there is no PixelData.
+    if element.offset is None:
+        return None, 0
+    digest = hashlib.blake2b(digest_size=16)
+    fileobj.seek(element.offset)
+    remaining = None if element.length == UNDEFINED_LENGTH else element.length
+    hashed = 0
+    while remaining is None or remaining > 0:
+        chunk = fileobj.read(chunk_bytes if remaining is None else min(chunk_bytes, remaining))
+        if not chunk:
+            break
+        digest.update(chunk)
+        hashed += len(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return digest.hexdigest(), hashed
+
+
+def verify_encapsulated(fileobj, element):
+    # EncapsulationCheck of encapsulated (compressed) PixelData without decoding anything: only the 8 byte item
+    # headers and the Basic Offset Table are read, fragment payloads are seeked over. Checks the item framing,
+    # even fragment lengths, the offset table against the fragment positions, the fragment count against
+    # NumberOfFrames, and the closing sequence delimiter.
+    frames = int(element.dataset.get('NumberOfFrames', 1) or 1)
+    if element.offset is None:
+        return EncapsulationCheck(0, frames, 0, ['no PixelData found'])
+    if element.length != UNDEFINED_LENGTH:
+        return EncapsulationCheck(0, frames, 0, ['PixelData of a compressed transfer syntax has a defined length '
+                                                 '(%d), it is not encapsulated' % element.length])
+    file_size = fileobj.seek(0, os.SEEK_END)
+    problems = []
+    position = element.offset
+    fileobj.seek(position)
+
+    def next_item():
+        # (tag, length) of the item header at `position`, None past the end of the file
+        header = fileobj.read(ITEM_HEADER.size)
+        if len(header) < ITEM_HEADER.size:
+            return None
+        group, elem, length = ITEM_HEADER.unpack(header)
+        return (group, elem), length
+
+    item = next_item()
+    if item is None or item[0] != ITEM_TAG:
+        return EncapsulationCheck(0, frames, 0, ['Basic Offset Table item missing at offset %d' % position])
+    table_length = item[1]
+    offsets = []
+    if table_length == UNDEFINED_LENGTH or table_length % 4:
+        problems.append('Basic Offset Table length %d is not a multiple of 4' % table_length)
+    elif position + ITEM_HEADER.size + table_length > file_size:
+        problems.append('Basic Offset Table runs past the end of the file')
+    else:
+        table = fileobj.read(table_length)
+        offsets = list(struct.unpack('<%dL' % (table_length // 4), table))
+    position += ITEM_HEADER.size + (0 if table_length == UNDEFINED_LENGTH else table_length)
+    first_fragment = position
+    fragment_starts = []
+    delimited = False
+    while True:
+        fileobj.seek(position)
+        item = next_item()
+        if item is None:
+            break
+        tag, length = item
+        if tag == SEQUENCE_DELIMITER_TAG:
+            delimited = True
+            if length != 0:
+                problems.append('sequence delimiter at offset %d has length %d' % (position, length))
+            break
+        if tag != ITEM_TAG:
+            problems.append('expected an item tag at offset %d, found (%04X,%04X)' % (position, tag[0], tag[1]))
+            break
+        if length == UNDEFINED_LENGTH:
+            problems.append('fragment %d has undefined length' % (len(fragment_starts) + 1))
+            break
+        if length % 2:
+            problems.append('fragment %d has odd length %d' % (len(fragment_starts) + 1, length))
+        fragment_starts.append(position - first_fragment)
+        position += ITEM_HEADER.size + length
+        if position > file_size:
+            problems.append('fragment %d runs past the end of the file' % len(fragment_starts))
+            break
+    if not delimited and not problems:
+        problems.append('sequence delimiter missing')
+
+    if offsets:
+        if len(offsets) != frames:
+            problems.append('Basic Offset Table has %d entries for %d frames' % (len(offsets), frames))
+        if offsets[0] != 0:
+            problems.append('Basic Offset Table does not start at 0')
+        if any(later <= earlier for earlier, later in zip(offsets, offsets[1:])):
+            problems.append('Basic Offset Table offsets are not increasing')
+        starts = set(fragment_starts)
+        stray = [offset for offset in offsets if offset not in starts]
+        if stray:
+            problems.append('%d Basic Offset Table entries do not point at a fragment, first %d'
+                            % (len(stray), stray[0]))
+    # a frame can span several fragments, but never share one
+    if len(fragment_starts) < frames:
+        problems.append('%d fragments for %d frames' % (len(fragment_starts), frames))
+    return EncapsulationCheck(len(fragment_starts), frames, len(offsets), problems)
@@ -0,0 +1,802 @@
+import collections
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+import zipfile
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.uid import RLELossless
+
+import benchmark_validator
+import data_validator
+import dicom_sources
+from pixel_data import ITEM_HEADER, locate_pixel_data, verify_encapsulated
+
+AXIAL = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+SAGITTAL = [0.0, 1.0, 0.0, 0.0, 0.0, -1.0]
+# accepts every clean case make_case_tree generates
+REQUIREMENTS = {"DICOMRequirements": {"SOPClassUID": [benchmark_validator.CT_IMAGE_STORAGE], "MinKVP": 100,
+                                      "MinSliceThickness": 0.5, "ImageType": "AXIAL"}}
+
+
+def make_tree(root, series_count=6, slice_count=12, **counts):
+    benchmark_validator.make_case_tree(str(root), series_count, slice_count, rows=8, columns=8, **counts)
+    return str(root)
+
+
+def analyze(tmp_path, cases_path, output_name='out', requirements=REQUIREMENTS, **overrides):
+    # one analyze_cases run; returns (output directory, counts)
+    req_path = str(tmp_path / 'requirements.json')
+    with open(req_path, 'w') as f:
+        json.dump(requirements, f)
+    output_dir = str(tmp_path / output_name)
+    os.makedirs(output_dir, exist_ok=True)
+    params = dict(data_validator.DEFAULTS, input_req_json_path=req_path, path_to_dicoms=cases_path,
+                  output_dir=output_dir)
+    params.update(overrides)
+    return output_dir, data_validator.analyze_cases(params)
+
+
+def read_outputs(output_dir):
+    outputs = {}
+    for key in data_validator.OUTPUT_KEYS:
+        with open(os.path.join(output_dir, data_validator.DEFAULTS[key])) as f:
+            outputs[key] = f.read()
+    return outputs
+
+
+def count_reads(monkeypatch):
+    # files (names of file objects) pydicom parses from now on
+    reads = []
+    dcmread = pydicom.dcmread
+
+    def counting_dcmread(fp, *args, **kwargs):
+        reads.append(getattr(fp, 'name', fp))
+        return dcmread(fp, *args, **kwargs)
+
+    monkeypatch.setattr(pydicom, 'dcmread', counting_dcmread)
+    return reads
+
+
+def rewrite_slices(case_dir, **values):
+    for name in os.listdir(case_dir):
+        path = os.path.join(case_dir, name)
+        ds = pydicom.dcmread(path)
+        for tag, value in values.items():
+            setattr(ds, tag, value)
+        ds.save_as(path)
+
+
+# geometry
+
+def stack(count, step, orientation=AXIAL):
+    return np.array([np.multiply(step, i) for i in range(count)], dtype=float), np.array([orientation] * count)
+
+
+def test_axial_geometry():
+    geometry = data_validator.series_geometry(*stack(10, [0.0, 0.0, 1.5]))
+    assert geometry['valid']
+    assert geometry['slice_spacing'] == pytest.approx(1.5)
+    assert geometry['zfov'] == pytest.approx(13.5)
+    assert geometry['gantry_tilt'] == pytest.approx(0.0)
+    assert len(geometry['irregular_slices']) == 0
+
+
+def test_sagittal_geometry_sorts_along_the_normal():
+    positions, orientations = stack(10, [2.0, 0.0, 0.0], SAGITTAL)
+    order = np.random.RandomState(0).permutation(10)
+    geometry = data_validator.series_geometry(positions[order], orientations)
+    assert geometry['valid']
+    assert geometry['slice_spacing'] == pytest.approx(2.0)
+    assert geometry['zfov'] == pytest.approx(18.0)
+    assert len(geometry['irregular_slices']) == 0
+
+
+def test_tilted_geometry():
+    tilt = 20.0
+    geometry = data_validator.series_geometry(*stack(10, [0.0, math.tan(math.radians(tilt)), 1.0]))
+    assert geometry['gantry_tilt'] == pytest.approx(tilt)
+    assert geometry['slice_spacing'] == pytest.approx(1.0)
+
+
+def test_missing_slice_is_irregular():
+    positions, orientations = stack(10, [0.0, 0.0, 1.0])
+    geometry = data_validator.series_geometry(np.delete(positions, 5, axis=0), orientations[:9])
+    assert list(geometry['irregular_slices']) == [4]
+
+
+@pytest.mark.parametrize('orientation', [[0.0] * 6, [1.0, 0.0, 0.0, 1.0, 0.0, 0.0], [np.nan] * 6])
+def test_degenerate_orientation_is_invalid(orientation):
+    with np.errstate(all='raise'):
+        geometry = data_validator.series_geometry(*stack(5, [0.0, 0.0, 1.0], orientation))
+    assert not geometry['valid']
+
+
+def test_batch_geometry_matches_single_series():
+    missing = stack(12, [0.0, 0.0, 1.0])
+    series_list = [stack(10, [0.0, 0.0, 1.0]), stack(1, [0.0, 0.0, 1.0]), stack(7, [3.0, 0.0, 0.0], SAGITTAL),
+                   stack(4, [0.0, 0.0, 1.0], [0.0] * 6), (np.delete(missing[0], [3, 8], axis=0), missing[1][:10])]
+    for batched, (positions, orientations) in zip(data_validator.batch_series_geometry(series_list), series_list):
+        single = data_validator.series_geometry(positions, orientations)
+        assert batched['valid'] == single['valid']
+        np.testing.assert_equal([batched['slice_spacing'], batched['zfov'], batched['gantry_tilt']],
+                                [single['slice_spacing'], single['zfov'], single['gantry_tilt']])
+        np.testing.assert_equal(batched['irregular_slices'], single['irregular_slices'])
+
+
+def test_degenerate_orientation_case_is_rejected(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=2)
+    rewrite_slices(os.path.join(cases_path, 'case_000'), ImageOrientationPatient=[0.0] * 6)
+    output_dir, counts = analyze(tmp_path, cases_path)
+    assert counts['number_of_failed_cases'] == 1
+    with open(os.path.join(output_dir, data_validator.DEFAULTS['rejected_results_json'])) as f:
+        entry = json.loads(f.readline())
+    assert entry['case'].endswith('case_000')
+    assert [data_validator.rejection_code(message) for message in entry['messages']] == ['InvalidGeometry']
+
+
+# requirements
+
+def test_unknown_requirement_keys_are_rejected():
+    requirements = {"DICOMRequirements": dict(REQUIREMENTS['DICOMRequirements'], MinKVPP=100, Colour='red')}
+    with pytest.raises(ValueError) as error:
+        data_validator.compile_requirements(requirements)
+    assert 'MinKVPP (did you mean MinKVP?)' in str(error.value)
+    assert 'Colour' in str(error.value)
+
+
+def test_requirement_keys_ignore_case():
+    requirements = {"DICOMRequirements": dict(REQUIREMENTS['DICOMRequirements'], maxkvp=140)}
+    rules = data_validator.compile_requirements(requirements).case_rules
+    assert [rule.limit for rule in rules if rule.key == 'MaxKVP'] == [140]
+
+
+def test_unknown_requirement_keys_stop_the_run(tmp_path, monkeypatch):
+    cases_path = make_tree(tmp_path / 'tree', series_count=1, slice_count=2)
+    req_path = str(tmp_path / 'requirements.json')
+    with open(req_path, 'w') as f:
+        json.dump({"DICOMRequirements": dict(REQUIREMENTS['DICOMRequirements'], MaxKVP_=140)}, f)
+    monkeypatch.setattr('sys.argv', ['data_validator.py', '-sr', req_path, '-dc', cases_path, '-od', str(tmp_path)])
+    assert data_validator.main() == data_validator.RETURN_CODES['invalid_requirements'][0]
+    assert not os.path.exists(os.path.join(str(tmp_path), data_validator.DEFAULTS['rejected_results_filename']))
+
+
+def test_first_slice_rejection_reads_no_other_slices(tmp_path, monkeypatch):
+    cases_path = make_tree(tmp_path / 'tree', series_count=3, slice_count=6, localizer=1)
+    reads = count_reads(monkeypatch)
+    output_dir, counts = analyze(tmp_path, cases_path)
+    assert counts['number_of_failed_cases'] == 1
+    with open(os.path.join(output_dir, data_validator.DEFAULTS['rejected_results_json'])) as f:
+        rejected = json.loads(f.readline())['case']
+    read_cases = collections.Counter(os.path.dirname(path) for path in reads)
+    assert read_cases.pop(rejected) == 1
+    assert sorted(read_cases.values()) == [6, 6]
+
+
+# rules on undefined measures
+
+def test_undefined_measure_fails():
+    assert not data_validator.at_least(np.nan, 1)
+    assert not data_validator.at_most(np.nan, 1)
+
+
+def test_single_slice_series_passes_slice_thickness(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=1, slice_count=1)
+    case_dir = os.path.join(cases_path, 'case_000')
+    with data_validator.Validator(REQUIREMENTS, verbose=False) as validator:
+        result = validator.validate_series(sorted(os.path.join(case_dir, name) for name in os.listdir(case_dir)))
+    assert result.status == 'accepted', result.messages
+
+
+def test_empty_series_is_an_error():
+    with data_validator.Validator(REQUIREMENTS, verbose=False) as validator:
+        with pytest.raises(ValueError):
+            validator.validate_series([])
+
+
+def test_pixel_rules_cover_the_first_acquisition(tmp_path):
+    # pixel values are the instance number, so only the second acquisition goes above -1024 + slice_count // 2
+    cases_path = make_tree(tmp_path / 'tree', series_count=1, slice_count=10, multi_acquisition=1)
+    requirements = {"DICOMRequirements": dict(REQUIREMENTS['DICOMRequirements'], MaxHU=-1019)}
+    output_dir, counts = analyze(tmp_path, cases_path, requirements=requirements)
+    assert counts['number_of_failed_cases'] == 1
+    with open(os.path.join(output_dir, data_validator.DEFAULTS['rejected_results_json'])) as f:
+        messages = json.loads(f.readline())['messages']
+    assert [data_validator.rejection_code(message) for message in messages] == ['MultipleAcquisitions']
+
+
+def test_hu_rules_skip_cases_with_no_checked_pixels(tmp_path):
+    # the RLE case's pixel data is not checked: it has no HU range to fail, the other case goes above MaxHU
+    cases_path = make_tree(tmp_path / 'tree', series_count=2, slice_count=10, compressed=1)
+    requirements = {"DICOMRequirements": dict(REQUIREMENTS['DICOMRequirements'], MinHU=-1000, MaxHU=-1019)}
+    output_dir, counts = analyze(tmp_path, cases_path, requirements=requirements)
+    assert counts['number_of_failed_cases'] == 1
+    with open(os.path.join(output_dir, data_validator.DEFAULTS['accepted_results_json'])) as f:
+        assert json.loads(f.readline())['case'].endswith('case_000')
+
+
+# parallel runs
+
+def test_workers_match_a_serial_run(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=8, slice_count=6, missing=2, multi_acquisition=1,
+                           localizer=1)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'serial')
+    output_dir, counts = analyze(tmp_path, cases_path, 'parallel', workers=3)
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+def test_prefetch_matches_a_serial_run(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=8, slice_count=6, missing=2, multi_acquisition=1,
+                           localizer=1)
+    # a read error surfaces inside its own case, as in a serial run
+    with open(os.path.join(cases_path, 'case_005', 'IM-0003.dcm'), 'wb') as f:
+        f.write(b'not a dicom file')
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'serial')
+    assert reference_counts['number_of_errored_cases'] == 1
+    output_dir, counts = analyze(tmp_path, cases_path, 'prefetched', prefetch=3, io_threads=4)
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+def test_profiles_share_one_read_per_file(tmp_path, monkeypatch):
+    cases_path = make_tree(tmp_path / 'tree', series_count=4, slice_count=6, missing=1, localizer=1)
+    # the second profile rejects every case on kVP and adds a pixel rule, so it reads pixel statistics too
+    profiles = collections.OrderedDict([('head', REQUIREMENTS), ('strict', {"DICOMRequirements": dict(
+        REQUIREMENTS['DICOMRequirements'], MinKVP=130, MaxHU=-1019)})])
+    references = {}
+    for name, requirements in profiles.items():
+        references[name] = analyze(tmp_path, cases_path, 'reference_' + name, requirements)
+    req_paths = []
+    for name, requirements in profiles.items():
+        req_paths.append(str(tmp_path / (name + '.json')))
+        with open(req_paths[-1], 'w') as f:
+            json.dump(requirements, f)
+    reads = count_reads(monkeypatch)
+    output_dir, summaries = analyze(tmp_path, cases_path, input_req_json_path=req_paths)
+    # the localizer is rejected on its first slice by both profiles, the other cases are read in full
+    assert len(reads) == len(set(reads)) == 5 + 1 + 6 + 6
+    assert list(summaries) == list(profiles)
+    for name, (reference_dir, reference_counts) in references.items():
+        assert summaries[name] == reference_counts
+        assert read_outputs(os.path.join(output_dir, name)) == read_outputs(reference_dir)
+
+
+# journal and resume
+
+def test_read_journal_ignores_unflushed_and_torn_lines(tmp_path):
+    journal_path = str(tmp_path / data_validator.JOURNAL_FILENAME)
+    with open(journal_path, 'w') as f:
+        f.write(json.dumps({'case': 'a', 'status': 'accepted'}) + '\n')
+        f.write(json.dumps({'offsets': {'accepted_results_filename': 2}}) + '\n')
+        f.write(json.dumps({'case': 'b', 'status': 'rejected'}) + '\n')
+        f.write('{"case": "c", "sta')
+    completed, offsets, journal_size = data_validator.read_journal(journal_path)
+    assert completed == {'a': 'accepted'}
+    assert offsets == {'accepted_results_filename': 2}
+    with open(journal_path, 'rb') as f:
+        assert f.read(journal_size).endswith(b'}}\n')
+
+
+def crash_after(cases, tmp_path, cases_path, **overrides):
+    # analyze_cases flushing after every case, killed while writing case number `cases` + 1: part of its verdict
+    # is on disk but not in the journal, and the journal ends in a torn line
+    written = []
+
+    def write_results(writers, results):
+        if len(written) == cases:
+            for writer in writers.values():
+                writer.files['rejected_results_filename'].write('partial verdict')
+                writer.files['rejected_results_filename'].flush()
+                writer.journal.write('{"case": ')
+                writer.journal.flush()
+            os._exit(1)
+        written.append(results)
+        original(writers, results)
+
+    original, data_validator.write_results = data_validator.write_results, write_results
+    analyze(tmp_path, cases_path, 'resumed', flush_every=1, **overrides)
+
+
+def test_crash_then_resume_gives_the_same_outputs(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', missing=1, multi_acquisition=1, localizer=1)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'reference')
+    process = multiprocessing.get_context('fork').Process(target=crash_after, args=(3, tmp_path, cases_path))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+    output_dir, counts = analyze(tmp_path, cases_path, 'resumed', resume=True)
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+def test_second_crash_keeps_the_resumed_progress(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=8, missing=1, multi_acquisition=1, localizer=1)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'reference')
+    for cases, resume in [(2, False), (3, True)]:
+        process = multiprocessing.get_context('fork').Process(target=crash_after, args=(cases, tmp_path, cases_path),
+                                                              kwargs=dict(resume=resume))
+        process.start()
+        process.join()
+        assert process.exitcode == 1
+    # 2 cases from the first run, 3 more from the first resume
+    completed, _, _ = data_validator.read_journal(os.path.join(str(tmp_path / 'resumed'),
+                                                               data_validator.JOURNAL_FILENAME))
+    assert len(completed) == 5
+    output_dir, counts = analyze(tmp_path, cases_path, 'resumed', resume=True)
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+# sharding
+
+@pytest.mark.parametrize('label', ['tree/case_000', 'tree/case_001', 'tree/a/b', 'tree::x/IM1.dcm'])
+def test_shard_key_ignores_a_trailing_separator(label):
+    for shard in [(1, 3), (2, 3), (3, 3)]:
+        assert data_validator.in_shard(label, 'tree', shard) == data_validator.in_shard(label, 'tree/', shard)
+
+
+def test_case_key():
+    assert data_validator.case_key('tree/case_000', 'tree') == 'case_000'
+    assert data_validator.case_key('tree/case_000', 'tree/') == 'case_000'
+    assert data_validator.case_key('tree', 'tree/') == '.'
+    assert data_validator.case_key('tree2/case_000', 'tree') == 'tree2/case_000'
+    assert data_validator.case_key('1.2.3', 'tree') == '1.2.3'
+
+
+def test_shards_partition_and_merge_like_one_run(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=10, slice_count=4, missing=2, localizer=1)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'reference')
+    shard_cases = collections.Counter()
+    for shard in [(1, 3), (2, 3), (3, 3)]:
+        # the shards disagree on the trailing separator and must still split the tree the same way
+        path = cases_path if shard[0] % 2 else os.path.join(cases_path, '')
+        output_dir, _ = analyze(tmp_path, path, 'sharded', shard=shard)
+        with open(os.path.join(data_validator.shard_dir(output_dir, shard),
+                               data_validator.SHARD_MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+        assert manifest['total_cases'] == 10
+        shard_cases[shard] = manifest['cases']
+    assert sum(shard_cases.values()) == 10
+    params = dict(data_validator.DEFAULTS, output_dir=str(tmp_path / 'sharded'))
+    counts, problems = data_validator.merge_shards(params)
+    assert problems == []
+    assert counts == reference_counts
+    assert read_outputs(params['output_dir']) == read_outputs(reference_dir)
+
+
+def test_merge_reports_shards_that_do_not_add_up(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=6, slice_count=3)
+    shard_dirs = []
+    for shard in [(1, 2), (2, 2)]:
+        output_dir, _ = analyze(tmp_path, cases_path, 'sharded', shard=shard)
+        shard_dirs.append(data_validator.shard_dir(output_dir, shard))
+    # the same shard merged twice
+    shutil.copytree(shard_dirs[0], str(tmp_path / 'copy'))
+    params = dict(data_validator.DEFAULTS, output_dir=str(tmp_path / 'sharded'))
+    _, problems = data_validator.merge_shards(params, shard_dirs + [str(tmp_path / 'copy')])
+    assert len(problems) == 1 and 'discovered' in problems[0]
+
+
+# duplicate index
+
+def read_report(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_sharded_duplicate_reports_merge_like_one_run(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=6, slice_count=4)
+    # the same series twice, and one slice of another copied into a third
+    shutil.copytree(os.path.join(cases_path, 'case_000'), os.path.join(cases_path, 'case_006'))
+    case_dir = os.path.join(cases_path, 'case_001')
+    shutil.copy(os.path.join(case_dir, sorted(os.listdir(case_dir))[0]),
+                os.path.join(cases_path, 'case_002', 'x.dcm'))
+    reference_path = str(tmp_path / 'reference.jsonl')
+    analyze(tmp_path, cases_path, 'reference', duplicates=reference_path, duplicates_hash=True)
+    reference = read_report(reference_path)
+    # pixel values are the instance number, so slices of different series also share content
+    assert collections.Counter(entry['kind'] for entry in reference)['exact_duplicate'] == 5
+    for shard in [(1, 3), (2, 3), (3, 3)]:
+        analyze(tmp_path, cases_path, 'sharded', shard=shard, duplicates=str(tmp_path / 'shard.jsonl'),
+                duplicates_hash=True)
+    params = dict(data_validator.DEFAULTS, output_dir=str(tmp_path / 'sharded'))
+    _, problems = data_validator.merge_shards(params)
+    assert problems == []
+    assert read_report(os.path.join(params['output_dir'], data_validator.DUPLICATE_REPORT_FILENAME)) == reference
+
+
+def test_unreadable_slices_are_counted_not_indexed(tmp_path, capsys):
+    cases_path = make_tree(tmp_path / 'tree', series_count=2, slice_count=4)
+    case_dir = os.path.join(cases_path, 'case_001')
+    with open(os.path.join(case_dir, sorted(os.listdir(case_dir))[-1]), 'wb') as f:
+        f.write(b'not a dicom file')
+    analyze(tmp_path, cases_path, duplicates=str(tmp_path / 'duplicates.jsonl'))
+    out = capsys.readouterr().out
+    assert 'Instances indexed for duplicates:  8' in out
+    assert 'Instances without a readable SOPInstanceUID:  1' in out
+
+
+# run profile
+
+def read_profile(tmp_path, cases_path, output_name, **overrides):
+    metrics_path = str(tmp_path / (output_name + '.json'))
+    analyze(tmp_path, cases_path, output_name, profile=metrics_path, profile_slowest=3, **overrides)
+    with open(metrics_path) as f:
+        return json.load(f)
+
+
+def test_profile_metrics(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=4, slice_count=5)
+    cache_path = str(tmp_path / 'cache.db')
+    report = read_profile(tmp_path, cases_path, 'cold', metadata_cache=cache_path)
+    assert {'discovery', 'validation', 'output'} <= set(report['stages'])
+    assert report['totals']['cases'] == 4
+    assert (report['totals']['files_read'], report['totals']['cache_hits']) == (20, 0)
+    assert report['totals']['bytes_read'] > 0
+    assert len(report['slowest_cases']) == 3
+    walls = [case['wall'] for case in report['slowest_cases']]
+    assert walls == sorted(walls, reverse=True)
+    assert report['case_stages']['read'] > 0
+    report = read_profile(tmp_path, cases_path, 'warm', metadata_cache=cache_path)
+    assert report['totals'] == dict(cases=4, files_read=0, cache_hits=20, bytes_read=0)
+
+
+# triage
+
+def test_flagged_cases_have_their_own_outputs(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=3, slice_count=30, missing=1)
+    output_dir, _ = analyze(tmp_path, cases_path, triage=10)
+    triage_dir = os.path.join(output_dir, data_validator.TRIAGE_DIRNAME)
+    with open(os.path.join(triage_dir, 'triage_summary.json')) as f:
+        counts, = json.load(f).values()
+    assert counts['number_of_flagged_cases'] == 1
+    assert counts['number_of_failed_cases'] == 0
+    outputs = read_outputs(triage_dir)
+    with open(os.path.join(triage_dir, data_validator.DEFAULTS['flagged_results_filename'])) as f:
+        assert f.read().startswith(os.path.join(cases_path, 'case_000'))
+    assert outputs['rejected_results_filename'] == ''
+
+
+def test_triage_reads_small_cases_once(tmp_path, monkeypatch):
+    # a case of up to step + 1 files would give a 2-file sample, which cannot be judged
+    cases_path = make_tree(tmp_path / 'tree', series_count=5, slice_count=8)
+    reads = count_reads(monkeypatch)
+    output_dir, counts = analyze(tmp_path, cases_path, triage=10)
+    assert len(reads) == 40
+    assert counts['number_of_total_cases'] == 0
+    with open(os.path.join(output_dir, data_validator.TRIAGE_DIRNAME, 'triage_summary.json')) as f:
+        triage_counts, = json.load(f).values()
+    assert triage_counts['number_of_total_cases'] == 5
+    assert 'number_of_flagged_cases' not in triage_counts
+
+
+# series grouping
+
+def split_series(cases_path):
+    # half of case_000's slices moved to a directory of their own
+    case_dir = os.path.join(cases_path, 'case_000')
+    os.makedirs(case_dir + '_rest')
+    for name in sorted(os.listdir(case_dir))[::2]:
+        os.rename(os.path.join(case_dir, name), os.path.join(case_dir + '_rest', name))
+
+
+def test_group_by_series_joins_directories(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=3, slice_count=6)
+    split_series(cases_path)
+    output_dir, counts = analyze(tmp_path, cases_path, group_by='series')
+    assert (counts['number_of_total_cases'], counts['number_of_failed_cases']) == (3, 0)
+    with open(os.path.join(output_dir, data_validator.SERIES_INDEX_FILENAME)) as f:
+        series_map = [json.loads(line) for line in f]
+    assert sorted(len(entry['directories']) for entry in series_map) == [1, 1, 2]
+
+
+def test_cold_grouped_run_reads_each_file_once(tmp_path, monkeypatch):
+    cases_path = make_tree(tmp_path / 'tree', series_count=3, slice_count=6, missing=1)
+    split_series(cases_path)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'reference', group_by='series')
+    reads = count_reads(monkeypatch)
+    output_dir, counts = analyze(tmp_path, cases_path, group_by='series', metadata_cache=str(tmp_path / 'cache.db'))
+    assert len(reads) == len(set(reads)) == 17
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+# metadata cache
+
+def test_cached_run_reads_no_files(tmp_path, monkeypatch):
+    cases_path = make_tree(tmp_path / 'tree', missing=1, multi_acquisition=1)
+    cache_path = str(tmp_path / 'cache.db')
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'first', metadata_cache=cache_path)
+    reads = count_reads(monkeypatch)
+    output_dir, counts = analyze(tmp_path, cases_path, 'second', metadata_cache=cache_path)
+    assert reads == []
+    assert counts == reference_counts
+    assert read_outputs(output_dir) == read_outputs(reference_dir)
+
+
+def test_cache_writers_do_not_wait_for_each_other(tmp_path):
+    cache_path = str(tmp_path / 'cache.db')
+    first, second = data_validator.MetadataCache(cache_path), data_validator.MetadataCache(cache_path)
+    try:
+        second.connection.execute('PRAGMA busy_timeout = 100')
+        # a case in progress on the first connection does not lock out the second
+        first.put('/cases/a/IM1.dcm', 1, 1, {'Rows': 8})
+        second.put('/cases/b/IM1.dcm', 1, 1, {'Rows': 8})
+        second.commit()
+        first.commit()
+        assert second.get('/cases/a/IM1.dcm', 1, 1) == {'Rows': 8}
+    finally:
+        first.close()
+        second.close()
+
+
+def test_evict_missing_archive_members(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=2, slice_count=3)
+    archive_path = str(tmp_path / 'tree.zip')
+
+    def write_archive(case_names):
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            for name in case_names:
+                for file_name in os.listdir(os.path.join(cases_path, name)):
+                    archive.write(os.path.join(cases_path, name, file_name), name + '/' + file_name)
+
+    cache_path = str(tmp_path / 'cache.db')
+    write_archive(['case_000', 'case_001'])
+    # a run of its own, as from the command line: a process keeps its archives open
+    process = multiprocessing.get_context('fork').Process(target=analyze, args=(tmp_path, archive_path),
+                                                          kwargs=dict(metadata_cache=cache_path))
+    process.start()
+    process.join()
+    write_archive(['case_001'])
+    analyze(tmp_path, archive_path, metadata_cache=cache_path)
+    cache = data_validator.MetadataCache(cache_path)
+    try:
+        paths = [path for (path,) in cache.connection.execute('SELECT path FROM slices')]
+    finally:
+        cache.close()
+    assert len(paths) == 3 and all('case_001' in path for path in paths)
+
+
+# archives
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_compressed_tar_is_read_front_to_back(tmp_path, monkeypatch, prefetch):
+    cases_path = make_tree(tmp_path / 'tree', series_count=4, slice_count=5, missing=1)
+    reference_dir, reference_counts = analyze(tmp_path, cases_path, 'reference')
+    # stored in reverse name order: reading cases and slices by name would seek backwards on every member
+    archive_path = str(tmp_path / 'tree.tar.gz')
+    files = sorted(os.path.join(d, name) for d, _, names in os.walk(cases_path) for name in names)
+    with tarfile.open(archive_path, 'w:gz') as archive:
+        for path in reversed(files):
+            archive.add(path, os.path.relpath(path, str(tmp_path)))
+    offsets = []
+    archive_open = dicom_sources.Archive.open
+
+    def recording_open(archive, name):
+        offsets.append(archive.members[name].offset)
+        return archive_open(archive, name)
+
+    monkeypatch.setattr(dicom_sources.Archive, 'open', recording_open)
+    output_dir, counts = analyze(tmp_path, archive_path, prefetch=prefetch)
+    assert len(offsets) == len(files)
+    assert offsets == sorted(offsets)
+    assert counts == reference_counts
+    outputs, reference = read_outputs(output_dir), read_outputs(reference_dir)
+    for key in ['accepted_results_filename', 'rejected_results_filename']:
+        # labels are member references, and the cases come in stored order
+        lines = [line.replace(archive_path + dicom_sources.MEMBER_SEPARATOR, str(tmp_path) + os.sep)
+                 for line in outputs[key].splitlines()]
+        assert sorted(lines) == sorted(reference[key].splitlines())
+
+
+# watch mode
+
+def read_entries(output_dir):
+    entries = []
+    for key in ['accepted_results_json', 'rejected_results_json']:
+        path = os.path.join(output_dir, data_validator.DEFAULTS[key])
+        if os.path.exists(path):
+            with open(path) as f:
+                entries.extend(json.loads(line) for line in f)
+    return entries
+
+
+def wait_for_entries(output_dir, count):
+    for _ in range(400):
+        entries = read_entries(output_dir)
+        if len(entries) >= count:
+            return entries
+        time.sleep(0.05)
+    return read_entries(output_dir)
+
+
+def start_watch(params):
+    # a watch daemon of its own, as from the command line; stopped with SIGTERM
+    process = multiprocessing.get_context('fork').Process(target=data_validator.watch_cases, args=(params,))
+    process.start()
+    return process
+
+
+def stop_watch(process):
+    process.terminate()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_watch_appends_across_restarts_and_marks_revalidated_cases(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=2, slice_count=6)
+    req_path = str(tmp_path / 'requirements.json')
+    with open(req_path, 'w') as f:
+        json.dump(REQUIREMENTS, f)
+    output_dir = str(tmp_path / 'out')
+    os.makedirs(output_dir)
+    params = dict(data_validator.DEFAULTS, input_req_json_path=req_path, path_to_dicoms=cases_path,
+                  output_dir=output_dir, watch=True, poll=True, settle=0.2, poll_interval=0.05)
+    process = start_watch(params)
+    try:
+        entries = wait_for_entries(output_dir, 2)
+        assert [entry['status'] for entry in entries] == ['accepted', 'accepted']
+        # a slice of a validated series goes missing
+        case_dir = os.path.join(cases_path, 'case_000')
+        os.remove(os.path.join(case_dir, sorted(os.listdir(case_dir))[3]))
+        entries = wait_for_entries(output_dir, 3)
+    finally:
+        stop_watch(process)
+    revalidated = [entry for entry in entries if 'supersedes' in entry]
+    assert [(entry['case'], entry['status'], entry['supersedes']) for entry in revalidated] == \
+        [(case_dir, 'rejected', 'accepted')]
+    # restarted without --resume: the earlier verdicts stay and only the new series is validated
+    shutil.copytree(os.path.join(cases_path, 'case_001'), os.path.join(cases_path, 'case_002'))
+    process = start_watch(params)
+    try:
+        wait_for_entries(output_dir, 4)
+    finally:
+        stop_watch(process)
+    entries = read_entries(output_dir)
+    assert len(entries) == 4
+    assert [entry['status'] for entry in entries if entry['case'].endswith('case_002')] == ['accepted']
+    assert sum('supersedes' in entry for entry in entries) == 1
+    writer = data_validator.ResultWriter(params, resume=True)
+    writer.close()
+    assert (writer.number_of_total_cases, writer.number_of_failed_cases) == (3, 1)
+
+
+# results database
+
+def test_default_runs_match_path_and_shard(tmp_path):
+    results_db = data_validator.ResultsDatabase(str(tmp_path / 'results.db'))
+    try:
+        first = results_db.start_run('head', 'tree')
+        first_shard = results_db.start_run('head', 'tree', shard=(1, 2))
+        results_db.start_run('head', 'other')
+        second = results_db.start_run('head', 'tree/')
+        second_shard = results_db.start_run('head', os.path.abspath('tree'), shard=(1, 2))
+        assert results_db.previous_run(second) == first
+        assert results_db.previous_run(second_shard) == first_shard
+        assert results_db.latest_run('head', cases_path='tree/', shard=(1, 2)) == second_shard
+        assert results_db.start_run('head', 'tree', resume=True) == second
+    finally:
+        results_db.close()
+
+
+def command_lines(capsys, command, argv):
+    # (return code, printed lines) of a diff_main or query_main call
+    capsys.readouterr()
+    return_code = command(argv)
+    return return_code, capsys.readouterr().out.splitlines()
+
+
+def test_diff_and_query_commands(tmp_path, capsys):
+    cases_path = make_tree(tmp_path / 'tree', series_count=4, slice_count=6, localizer=1)
+    db_path = str(tmp_path / 'results.db')
+    analyze(tmp_path, cases_path, results_db=db_path)
+    os.remove(os.path.join(cases_path, 'case_002', 'IM-0003.dcm'))
+    analyze(tmp_path, cases_path, results_db=db_path)
+    no_error = data_validator.RETURN_CODES['no_error'][0]
+
+    assert command_lines(capsys, data_validator.diff_main, [db_path]) == (
+        no_error, ['Changes from run 1 to run 2', 'case_002\taccepted -> rejected\tIrregularSlices'])
+    assert command_lines(capsys, data_validator.diff_main, [db_path, '--from', '2', '--to', '1', '--newly_failed']) \
+        == (no_error, ['Changes from run 2 to run 1'])
+    assert command_lines(capsys, data_validator.query_main, [db_path, '--status', 'rejected']) == (
+        no_error, ['case_000\trejected\tRejectedImageType', 'case_002\trejected\tIrregularSlices'])
+    assert command_lines(capsys, data_validator.query_main, [db_path, '--run', '1', '--code', 'IrregularSlices']) \
+        == (no_error, [])
+    assert command_lines(capsys, data_validator.query_main, [db_path, '--count_by', 'code']) == (
+        no_error, ['IrregularSlices\t1', 'RejectedImageType\t1'])
+    return_code, lines = command_lines(capsys, data_validator.query_main, [db_path, '--where', 'Rows=8',
+                                                                          '--status', 'accepted'])
+    assert [line.split('\t')[:2] for line in lines] == [['case_001', 'accepted'], ['case_003', 'accepted']]
+    assert command_lines(capsys, data_validator.query_main, [db_path, '--run', '9'])[0] == \
+        data_validator.RETURN_CODES['unknown_run'][0]
+    assert command_lines(capsys, data_validator.diff_main, [str(tmp_path / 'missing.db')])[0] == \
+        data_validator.RETURN_CODES['nonexistent_path'][0]
+
+
+# encapsulated pixel data
+
+def rle_slice(tmp_path):
+    path = str(tmp_path / 'rle.dcm')
+    benchmark_validator.make_slice(path, pydicom.uid.generate_uid(), pydicom.uid.generate_uid(), 1, 8, 8, 0.0,
+                                   transfer_syntax=RLELossless)
+    return path
+
+
+def check_encapsulation(path):
+    with open(path, 'rb') as f:
+        return verify_encapsulated(f, locate_pixel_data(f, ('Rows', 'NumberOfFrames')))
+
+
+def test_valid_encapsulation(tmp_path):
+    path = rle_slice(tmp_path)
+    check = check_encapsulation(path)
+    assert check.problems == []
+    assert (check.fragments, check.frames) == (1, 1)
+    assert benchmark_validator.load_odd_even_checker().check_pixel_data_length(path, verbose=False) == 0
+
+
+@pytest.mark.parametrize('corruption', ['odd_fragment', 'overrun', 'no_delimiter', 'bad_item_tag'])
+def test_corrupted_encapsulation(tmp_path, corruption):
+    path = rle_slice(tmp_path)
+    with open(path, 'rb') as f:
+        element = locate_pixel_data(f, ('Rows',))
+        data = bytearray(f.seek(0) or f.read())
+    # the Basic Offset Table item, then the one fragment
+    offset_table = element.offset
+    _, _, table_length = ITEM_HEADER.unpack_from(data, offset_table)
+    fragment = offset_table + ITEM_HEADER.size + table_length
+    group, item, length = ITEM_HEADER.unpack_from(data, fragment)
+    if corruption == 'odd_fragment':
+        ITEM_HEADER.pack_into(data, fragment, group, item, length - 1)
+    elif corruption == 'overrun':
+        ITEM_HEADER.pack_into(data, fragment, group, item, len(data))
+    elif corruption == 'no_delimiter':
+        del data[-ITEM_HEADER.size:]
+    else:
+        ITEM_HEADER.pack_into(data, fragment, 0x0008, 0x0010, length)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert check_encapsulation(path).problems
+    assert benchmark_validator.load_odd_even_checker().check_pixel_data_length(path, verbose=False) == 4
+
+
+# odd/even byte check batch mode
+
+def test_odd_even_batch_summary(tmp_path):
+    cases_path = make_tree(tmp_path / 'tree', series_count=2, slice_count=3, compressed=1)
+    checker = benchmark_validator.load_odd_even_checker()
+    case_dir = os.path.join(cases_path, 'case_001')
+    native = os.path.join(case_dir, sorted(os.listdir(case_dir))[0])
+    # the PixelData length of one native slice made odd: it is the last element, its length the 4 bytes before
+    with open(native, 'rb') as f:
+        element = locate_pixel_data(f, ('Rows',))
+        data = bytearray(f.seek(0) or f.read())
+    data[element.offset - 4:element.offset] = (element.length - 1).to_bytes(4, 'little')
+    with open(native, 'wb') as f:
+        f.write(data[:-1])
+    broken = os.path.join(case_dir, 'broken.dcm')
+    with open(broken, 'w') as f:
+        f.write('not a dicom file')
+    files = checker.collect_files([cases_path])
+    summary = checker.run_batch(files)
+    assert summary['total'] == 7
+    assert summary['counts'] == {'0': 5, '1': 1, '2': 0, '3': 1, '4': 0}
+    codes = dict((entry['path'], entry['code']) for entry in summary['files'])
+    assert (codes[native], codes[broken]) == (1, 3)
+    assert [entry['path'] for entry in summary['files']] == files
+    # worker processes need the script run as a program, the checker loaded here is not importable by name
+    output_path = str(tmp_path / 'summary.json')
+    process = subprocess.run([sys.executable, benchmark_validator.ODD_EVEN_SCRIPT, cases_path, '-w', '2',
+                              '-o', output_path], cwd=os.path.dirname(benchmark_validator.ODD_EVEN_SCRIPT))
+    assert process.returncode == 3
+    with open(output_path) as f:
+        assert json.load(f) == summary